@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Compare the old and new ways of generating the Duplicity commands.
+
+The old way built the options shared by the sources of a group, and
+the filter options of each source again for each command, then
+inserted the command in front of every option list. The new way
+generates these options once and builds each command in one go.
+
+usage: python3 benchmarks/command_generation.py [-n <runs>] [-s <sources>]...
+"""
+import getopt
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dupcomposer.backup_config import BackupConfig
+from dupcomposer.backup_runner import BackupRunner
+from synthetic import get_config_data
+
+
+def get_source_cmd_legacy(source):
+    """Generate the backup options of a source the way it was done before."""
+    cmd = []
+    for filter in source.filters.config or []:
+        cmd.extend(['--' + filter['type'], filter['path']])
+    cmd.extend([source.source_path, source.provider.get_cmd(source.backup_path)])
+    return cmd
+
+
+def get_cmds_legacy(runner):
+    """Generate the backup commands the way it was done before."""
+    cmds = {}
+    for group in runner.config.groups:
+        backup_group = runner.config.groups[group]
+        opts = []
+        for source in backup_group.sources:
+            opts.append(backup_group.encryption.get_cmd() +
+                        backup_group._get_volume_cmd() +
+                        backup_group.prefix.get_cmd() +
+                        backup_group._get_full_frequency(runner.mode) +
+                        get_source_cmd_legacy(source))
+        for i in range(len(opts)):
+            if runner.is_full_backup and runner.mode == 'backup':
+                opts[i][:0] = ['full']
+            opts[i][:0] = BackupRunner.command
+        cmds[group] = opts
+    return cmds
+
+
+def get_cmds_current(runner):
+    """Generate the commands the current way."""
+    return runner.get_cmds_raw()
+
+
+def measure(func, runner, runs):
+    """Get the median run time of func in seconds."""
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        func(runner)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    runs = 5
+    source_counts = []
+    opts, args = getopt.getopt(sys.argv[1:], 'n:s:')
+    for opt, a in opts:
+        if opt == '-n':
+            runs = int(a)
+        elif opt == '-s':
+            source_counts.append(int(a))
+    print('{:>8} {:>12} {:>12} {:>8}'.format('SOURCES', 'OLD', 'NEW', 'SPEEDUP'))
+    for source_count in source_counts or [10000, 100000]:
+        # Spread the sources over 10 groups.
+        config = BackupConfig(get_config_data(10, source_count // 10))
+        runner = BackupRunner(config, 'backup', is_full_backup=True)
+        # Build the groups, so that only the command generation is measured.
+        assert get_cmds_legacy(runner) == get_cmds_current(runner)
+        old = measure(get_cmds_legacy, runner, runs)
+        new = measure(get_cmds_current, runner, runs)
+        print('{:>8} {:>10.1f}ms {:>10.1f}ms {:>7.2f}x'.format(source_count,
+                                                              old * 1000,
+                                                              new * 1000,
+                                                              old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Measure the import time of the dupcomposer CLI.
+
+It runs ``python -X importtime`` in fresh interpreters and reports the
+median cumulative import time of the CLI module, along with the cost of
+the keyring modules, which are only imported when a secret is read from
+the keyring.
+
+usage: python3 benchmarks/import_time.py [-n <runs>]
+"""
+import getopt
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_import_times(module):
+    """Import module in a fresh interpreter and get the import times.
+
+    :param module: The name of the module to import.
+    :type module: str
+    :return: The cumulative import time of each module in microseconds.
+    :rtype: dict
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime',
+                             '-c', 'import {}'.format(module)],
+                            cwd=PROJECT_DIR,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    runs = 10
+    opts, args = getopt.getopt(sys.argv[1:], 'n:')
+    for opt, a in opts:
+        if opt == '-n':
+            runs = int(a)
+    cli_times = []
+    keyring_times = []
+    keyring_imported = False
+    for i in range(runs):
+        times = get_import_times('dupcomposer.__main__')
+        cli_times.append(times['dupcomposer.__main__'])
+        keyring_imported = keyring_imported or 'keyring' in times
+        times = get_import_times('keyring.backends.SecretService')
+        keyring_times.append(times['keyring.backends.SecretService'])
+    print('Median of {} runs:'.format(runs))
+    print('{:<40} {:>8.1f} ms'.format('dupcomposer.__main__',
+                                      statistics.median(cli_times) / 1000))
+    print('{:<40} {:>8.1f} ms'.format('keyring.backends.SecretService',
+                                      statistics.median(keyring_times) / 1000))
+    print('keyring imported by the CLI: {}'.format('yes' if keyring_imported else 'no'))
+
+
+if __name__ == '__main__':
+    main()
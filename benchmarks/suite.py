@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""Measure the startup, planning and execution overhead of dupcomp.
+
+The benchmarks run on synthetic configurations of the given sizes,
+with the fake Duplicity of benchmarks/stub put first on the PATH, so
+that only the overhead of dupcomp is measured. The median time of
+each benchmark and the peak memory allocated while running it are
+reported.
+
+The results can be saved as a baseline, and compared to a saved
+baseline. The comparison lists the benchmarks slower than the baseline
+by more than the threshold, and the script exits with 1 if there are
+any of them.
+
+usage: python3 benchmarks/suite.py [-n <runs>] [-s <groups>x<sources>]...
+                                   [-e <commands>] [--save=<file>]
+                                   [--compare=<file>] [--threshold=<percent>]
+"""
+import contextlib
+import getopt
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dupcomposer.backup_config import BackupConfig
+from dupcomposer.backup_runner import BackupRunner, read_config
+from synthetic import write_config
+
+STUB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub')
+
+
+def measure(func, runs, setup=None):
+    """Get the median run time and the peak memory of func.
+
+    The peak memory is measured in an additional run, as tracing
+    the allocations slows down the code measured.
+
+    :param func: The function to measure, called with the value
+                 returned by setup.
+    :type func: callable
+    :param runs: The number of timed runs.
+    :type runs: int
+    :param setup: A function called before each run, not measured.
+    :type setup: callable
+    :return: The median time in seconds and the peak memory in bytes.
+    :rtype: dict
+    """
+    times = []
+    for i in range(runs):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+    arg = setup() if setup else None
+    tracemalloc.start()
+    try:
+        func(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'time': statistics.median(times), 'peak': peak}
+
+
+def build_groups(config):
+    """Build all the groups of a configuration."""
+    for group in config.groups:
+        config.groups[group]
+
+
+def get_opts_raw(config):
+    """Generate the options of all the groups of a configuration."""
+    for group in config.groups:
+        config.groups[group].get_opts_raw('backup')
+
+
+def bench_planning(config_file, group_count, sources_per_group, runs):
+    """Measure the reading of the config and the command generation.
+
+    :param config_file: The path of the configuration file to generate.
+    :type config_file: str
+    :param group_count: The number of groups.
+    :type group_count: int
+    :param sources_per_group: The number of sources in each group.
+    :type sources_per_group: int
+    :param runs: The number of timed runs.
+    :type runs: int
+    :return: The results by benchmark name.
+    :rtype: dict
+    """
+    write_config(config_file, group_count, sources_per_group)
+    config_data = read_config(config_file)
+
+    def new_config():
+        return BackupConfig(read_config(config_file, use_cache=True))
+
+    def built_config():
+        config = new_config()
+        build_groups(config)
+        return config
+
+    def new_runner():
+        return BackupRunner(built_config(), 'backup')
+
+    # Fill the config cache before measuring the cached read.
+    read_config(config_file, use_cache=True)
+    scale = '{}x{}'.format(group_count, sources_per_group)
+    benchmarks = [
+        ('read_config', lambda arg: read_config(config_file), None),
+        ('read_config_cached',
+         lambda arg: read_config(config_file, use_cache=True), None),
+        ('build_config', lambda arg: build_groups(BackupConfig(config_data)), None),
+        ('get_opts_raw', get_opts_raw, built_config),
+        ('get_cmds_raw', lambda runner: runner.get_cmds_raw(), new_runner),
+    ]
+    return {'{}[{}]'.format(name, scale): measure(func, runs, setup)
+            for name, func, setup in benchmarks}
+
+
+def bench_execution(config_file, command_count, runs):
+    """Measure the overhead of running the commands with the stub.
+
+    The overhead is the run time of the commands through dupcomp,
+    less the time of running the stub the same number of times, for
+    each command.
+
+    :param config_file: The path of the configuration file to generate.
+    :type config_file: str
+    :param command_count: The number of commands to run.
+    :type command_count: int
+    :param runs: The number of timed runs.
+    :type runs: int
+    :return: The results by benchmark name.
+    :rtype: dict
+    """
+    group_count = min(command_count, 4)
+    write_config(config_file, group_count, command_count // group_count)
+    stub = shutil.which('duplicity')
+
+    def run_stub(arg):
+        for i in range(command_count):
+            subprocess.run([stub, 'incremental'], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+
+    def new_runner():
+        return BackupRunner(BackupConfig(read_config(config_file)), 'backup')
+
+    def run_cmds(runner):
+        with open(os.devnull, 'w') as out, contextlib.redirect_stdout(out):
+            runner.run_cmds()
+
+    stub_result = measure(run_stub, runs)
+    result = measure(run_cmds, runs, new_runner)
+    result['time'] = max(result['time'] - stub_result['time'], 0) / command_count
+    return {'run_overhead_per_cmd[{}]'.format(command_count): result}
+
+
+def compare(results, baseline, threshold):
+    """Compare the results to a baseline.
+
+    :param results: The results by benchmark name.
+    :type results: dict
+    :param baseline: The baseline results by benchmark name.
+    :type baseline: dict
+    :param threshold: The slowdown tolerated, eg. 0.25 for 25%.
+    :type threshold: float
+    :return: The names of the benchmarks slower than the baseline.
+    :rtype: list
+    """
+    print('\n{:<36} {:>12} {:>12} {:>8}'.format('BENCHMARK', 'BASELINE',
+                                                 'CURRENT', 'CHANGE'))
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['time']
+        new = results[name]['time']
+        change = (new - old) / old if old else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print('{:<36} {:>10.3f}ms {:>10.3f}ms {:>+7.0%}{}'.format(name, old * 1000,
+                                                                   new * 1000,
+                                                                   change, flag))
+    return regressions
+
+
+def main():
+    runs = 5
+    scales = []
+    command_count = 100
+    save_file = None
+    compare_file = None
+    threshold = 0.25
+    opts, args = getopt.getopt(sys.argv[1:], 'n:s:e:',
+                               ['save=', 'compare=', 'threshold='])
+    for opt, a in opts:
+        if opt == '-n':
+            runs = int(a)
+        elif opt == '-s':
+            scales.append(tuple(int(i) for i in a.split('x')))
+        elif opt == '-e':
+            command_count = int(a)
+        elif opt == '--save':
+            save_file = a
+        elif opt == '--compare':
+            compare_file = a
+        elif opt == '--threshold':
+            threshold = float(a) / 100
+    baseline = None
+    if compare_file:
+        with open(compare_file) as f:
+            baseline = json.load(f)['results']
+    work_dir = tempfile.mkdtemp()
+    # Keep the config cache of the benchmarks away from the user's one.
+    os.environ['XDG_CACHE_HOME'] = work_dir
+    os.environ['PATH'] = os.pathsep.join([STUB_DIR, os.environ.get('PATH', '')])
+    results = {}
+    try:
+        config_file = os.path.join(work_dir, 'dupcomposer-config.yml')
+        for group_count, sources_per_group in scales or [(10, 100), (100, 100)]:
+            results.update(bench_planning(config_file, group_count,
+                                          sources_per_group, runs))
+        if command_count:
+            results.update(bench_execution(config_file, command_count, runs))
+    finally:
+        shutil.rmtree(work_dir)
+    print('{:<36} {:>12} {:>12}'.format('BENCHMARK', 'TIME', 'PEAK MEMORY'))
+    for name, result in results.items():
+        print('{:<36} {:>10.3f}ms {:>10.1f}MB'.format(name, result['time'] * 1000,
+                                                       result['peak'] / 2**20))
+    if save_file:
+        with open(save_file, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'runs': runs,
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if baseline is not None and compare(results, baseline, threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
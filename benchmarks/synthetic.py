@@ -0,0 +1,66 @@
+"""Generate synthetic configurations for the benchmarks.
+
+Functions:
+
+get_config_data: Generate the data of a configuration.
+write_config: Write a generated configuration to a YAML file.
+"""
+import yaml
+
+
+def get_config_data(group_count, sources_per_group):
+    """Generate the data of a configuration.
+
+    The groups use all the provider types in turn, with encryption,
+    file prefixes, full backup frequency and a filter on each source,
+    so that every part of the command generation is exercised.
+
+    :param group_count: The number of groups.
+    :type group_count: int
+    :param sources_per_group: The number of sources in each group.
+    :type sources_per_group: int
+    :rtype: dict
+    """
+    urls = ('file:///backups/',
+            'sftp://user@host{}.example.com/',
+            's3://s3.example.com/bucket{}/')
+    groups = {}
+    for g in range(group_count):
+        sources = {}
+        for s in range(sources_per_group):
+            path = '/srv/group{}/data{}'.format(g, s)
+            sources[path] = {'backup_path': path,
+                             'restore_path': '/restored' + path,
+                             'filters': [{'type': 'exclude', 'path': path + '/tmp'}]}
+        provider = {'url': urls[g % len(urls)].format(g)}
+        if provider['url'].startswith('sftp'):
+            provider['password'] = 'xxxxxx'
+        elif provider['url'].startswith('s3'):
+            provider.update({'aws_access_key_id': 'xxxxxx',
+                             'aws_secret_access_key': 'xxxxxx'})
+        groups['group_{}'.format(g)] = \
+            {'encryption': {'enabled': True, 'gpg_key': 'xxxxxx',
+                            'gpg_passphrase': 'xxxxxx'},
+             'backup_provider': provider,
+             'backup_file_prefixes': {'archive': 'archive_',
+                                      'manifest': 'manifest_',
+                                      'signature': 'signature_'},
+             'full_backup_frequency': '1M',
+             'volume_size': 200,
+             'sources': sources}
+    return {'backup_groups': groups}
+
+
+def write_config(file_path, group_count, sources_per_group):
+    """Write a generated configuration to a YAML file.
+
+    :param file_path: The path of the file.
+    :type file_path: str
+    :param group_count: The number of groups.
+    :type group_count: int
+    :param sources_per_group: The number of sources in each group.
+    :type sources_per_group: int
+    """
+    with open(file_path, 'w') as f:
+        yaml.dump(get_config_data(group_count, sources_per_group), f,
+                  Dumper=getattr(yaml, 'CDumper', yaml.Dumper))
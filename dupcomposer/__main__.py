@@ -1,24 +1,45 @@
 #!/usr/bin/env python3
 """Launch dupcomposer (CLI entrypoint)."""
 import sys
+import atexit
 import getopt
+import itertools
+import json
 import os.path
 import shutil
 import subprocess
 from dupcomposer.backup_runner import read_config, BackupRunner
 from dupcomposer.backup_config import BackupConfig
+from dupcomposer.backup_plan import write_plan, read_plan, get_shard
+from dupcomposer.backup_trace import BackupTracer, NULL_TRACER
+from dupcomposer.backup_history import BackupHistory
+from dupcomposer.backup_state import (BackupJournal, BackupSourceIndex,
+                                      BackupConfigDigests, BackupDeferredGroups,
+                                      get_state_path,
+                                      get_cache_path, is_private_file,
+                                      write_json_atomic)
 
 
 def main():
-    check_duplicity_version(get_terminal_encoding())
     # default config file to look for
     config_file = 'dupcomposer-config.yml'
     dry_run = False
     skip_config_safeguard = False
     full_backup = False
+    jobs = None
+    keep_going = False
+    resume = False
+    force = False
+    check_version = False
+    output_format = 'text'
+    shard = None
+    trace_file = None
     # Collecting and parsing options
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'c:dhsf')
+        opts, args = getopt.getopt(sys.argv[1:], 'c:dhsfj:kr',
+                                   ['jobs=', 'keep-going', 'resume', 'force',
+                                    'check-version', 'format=', 'shard=',
+                                    'trace='])
     except getopt.GetoptError as err:
         print(err)
         usage()
@@ -41,11 +62,51 @@ def main():
             skip_config_safeguard = True
         elif opt == '-f':
             full_backup = True
+        # Number of groups to run in parallel
+        elif opt in ('-j', '--jobs'):
+            try:
+                jobs = int(a)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                print('{}: the number of jobs must be a positive integer.'.format(opt))
+                usage()
+                sys.exit(1)
+        # Don't stop at the first failed command
+        elif opt in ('-k', '--keep-going'):
+            keep_going = True
+        # Skip the commands completed in the last, interrupted run
+        elif opt in ('-r', '--resume'):
+            resume = True
+        # Back up unchanged sources as well
+        elif opt == '--force':
+            force = True
+        # Check the Duplicity version on dry runs as well
+        elif opt == '--check-version':
+            check_version = True
+        # Output format of the dry run
+        elif opt == '--format':
+            if a not in ('text', 'jsonl'):
+                print('--format: the output format must be text or jsonl.')
+                usage()
+                sys.exit(1)
+            output_format = a
+        # Run only a part of the plan
+        elif opt == '--shard':
+            shard = parse_shard(a)
+            if shard is None:
+                print('--shard: the shard must be given as i/n, '
+                      'where 1 <= i <= n.')
+                usage()
+                sys.exit(1)
+        # Record the timing of the run
+        elif opt == '--trace':
+            trace_file = a
         elif opt == '-h':
             usage()
             sys.exit(0)
 
-    if not args or args[0] not in ['backup', 'restore']:
+    if not args or args[0] not in ['backup', 'restore', 'execute-plan']:
         print('backup|restore action is missing from the command!')
         usage()
         sys.exit(1)
@@ -55,55 +116,184 @@ def main():
         usage()
         sys.exit(1)
 
-    config_raw =  read_config(config_file)
+    if output_format != 'text' and (not dry_run or args[0] == 'execute-plan'):
+        print('--format: the output format only applies to dry runs '
+              'of backup and restore.')
+        usage()
+        sys.exit(1)
+
+    if args[0] == 'execute-plan':
+        if len(args) != 2:
+            print('execute-plan: the path of the plan file is missing!')
+            usage()
+            sys.exit(1)
+        if full_backup:
+            print('-f: force full backup is an invalid option for a plan, '
+                  'generate the plan with -f instead.')
+            usage()
+            sys.exit(1)
+        records = read_plan(args[1])
+        if shard:
+            records = get_shard(records, *shard)
+        if not records:
+            print('No commands to run in the plan.')
+            sys.exit(0)
+        mode = records[0]['action']
+        requested_groups = sorted({record['group'] for record in records})
+    elif shard:
+        print('--shard: sharding is only supported with execute-plan.')
+        usage()
+        sys.exit(1)
+    else:
+        mode = args[0]
+        requested_groups = args[1:]
+
+    tracer = NULL_TRACER
+    if trace_file:
+        tracer = BackupTracer()
+        # Write the trace on exit, even if the run fails.
+        atexit.register(save_trace, tracer, trace_file)
+
+    # A dry run doesn't need Duplicity, unless asked to check it.
+    if not dry_run or check_version:
+        with tracer.span('check_duplicity_version'):
+            check_duplicity_version(get_terminal_encoding())
+
+    with tracer.span('read_config'):
+        config_raw =  read_config(config_file, use_cache=True)
     # Check if groups requested are valid
-    for group in args[1:]:
+    for group in requested_groups:
         if group not in config_raw.get('backup_groups', {}):
             raise ValueError('No group {} in the configuration!'.format(group))
-    # Check if any of the existing groups have changed
+    group_names = requested_groups or list(config_raw.get('backup_groups', {}))
+    # Check if any of the groups to run have changed
     if not skip_config_safeguard:
-        check_config_change(config_raw, config_file)
+        with tracer.span('check_config_change'):
+            check_config_change(config_raw, config_file, group_names)
     # Setting up the environment
-    config = BackupConfig(config_raw)
-    runner = BackupRunner(config, args[0], full_backup)
+    with tracer.span('BackupConfig'):
+        config = BackupConfig(config_raw)
+    journal = index = history = deferred = None
+    if not dry_run:
+        journal = BackupJournal(get_state_path(config_file, 'journal'),
+                                mode, resume)
+        index = BackupSourceIndex(get_state_path(config_file, 'index'))
+        history = BackupHistory(get_state_path(config_file, 'history'))
+        deferred = BackupDeferredGroups(get_state_path(config_file, 'deferred'))
+    runner = BackupRunner(config, mode, full_backup, jobs, keep_going,
+                          journal, index, force, tracer, history, deferred)
 
     # Do the actual run
-    if dry_run:
-        commands = runner.get_cmds_raw(args[1:])
-        # Sorting keys for consistent ordering of output (for functional tests).
-        for group in sorted(commands):
-            print('Generating commands for group {}:\n'.format(group))
-            for cmd in commands[group]:
-                print(' '.join(cmd))
-
-            print()
+    if dry_run and output_format == 'jsonl':
+        with tracer.span('write_plan'):
+            write_plan(runner.iter_plan(requested_groups), sys.stdout)
+    elif dry_run:
+        if args[0] == 'execute-plan':
+            commands = ((record['group'], record['argv']) for record in records)
+        else:
+            commands = runner.iter_cmds(requested_groups)
+        # The commands are printed as they are generated, in the order
+        # of the group names (for functional tests).
+        with tracer.span('print_commands'):
+            for group, group_commands in itertools.groupby(commands,
+                                                           key=lambda item: item[0]):
+                print('Generating commands for group {}:\n'.format(group))
+                for _, cmd in group_commands:
+                    print(' '.join(cmd))
+
+                print()
     else:
         # True run
-        runner.run_cmds(args[1:])
-        # Cache current run's config so that we can compare later
-        save_config_cache(config_file)
+        if args[0] == 'execute-plan':
+            results = runner.run_plan(records)
+        else:
+            results = runner.run_cmds(requested_groups)
+        # Record the config of the groups run so that we can compare later
+        with tracer.span('save_config_digests'):
+            save_config_digests(config_raw, config_file,
+                                [result.name for result in results
+                                 if not result.deferred])
 
 
 def usage():
     print("""-----
-usage: dupcomp.py [-d] [-s] [-f] [-c <configpath>] backup|restore [backup_group1 backup_group2 ...]
+usage: dupcomp.py [-d] [-s] [-f] [-k] [-r] [--force] [--check-version] [--format text|jsonl] [--trace <tracepath>] [-j <n>] [-c <configpath>] backup|restore [backup_group1 backup_group2 ...]
+       dupcomp.py [-d] [-s] [-k] [-r] [--check-version] [--shard <i>/<n>] [--trace <tracepath>] [-j <n>] [-c <configpath>] execute-plan <planpath>
 
 optional arguments:
  -d                dry run (just print the commands to be executed)
  -c <configpath>   use the configuration file at <configpath>
  -s                skip the configuration change safeguard step
  -f                force full backup
+ -j, --jobs <n>    run up to <n> backup groups in parallel
+ -k, --keep-going  keep running the remaining commands after a failure
+ -r, --resume      skip the commands completed in the last, interrupted run
+ --force           back up sources even if they are unchanged
+ --check-version   check the Duplicity version on dry runs as well
+ --format <format> output format of the dry run, text (default) or jsonl,
+                   the latter being an execution plan
+ --shard <i>/<n>   run the ith of n parts of the execution plan
+ --trace <tracepath>
+                   write the timing of the run to <tracepath> as a
+                   Chrome trace, to be opened in Perfetto
 -----""")
 
 
+def save_trace(tracer, trace_file):
+    """Write the trace of the run.
+
+    :param tracer: The tracer of the run.
+    :type tracer: :class:`backup_trace.BackupTracer`
+    :param trace_file: The path of the trace file.
+    :type trace_file: str
+    """
+    try:
+        tracer.save(trace_file)
+    except OSError as err:
+        print('Unable to write the trace to {}: {}'.format(trace_file, err),
+              file=sys.stderr)
+
+
+def parse_shard(value):
+    """Parse the value of the --shard option.
+
+    :param value: The shard given as i/n.
+    :type value: str
+    :return: The shard number and the number of shards,
+             or None if the value is invalid.
+    :rtype: tuple
+    """
+    try:
+        shard, shard_count = map(int, value.split('/'))
+    except ValueError:
+        return None
+    if not 1 <= shard <= shard_count:
+        return None
+    return shard, shard_count
+
+
 def check_duplicity_version(codec):
     """Verify that the correct version of duplicity is available.
 
+    A successful check is cached, keyed by the path, modification time
+    and size of the executable, so Duplicity is only run again when it
+    is replaced or updated.
+
     :param codec: The character encoding of the terminal.
     :ptype codec: str
     """
+    executable = shutil.which(BackupRunner.command[0])
     try:
-        result = subprocess.run(BackupRunner.command + ['--version'],
+        if executable is None:
+            raise FileNotFoundError(BackupRunner.command[0])
+        stat = os.stat(executable)
+        executable_id = {'path': executable,
+                         'mtime_ns': stat.st_mtime_ns,
+                         'size': stat.st_size}
+        cached_id = read_version_cache()
+        if cached_id is not None and cached_id == executable_id:
+            return
+        result = subprocess.run([executable, '--version'],
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
 
@@ -123,6 +313,41 @@ def check_duplicity_version(codec):
             print('Unsupported Duplicity version %d.%d.%d!\n\n'
                   'Please install Duplicity 0.7 or later.' % (major, minor, patch))
             exit(1)
+        save_version_cache(executable_id)
+
+
+def read_version_cache():
+    """Read the executable checked by the last version check.
+
+    Cache files which other users could have written are ignored.
+
+    :return: The path, modification time and size of the executable,
+             or None if there is no valid cache.
+    :rtype: dict
+    """
+    try:
+        with open(get_cache_path('duplicity-version.json')) as f:
+            if is_private_file(f):
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def save_version_cache(executable_id):
+    """Record the executable that passed the version check.
+
+    The check is not affected if the cache can't be written.
+
+    :param executable_id: The path, modification time and size
+                          of the executable.
+    :type executable_id: dict
+    """
+    try:
+        write_json_atomic(get_cache_path('duplicity-version.json'),
+                          executable_id, 0o600)
+    except OSError:
+        pass
 
 def get_terminal_encoding():
     """Returns the parent shell's character encoding.
@@ -137,35 +362,63 @@ def get_terminal_encoding():
         return 'utf-8'
 
 
-def check_config_change(config_data, config_filename):
-    """Prints a message and exits on config change."""
-    cache_filename = '.'.join([config_filename, 'cached'])
-    if os.path.isfile(cache_filename):
-        cached_groups = read_config(cache_filename).get('backup_groups', {})
-        current_groups = config_data.get('backup_groups', {})
-        changed_groups = []
-        # We need the group names in a deterministic order
-        # in the output for testing.
-        for group_name in sorted(current_groups.keys()):
-            if group_name in cached_groups and \
-               current_groups[group_name] != cached_groups[group_name]:
-                changed_groups.append(group_name)
-        # At least one group changed, abort.
-        if changed_groups:
-            print('The configuration of existing group(s) '
-                  '%s have changed! Backup aborted.\n\n'
-                  'If you are certain, that no backup sets will '
-                  'be impacted unintentionally by this change, '
-                  'rerun dupcomp with the \'-f\' flag that skips '
-                  'this safeguard step. You might want to consider '
-                  'doing a dry run first, to verify how duplicity '
-                  'will be run after the change.' % ', '.join(changed_groups))
-            exit(1)
+def load_config_digests(config_filename):
+    """Load the config digests of the groups run before.
+
+    If there is no digest file yet, the digests are computed from the
+    copy of the config cached by earlier versions, if there is one.
+
+    :param config_filename: The path of the configuration file.
+    :type config_filename: str
+    :rtype: :class:`backup_state.BackupConfigDigests`
+    """
+    digests = BackupConfigDigests(get_state_path(config_filename, 'digests'))
+    if not os.path.isfile(digests.file_path):
+        # Earlier versions saved the copy with a double dot.
+        for suffix in ('cached', '.cached'):
+            legacy_filename = get_state_path(config_filename, suffix)
+            if os.path.isfile(legacy_filename):
+                digests.add_groups(read_config(legacy_filename)
+                                   .get('backup_groups', {}))
+                break
+    return digests
 
 
-def save_config_cache(file_path):
-    shutil.copyfile(file_path, '.'.join([file_path, '.cached']))
+def check_config_change(config_data, config_filename, group_names):
+    """Prints a message and exits on config change.
 
+    Only the groups to be run are checked, against the config
+    digests recorded on their last successful run.
+    """
+    current_groups = config_data.get('backup_groups', {})
+    changed_groups = load_config_digests(config_filename).get_changed(
+        {group_name: current_groups[group_name] for group_name in group_names})
+    # At least one group changed, abort.
+    if changed_groups:
+        print('The configuration of existing group(s) '
+              '%s have changed! Backup aborted.\n\n'
+              'If you are certain, that no backup sets will '
+              'be impacted unintentionally by this change, '
+              'rerun dupcomp with the \'-f\' flag that skips '
+              'this safeguard step. You might want to consider '
+              'doing a dry run first, to verify how duplicity '
+              'will be run after the change.' % ', '.join(changed_groups))
+        exit(1)
+
+
+def save_config_digests(config_data, config_filename, group_names):
+    """Record the config digests of the groups run.
+
+    :param config_data: The raw configuration.
+    :type config_data: dict
+    :param config_filename: The path of the configuration file.
+    :type config_filename: str
+    :param group_names: The names of the groups run.
+    :type group_names: list
+    """
+    current_groups = config_data.get('backup_groups', {})
+    load_config_digests(config_filename).update(
+        {group_name: current_groups[group_name] for group_name in group_names})
 
 if __name__ == '__main__':
     main()
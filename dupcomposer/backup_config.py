@@ -3,6 +3,7 @@
 Classes:
 
 BackupConfig: Represent the whole configuration and generate the groups.
+BackupGroups: Build the backup groups of the configuration on demand.
 BackupGroup: Orchestrate the backup for the given config group.
 BackupEncryption: Handle the backup GPG encryption options.
 BackupProvider: Abstract class and factory for the following classes:
@@ -11,10 +12,104 @@ BackupProvider: Abstract class and factory for the following classes:
     BackupProviderSSH: SFTP/SCP target options.
 BackupSource: Backup/restore path options.
 BackupFilePrefixes: Handle the file prefixing for backup files.
+BackupPathFilter: Handle the include and exclude filters of a source.
+BackupRetryPolicy: Decide if and when a failed command is retried.
 """
+import datetime
+import os
 import re
+import random
+from collections.abc import Mapping
+from urllib.parse import urlsplit
 from . import backup_keyring
 
+
+def _check_positive_int(value, name):
+    """Raise an error if value is not a positive integer.
+
+    :param value: The configured value.
+    :param name: The description of the value used in the error message.
+    :type name: str
+    :raises ValueError: if the value is not a positive integer.
+    """
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError('{} must be a positive integer, '
+                         'got: {}'.format(name, value))
+
+
+def _get_timeout(data):
+    """Read and check the command_timeout value of a config node.
+
+    :param data: The raw config node (global or group level).
+    :type data: dict
+    :raises ValueError: if the timeout is not a positive number.
+    :return: The timeout in seconds or None if not configured.
+    :rtype: int, float
+    """
+    timeout = data.get('command_timeout', None)
+    if timeout is None:
+        return None
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) \
+       or timeout <= 0:
+        raise ValueError('command_timeout must be a positive number of '
+                         'seconds, got: {}'.format(timeout))
+    return timeout
+
+
+def _get_env_allowlist(data):
+    """Read and check the env_allowlist value of a config node.
+
+    :param data: The raw config node (global or group level).
+    :type data: dict
+    :raises ValueError: if the value is not a list of variable names.
+    :return: The names of the environment variables passed on to
+             Duplicity or None if not configured.
+    :rtype: list
+    """
+    allowlist = data.get('env_allowlist', None)
+    if allowlist is None:
+        return None
+    if not isinstance(allowlist, list) or \
+       not all(isinstance(name, str) for name in allowlist):
+        raise ValueError('env_allowlist must be a list of environment '
+                         'variable names, got: {}'.format(allowlist))
+    return allowlist
+
+
+def _get_keyring_entries(group_data):
+    """Collect the keyring entries of the secrets of a group.
+
+    :param group_data: Raw config data of the group.
+    :type group_data: dict
+    :return: The [service, account] lists of the secrets stored in the
+             keyring. Invalid secret definitions are left out, those
+             are reported when the group is built.
+    :rtype: list
+    """
+    encryption = group_data.get('encryption', None) or {}
+    provider = group_data.get('backup_provider', None) or {}
+    secrets = [provider.get('aws_secret_access_key', None),
+               provider.get('password', None)]
+    if encryption.get('enabled', False) is True:
+        secrets.append(encryption.get('gpg_passphrase', None))
+    return [secret for secret in secrets
+            if isinstance(secret, list) and len(secret) == 2]
+
+
+def _get_secret_ref(secret_def):
+    """Get a reference to a secret, which doesn't reveal its value.
+
+    :param secret_def: The configuration value describing the secret.
+    :type secret_def: str, list
+    :return: The keyring service and account of the secret, or None if
+             the secret is given in the configuration.
+    :rtype: dict
+    """
+    if isinstance(secret_def, list):
+        return {'keyring': {'service': secret_def[0], 'account': secret_def[1]}}
+    return None
+
+
 class BackupConfig:
     """Generate the backup groups from the config data and store them.
 
@@ -23,14 +118,192 @@ class BackupConfig:
     """
     def __init__(self, config_data):
         self.config_data = config_data
-        self.groups = {}
+        self._set_max_parallel_groups()
+        self._set_provider_limits()
+        self._set_target_limits()
+        self.command_timeout = _get_timeout(config_data)
+        self.env_allowlist = _get_env_allowlist(config_data)
+        self._set_metrics()
+        self._set_deadline()
         self.createGroups()
 
-    def createGroups(self):
-        """Generate a list of :class:`BackupGroup` objects."""
+    def _set_max_parallel_groups(self):
+        """Check and set the number of groups allowed to run concurrently.
+
+        :raises ValueError: if the value is not a positive integer.
+        """
+        value = self.config_data.get('max_parallel_groups', 1)
+        _check_positive_int(value, 'max_parallel_groups')
+        self.max_parallel_groups = value
+
+    def _set_provider_limits(self):
+        """Check and set the concurrency limits by provider type.
+
+        :raises ValueError: if the provider type is unknown or the
+                            limit is not a positive integer.
+        """
+        limits = self.config_data.get('provider_limits', {}) or {}
+        provider_types = [p.provider_type for p in (BackupProviderLocal,
+                                                    BackupProviderS3,
+                                                    BackupProviderSSH)]
+        for provider_type, limit in limits.items():
+            if provider_type not in provider_types:
+                raise ValueError('Unknown provider type in provider_limits: '
+                                 '{}'.format(provider_type))
+            _check_positive_int(limit, 'Provider limit for {}'.format(provider_type))
+        self.provider_limits = dict(limits)
+
+    def _set_target_limits(self):
+        """Check and set the concurrency limits by backup target.
+
+        The targets are the hosts of SFTP/SCP providers and the
+        buckets of S3 providers, as returned by
+        :meth:`BackupProvider.get_target`.
+
+        :raises ValueError: if a limit is not a positive integer.
+        """
+        default = self.config_data.get('max_parallel_per_target', None)
+        if default is not None:
+            _check_positive_int(default, 'max_parallel_per_target')
+        self.max_parallel_per_target = default
+        limits = self.config_data.get('target_limits', {}) or {}
+        for target, limit in limits.items():
+            _check_positive_int(limit, 'Target limit for {}'.format(target))
+        self.target_limits = dict(limits)
+
+    def _set_metrics(self):
+        """Check and set the paths of the metrics files.
+
+        :raises ValueError: if the metrics node has unknown keys or
+                            the paths are not strings.
+        """
+        metrics = self.config_data.get('metrics', {}) or {}
+        if not isinstance(metrics, dict):
+            raise ValueError('metrics must be a mapping of the metrics file '
+                             'paths, got: {}'.format(metrics))
+        for key, file_path in metrics.items():
+            if key not in ('json', 'textfile'):
+                raise ValueError('Unknown metrics file type: {}'.format(key))
+            if not isinstance(file_path, str) or not file_path:
+                raise ValueError('The path of the {} metrics file must be a '
+                                 'string, got: {}'.format(key, file_path))
+        self.metrics = {key: os.path.expanduser(file_path)
+                        for key, file_path in metrics.items()}
+
+    def _set_deadline(self):
+        """Check and set the deadline and the window of the runs.
+
+        The deadline is a time of day, given as a 'HH:MM' string, and
+        the window is a number of seconds from the start of the run.
+
+        :raises ValueError: if the deadline is not a valid time of day
+                            or the window is not a positive number.
+        """
+        deadline = self.config_data.get('deadline', None)
+        if deadline is not None:
+            match = re.fullmatch(r'(\d{1,2}):(\d{2})', str(deadline))
+            if (not isinstance(deadline, str) or not match or
+                    int(match.group(1)) > 23 or int(match.group(2)) > 59):
+                raise ValueError("deadline must be a time of day given as a "
+                                 "'HH:MM' string, got: {}".format(deadline))
+            deadline = (int(match.group(1)), int(match.group(2)))
+        self.deadline = deadline
+        window = self.config_data.get('window', None)
+        if window is not None and (isinstance(window, bool) or
+                                   not isinstance(window, (int, float)) or
+                                   window <= 0):
+            raise ValueError('window must be a positive number of seconds, '
+                             'got: {}'.format(window))
+        self.window = window
+
+    def get_time_left(self, now):
+        """Get the time left until the deadline or the end of the window.
+
+        :param now: The start of the run.
+        :type now: :class:`datetime.datetime`
+        :return: The number of seconds left, or None if neither the
+                 deadline nor the window are configured.
+        :rtype: float
+        """
+        limits = []
+        if self.window is not None:
+            limits.append(self.window)
+        if self.deadline is not None:
+            hour, minute = self.deadline
+            deadline = now.replace(hour=hour, minute=minute, second=0,
+                                   microsecond=0)
+            # The next occurrence of the time of day.
+            if deadline <= now:
+                deadline += datetime.timedelta(days=1)
+            limits.append((deadline - now).total_seconds())
+        return min(limits, default=None)
+
+    def resolve_secrets(self, group_names=None):
+        """Read the keyring secrets of the groups in bulk.
+
+        The secrets are read with one keyring access for each keyring
+        configuration, and cached for the groups to use.
+
+        :param group_names: The groups to read the secrets for, all the
+                            groups if not given.
+        :type group_names: list
+        """
         groups_conf = self.config_data['backup_groups']
+        entries_by_keyring = {}
         for group_name in groups_conf:
-            self.groups[group_name] = BackupGroup(groups_conf[group_name], group_name)
+            if group_names is not None and group_name not in group_names:
+                continue
+            group_data = groups_conf[group_name]
+            entries = _get_keyring_entries(group_data)
+            if not entries:
+                continue
+            keyring_conf = group_data.get('keyring', None) or {}
+            key = tuple(sorted(keyring_conf.items()))
+            for entry in entries:
+                if entry not in entries_by_keyring.setdefault(key, []):
+                    entries_by_keyring[key].append(entry)
+        for key, entries in entries_by_keyring.items():
+            backup_keyring.BackupKeyring(**dict(key)).get_secrets(entries)
+
+    def createGroups(self):
+        """Set up the mapping of the :class:`BackupGroup` objects.
+
+        The groups are built when first accessed, and their secrets
+        are read from the keyring when their environment is needed.
+        """
+        self.groups = BackupGroups(self.config_data['backup_groups'])
+
+
+class BackupGroups(Mapping):
+    """Build the backup groups of the configuration on demand.
+
+    It maps the group names to :class:`BackupGroup` objects, building
+    each group the first time it is accessed, so that the groups not
+    requested for a run are never processed.
+
+    :param groups_conf: The raw config data of the groups by name.
+    :type groups_conf: dict
+    """
+    def __init__(self, groups_conf):
+        self.groups_conf = groups_conf
+        self._groups = {}
+
+    def __getitem__(self, group_name):
+        if group_name not in self._groups:
+            self._groups[group_name] = BackupGroup(self.groups_conf[group_name],
+                                                   group_name)
+        return self._groups[group_name]
+
+    def __contains__(self, group_name):
+        # Don't build the group just to check its name.
+        return group_name in self.groups_conf
+
+    def __iter__(self):
+        return iter(self.groups_conf)
+
+    def __len__(self):
+        return len(self.groups_conf)
+
 
 class BackupGroup:
     """Orchestrate the backup options for the given config group.
@@ -40,6 +313,9 @@ class BackupGroup:
     :param group_name: The name of the group in the configuration.
     :type group_name: str
     """
+    # The priority classes, the highest first.
+    priorities = ('critical', 'normal', 'low')
+
     def __init__(self, group_data, group_name):
         self.group_data = group_data
         self.name = group_name
@@ -59,6 +335,20 @@ class BackupGroup:
         self._setup_sources()
         self.full_frequency = group_data.get('full_backup_frequency', None)
         self.volsize = group_data['volume_size']
+        self.command_timeout = _get_timeout(group_data)
+        self.env_allowlist = _get_env_allowlist(group_data)
+        self.parallel_sources = group_data.get('parallel_sources', 1)
+        _check_positive_int(self.parallel_sources, 'parallel_sources')
+        self.retry_policy = BackupRetryPolicy(group_data.get('retry', None))
+        self.skip_unchanged = group_data.get('skip_unchanged', False)
+        if self.skip_unchanged not in (True, False):
+            raise ValueError('skip_unchanged must be yes or no, '
+                             'got: {}'.format(self.skip_unchanged))
+        self.priority = group_data.get('priority', 'normal')
+        if self.priority not in BackupGroup.priorities:
+            raise ValueError('priority must be one of {}, got: {}'
+                             .format(', '.join(BackupGroup.priorities),
+                                     self.priority))
 
 
     @property
@@ -73,21 +363,45 @@ class BackupGroup:
         self._keyring = backup_keyring.BackupKeyring(**config)
 
 
-    def get_opts_raw(self, mode):
+    def get_opts_raw(self, mode, cmd_prefix=()):
         """Get the Duplicity command line options for all sources.
 
         :param mode: Duplicity command, either 'backup' or 'restore'.
         :type mode: str
+        :param cmd_prefix: Arguments to put in front of the options of
+                           each source, eg. the command itself.
+        :type cmd_prefix: list
         :return: A list of CLI option lists for all sources (paths).
         :rtype: list
         """
-        opts_all = []
+        return list(self.iter_opts_raw(mode, cmd_prefix))
+
+    def iter_opts_raw(self, mode, cmd_prefix=()):
+        """Generate the Duplicity command line options source by source.
+
+        :param mode: Duplicity command, either 'backup' or 'restore'.
+        :type mode: str
+        :param cmd_prefix: Arguments to put in front of the options of
+                           each source, eg. the command itself.
+        :type cmd_prefix: list
+        :return: A generator of the CLI option lists of the sources.
+        :rtype: generator
+        """
+        # The options shared by the sources are only generated once.
+        group_opts = list(cmd_prefix) + self.get_group_opts(mode)
         for source in self.sources:
-            # Chain the CLI options.
-            opts_all.append(self.encryption.get_cmd() + self._get_volume_cmd() +
-                            self.prefix.get_cmd() + self._get_full_frequency(mode) +
-                            source.get_cmd(mode))
-        return opts_all
+            yield group_opts + source.get_cmd(mode)
+
+    def get_group_opts(self, mode):
+        """Get the Duplicity command line options shared by the sources.
+
+        :param mode: Duplicity command, either 'backup' or 'restore'.
+        :type mode: str
+        :return: A list of CLI options.
+        :rtype: list
+        """
+        return (self.encryption.get_cmd() + self._get_volume_cmd() +
+                self.prefix.get_cmd() + self._get_full_frequency(mode))
 
     def get_env(self):
         """Get all the environment variable data for the given group.
@@ -101,6 +415,19 @@ class BackupGroup:
         env_all.update(self.encryption.get_env())
         return env_all
 
+    def get_env_refs(self):
+        """Get the environment variable names without the secret values.
+
+        :return: A dictionary with the env. variable names as keys and
+                 references to the keyring entries of the secrets or
+                 None as values.
+        :rtype: dict
+        """
+        refs_all = {}
+        refs_all.update(self.provider.get_env_refs())
+        refs_all.update(self.encryption.get_env_refs())
+        return refs_all
+
     def _get_volume_cmd(self):
         """Generate the volsize CLI option"""
         return ['--volsize', str(self.volsize)]
@@ -161,6 +488,17 @@ class BackupEncryption:
         else:
             return {'PASSPHRASE': self.gpg_passphrase}
 
+    def get_env_refs(self):
+        """Get the shell env. variable names and their secret references.
+
+        :return: A dictionary with the variable name as key.
+        :rtype: dict
+        """
+        if self.enabled == False:
+            return {}
+        else:
+            return {'PASSPHRASE': _get_secret_ref(self.passphrase_config)}
+
     def _set_enabled_flag(self, encryption_data):
         """Check if the flag in the config is valid and set it.
 
@@ -187,25 +525,34 @@ class BackupEncryption:
         # For encryption to work, we need both the key and the passphrase.
         if self.enabled and {'gpg_key', 'gpg_passphrase'} < set(encryption_data.keys()):
             self.gpg_key = encryption_data['gpg_key']
-            self._set_passphrase(encryption_data['gpg_passphrase'])
+            self.passphrase_config = encryption_data['gpg_passphrase']
+            self._set_passphrase(self.passphrase_config)
         elif not self.enabled:
-            self.gpg_key = self.gpg_passphrase = None
+            self.gpg_key = self._passphrase = self.passphrase_config = None
         else:
             raise ValueError('Encryption is enabled, but GPG keys are missing.')
 
 
+    @property
+    def gpg_passphrase(self):
+        """The passphrase, read from the keyring on first use."""
+        if isinstance(self._passphrase, list):
+            self._passphrase = self.backup_group.keyring.get_secret(self._passphrase)
+        return self._passphrase
+
     def _set_passphrase(self, pp_config):
-        """Set the passphrase, get it from keyring if needed.
+        """Check and set the passphrase config.
+
+        Passphrases stored in the keyring are only read when needed.
 
         :param pp_config: Either the passphrase itself, or a list with two
                           members specifying the keyring service and account.
         :type pp_config: str, list
         """
-        if isinstance(pp_config, str):
-            self.gpg_passphrase = pp_config
-        elif isinstance(pp_config, list) and len(pp_config) == 2 \
-             and hasattr(self.backup_group, 'keyring'):
-            self.gpg_passphrase = self.backup_group.keyring.get_secret(pp_config)
+        if isinstance(pp_config, str) or \
+           (isinstance(pp_config, list) and len(pp_config) == 2
+            and hasattr(self.backup_group, 'keyring')):
+            self._passphrase = pp_config
         else:
             raise ValueError('Unable to get/set '
                              'passphrase with data: %s' % pp_config)
@@ -268,6 +615,42 @@ class BackupProvider:
         # TODO: Indicate that this is an abstract method.
         pass
 
+    def get_env_refs(self):
+        """Get the env. variable names and references to their secrets.
+
+        :return: The variable names as keys, with the keyring references
+                 of the secrets or None as values.
+        :rtype: dict
+        """
+        return {}
+
+    def get_target(self):
+        """Get the remote the backups are sent to.
+
+        It is used to limit the number of backups hitting the same
+        remote at the same time.
+
+        :return: The name of the remote or None for local backups.
+        :rtype: str
+        """
+        return None
+
+
+    def _check_secret(self, secret_def):
+        """Check the secret configuration without reading the keyring.
+
+        :param secret_def: The configuration value decribing the secret.
+        :type secret_def: str, list
+        :raises ValueError: if the secret configuration is invalid.
+        :return: The secret configuration.
+        :rtype: str, list
+        """
+        if isinstance(secret_def, str) or \
+           (isinstance(secret_def, list) and len(secret_def) == 2
+            and hasattr(self.backup_group, 'keyring')):
+            return secret_def
+        else:
+            raise ValueError('Invalid secret configuration: %s' % secret_def)
 
     def _load_secret(self, secret_def):
         """Determine the secret type and load from the keyring is needed.
@@ -276,14 +659,10 @@ class BackupProvider:
         :type secret_def: str, list
         """
         # We return the plaintext secret as-is
-        if isinstance(secret_def, str):
+        if isinstance(self._check_secret(secret_def), str):
             return secret_def
         # We read the secret from the keyring
-        elif isinstance(secret_def, list) and len(secret_def) == 2 \
-             and hasattr(self.backup_group, 'keyring'):
-            return self.backup_group.keyring.get_secret(secret_def)
-        else:
-            raise ValueError('Invalid secret configuration: %s' % secret_def)
+        return self.backup_group.keyring.get_secret(secret_def)
 
 
 class BackupProviderLocal(BackupProvider):
@@ -292,6 +671,8 @@ class BackupProviderLocal(BackupProvider):
     :param provider_data: Raw provider data.
     :type provider_data: dict
 """
+    provider_type = 'local'
+
     def __init__(self, provider_data):
         super().__init__(provider_data)
 
@@ -311,10 +692,20 @@ class BackupProviderS3(BackupProvider):
     :param backup_group: Group config object
     :type backup_group: BackupGroup
     """
+    provider_type = 's3'
+
     def __init__(self, provider_data, backup_group):
         super().__init__(provider_data, backup_group)
         self.access_key = provider_data['aws_access_key_id']
-        self.secret_key = self._load_secret(provider_data['aws_secret_access_key'])
+        self.secret_key_config = provider_data['aws_secret_access_key']
+        # The secret is read from the keyring on first use.
+        self._secret_key = self._check_secret(self.secret_key_config)
+
+    @property
+    def secret_key(self):
+        """The AWS secret access key."""
+        self._secret_key = self._load_secret(self._secret_key)
+        return self._secret_key
 
 
     def get_cmd(self, path):
@@ -342,6 +733,30 @@ class BackupProviderS3(BackupProvider):
         return {'AWS_ACCESS_KEY_ID': self.access_key,
                 'AWS_SECRET_ACCESS_KEY': self.secret_key}
 
+    def get_env_refs(self):
+        """Get the AWS env. variable names and the secret key reference.
+
+        :rtype: dict
+        """
+        return {'AWS_ACCESS_KEY_ID': None,
+                'AWS_SECRET_ACCESS_KEY': _get_secret_ref(self.secret_key_config)}
+
+    def get_target(self):
+        """Get the name of the S3 bucket.
+
+        The bucket is the first path element of s3:// URLs
+        (s3://host/bucket) and the host part of other URL schemes
+        (boto3+s3://bucket).
+
+        :return: The name of the bucket.
+        :rtype: str
+        """
+        url = urlsplit(self.url)
+        if url.scheme == 's3' and url.path.strip('/'):
+            return url.path.strip('/').split('/')[0]
+        else:
+            return url.netloc
+
 class BackupProviderSSH(BackupProvider):
     """SFTP/SCP backup target provider.
 
@@ -350,12 +765,23 @@ class BackupProviderSSH(BackupProvider):
     :param backup_group: Group config object
     :type backup_group: BackupGroup
     """
+    provider_type = 'ssh'
+
     def __init__(self, provider_data, backup_group):
         super().__init__(provider_data, backup_group)
-        self.password = provider_data.get('password', None)
-        # If we have password data, we need to run it through the loader
-        if self.password:
-            self.password = self._load_secret(self.password)
+        self.password_config = provider_data.get('password', None)
+        self._password = self.password_config
+        # If we have password data, we need to check it, the password
+        # is read from the keyring on first use.
+        if self._password:
+            self._check_secret(self._password)
+
+    @property
+    def password(self):
+        """The SFTP/SCP password or None."""
+        if self._password:
+            self._password = self._load_secret(self._password)
+        return self._password
 
 
     def get_env(self):
@@ -369,6 +795,24 @@ class BackupProviderSSH(BackupProvider):
         else:
             return {}
 
+    def get_env_refs(self):
+        """Get the SSH password env. variable name and its reference.
+
+        :rtype: dict
+        """
+        if self.password_config:
+            return {'FTP_PASSWORD': _get_secret_ref(self.password_config)}
+        else:
+            return {}
+
+    def get_target(self):
+        """Get the SFTP/SCP host name.
+
+        :return: The host name without the user and port.
+        :rtype: str
+        """
+        return urlsplit(self.url).hostname
+
 class BackupSource:
     """Path object for the source, backup and restore target.
 
@@ -411,9 +855,8 @@ class BackupSource:
         """
         # The Duplicity action is determined by the URL / path order.
         if mode == 'backup':
-            cmd = self.filters.get_cmd()
-            cmd.extend([self.source_path, self.provider.get_cmd(self.backup_path)])
-            return cmd
+            return self.filters.get_cmd() + [self.source_path,
+                                             self.provider.get_cmd(self.backup_path)]
         # Include / exclude not supported for restore!
         elif mode == 'restore':
             if not self.restore_path:
@@ -484,8 +927,11 @@ class BackupPathFilter:
         self.config = config
         self.valid_keys = ['path', 'type']
         self.valid_types = ['exclude', 'include']
+        self.filter_commands = []
         if self.config:
             self._verify_config()
+            for filter in self.config:
+                self.filter_commands.extend(['--' + filter['type'], filter['path']])
 
 
     def _verify_config(self):
@@ -505,10 +951,98 @@ class BackupPathFilter:
         return cmd: The command options.
         rtype cmd: list
         """
-        if self.config:
-            cmd = []
-            for filter in self.config:
-                cmd.extend(['--' + filter['type'], filter['path']])
-            return cmd
-        else:
-            return []
+        return self.filter_commands
+
+    def is_excluded(self, path):
+        """Check if a path is surely excluded from the backup.
+
+        Like Duplicity, the first filter matching the path or one of its
+        parents decides. The check errs on the side of including paths:
+        directories with included paths below them are not excluded, and
+        no path is excluded if any of the filters contains a glob pattern.
+
+        :param path: The absolute path to check.
+        :type path: str
+        :rtype: bool
+        """
+        if not self.config or any(re.search(r'[*?\[]', f['path'])
+                                  for f in self.config):
+            return False
+        path = os.path.abspath(path)
+        for filter in self.config:
+            filter_path = os.path.abspath(filter['path'])
+            if path != filter_path and not path.startswith(filter_path.rstrip('/') + '/'):
+                continue
+            if filter['type'] == 'include':
+                return False
+            # Don't prune the directories we have to descend into.
+            return not any(f['type'] == 'include' and
+                           os.path.abspath(f['path']).startswith(path.rstrip('/') + '/')
+                           for f in self.config)
+        return False
+
+
+class BackupRetryPolicy:
+    """Decide if and when a failed command is retried.
+
+    The delay before the nth retry is backoff_base * 2 ** (n - 1)
+    seconds, capped at backoff_max. With jitter enabled, the actual
+    delay is a random value between zero and the computed delay.
+
+    :param config: The raw retry configuration or None for no retries.
+    :type config: dict, None
+    :raises ValueError: if the configuration is invalid.
+    """
+    valid_keys = ('max_attempts', 'backoff_base', 'backoff_max',
+                  'jitter', 'retryable_exit_codes')
+
+    def __init__(self, config=None):
+        config = config or {}
+        for k in config:
+            if k not in self.valid_keys:
+                raise ValueError('{} is not a valid retry option.'.format(k))
+        self.max_attempts = config.get('max_attempts', 1)
+        _check_positive_int(self.max_attempts, 'max_attempts')
+        self.backoff_base = config.get('backoff_base', 10)
+        self.backoff_max = config.get('backoff_max', 600)
+        for name, value in (('backoff_base', self.backoff_base),
+                            ('backoff_max', self.backoff_max)):
+            if isinstance(value, bool) or not isinstance(value, (int, float)) \
+               or value < 0:
+                raise ValueError('{} must be a non-negative number, '
+                                 'got: {}'.format(name, value))
+        self.jitter = config.get('jitter', True)
+        if self.jitter not in (True, False):
+            raise ValueError('jitter must be yes or no, got: {}'.format(self.jitter))
+        # None means, that any non-zero return code is retried.
+        self.retryable_exit_codes = config.get('retryable_exit_codes', None)
+        if self.retryable_exit_codes is not None and \
+           (not isinstance(self.retryable_exit_codes, list) or
+            not all(isinstance(c, int) for c in self.retryable_exit_codes)):
+            raise ValueError('retryable_exit_codes must be a list of integers.')
+
+    def should_retry(self, attempt, returncode):
+        """Check if the command should be run again.
+
+        :param attempt: The number of the attempt that failed, from 1.
+        :type attempt: int
+        :param returncode: The return code of the failed attempt.
+        :type returncode: int
+        :rtype: bool
+        """
+        if returncode == 0 or attempt >= self.max_attempts:
+            return False
+        return (self.retryable_exit_codes is None or
+                returncode in self.retryable_exit_codes)
+
+    def get_delay(self, attempt):
+        """Get the number of seconds to wait before the next attempt.
+
+        :param attempt: The number of the attempt that failed, from 1.
+        :type attempt: int
+        :rtype: float
+        """
+        delay = min(self.backoff_base * 2 ** (attempt - 1), self.backoff_max)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
@@ -0,0 +1,244 @@
+"""Run the Duplicity processes on an asyncio event loop.
+
+Classes:
+
+BackupEngine: Start Duplicity subprocesses and stream their output.
+BackupScheduler: Start queued jobs within global and per target limits.
+
+Functions:
+
+get_lpt_order: Order jobs by their estimated duration, longest first.
+get_makespan: Predict the time it takes to run jobs in parallel.
+"""
+import asyncio
+import heapq
+import locale
+from .backup_trace import NULL_TRACER
+
+
+def get_lpt_order(durations):
+    """Order jobs by their estimated duration, longest first.
+
+    Starting the longest jobs first keeps the workers from idling at
+    the end, while the last long job runs (longest processing time
+    first scheduling). Jobs of the same duration keep their order.
+
+    :param durations: The estimated durations of the jobs.
+    :type durations: list
+    :return: The indexes of the jobs in the order to run them.
+    :rtype: list
+    """
+    return sorted(range(len(durations)), key=lambda i: -durations[i])
+
+
+def get_makespan(durations, workers):
+    """Predict the time it takes to run jobs in parallel.
+
+    Each job is started on the first worker free, in the order given.
+
+    :param durations: The estimated durations of the jobs in the order
+                      they are started.
+    :type durations: list
+    :param workers: The number of jobs running at the same time.
+    :type workers: int
+    :return: The time the last job finishes.
+    :rtype: float
+    """
+    finish_times = [0.0] * min(workers, len(durations))
+    for duration in durations:
+        heapq.heapreplace(finish_times, finish_times[0] + duration)
+    return max(finish_times, default=0.0)
+
+
+class BackupEngine:
+    """Start Duplicity subprocesses and stream their output.
+
+    All processes are driven by a single event loop, so no thread is
+    held up while a process runs. The number of processes running at the
+    same time can be limited for each provider type.
+
+    :param provider_limits: The maximum number of concurrent processes
+                            by provider type ('local', 's3' or 'ssh').
+                            Provider types not listed are not limited.
+    :type provider_limits: dict
+    :param tracer: The tracer recording the time spent starting
+                   and running the processes.
+    :type tracer: :class:`backup_trace.BackupTracer`
+    """
+    # Maximum length of an output line we are able to read.
+    line_limit = 2 ** 20
+
+    def __init__(self, provider_limits=None, tracer=None):
+        self.provider_limits = provider_limits or {}
+        self.tracer = tracer or NULL_TRACER
+        self.encoding = locale.getpreferredencoding(False)
+        # The semaphores are bound to the running loop, so
+        # these are created on first use.
+        self._semaphores = {}
+
+    async def run_cmd(self, command, env, out, provider=None, timeout=None,
+                      line_handler=None):
+        """Run a command and write its output to out.
+
+        The standard output and error of the process are read
+        concurrently and written to out line by line. The process
+        is killed if the coroutine is cancelled or the timeout expires.
+
+        :param command: The command argument list.
+        :type command: list
+        :param env: The complete environment of the process.
+        :type env: dict
+        :param out: The stream to write the output to.
+        :type out: file object
+        :param provider: The provider of the backup group, used to apply
+                         the concurrency limit of its type.
+        :type provider: :class:`backup_config.BackupProvider`
+        :param timeout: Seconds to wait for the process to finish.
+        :type timeout: int, float
+        :param line_handler: A function called with each line of the
+                             standard output, as it is read.
+        :type line_handler: callable
+        :raises asyncio.TimeoutError: if the process didn't finish in time.
+        :return: The return code of the process.
+        :rtype: int
+        """
+        semaphore = self._get_semaphore(provider)
+        if semaphore is None:
+            return await self._run_process(command, env, out, timeout,
+                                           line_handler)
+        async with semaphore:
+            return await self._run_process(command, env, out, timeout,
+                                           line_handler)
+
+    def _get_semaphore(self, provider):
+        """Get the semaphore limiting the given provider's type.
+
+        :param provider: The backup provider or None.
+        :type provider: :class:`backup_config.BackupProvider`
+        :return: The semaphore or None if the type is not limited.
+        :rtype: :class:`asyncio.Semaphore`
+        """
+        provider_type = getattr(provider, 'provider_type', None)
+        if provider_type not in self.provider_limits:
+            return None
+        if provider_type not in self._semaphores:
+            self._semaphores[provider_type] = \
+                asyncio.Semaphore(self.provider_limits[provider_type])
+        return self._semaphores[provider_type]
+
+    async def _run_process(self, command, env, out, timeout, line_handler=None):
+        """Start the process and wait until it exits."""
+        with self.tracer.span('spawn'):
+            proc = await asyncio.create_subprocess_exec(*command,
+                                                        env=env,
+                                                        stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.PIPE,
+                                                        limit=self.line_limit)
+        try:
+            with self.tracer.span('duplicity', {'pid': proc.pid}):
+                await asyncio.wait_for(asyncio.gather(self._pump(proc.stdout, out,
+                                                                 line_handler),
+                                                      self._pump(proc.stderr, out),
+                                                      proc.wait()),
+                                       timeout)
+        except BaseException:
+            # Timeout, cancellation or a broken output stream.
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        return proc.returncode
+
+    async def _pump(self, stream, out, line_handler=None):
+        """Copy the lines of stream to out until the end of the stream."""
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            text = line.decode(self.encoding, errors='replace')
+            out.write(text)
+            out.flush()
+            if line_handler:
+                line_handler(text)
+
+
+class BackupScheduler:
+    """Start queued jobs within global and per target limits.
+
+    Each job belongs to a target (a remote host or bucket). A job is
+    started when fewer than max_jobs jobs are running and its target
+    has a free slot. Jobs waiting for a busy target don't hold up the
+    jobs queued behind them for other targets.
+
+    :param max_jobs: The maximum number of jobs running at the same time.
+    :type max_jobs: int
+    :param target_limits: The maximum number of concurrent jobs by target.
+    :type target_limits: dict
+    :param default_target_limit: The limit of the targets not listed in
+                                 target_limits, None for no limit.
+    :type default_target_limit: int
+    """
+    def __init__(self, max_jobs, target_limits=None, default_target_limit=None):
+        self.max_jobs = max_jobs
+        self.target_limits = target_limits or {}
+        self.default_target_limit = default_target_limit
+
+    def get_limit(self, target):
+        """Get the concurrency limit of a target.
+
+        :param target: The target name, None for local jobs.
+        :type target: str
+        :return: The limit or None if the target is not limited.
+        :rtype: int
+        """
+        if target is None:
+            return None
+        return self.target_limits.get(target, self.default_target_limit)
+
+    async def run(self, jobs, worker, stop=None):
+        """Run the worker for each job, respecting the limits.
+
+        Jobs are started in the order given, skipping over the ones
+        whose target is busy.
+
+        :param jobs: A list of (target, job) tuples.
+        :type jobs: list
+        :param worker: A coroutine function called with the job.
+        :type worker: callable
+        :param stop: A function returning True, when no more jobs
+                     should be started.
+        :type stop: callable
+        :return: The jobs which were not started.
+        :rtype: list
+        """
+        pending = list(jobs)
+        running = {}
+        busy = {}
+        try:
+            while pending or running:
+                if not (stop and stop()):
+                    for item in list(pending):
+                        if len(running) >= self.max_jobs:
+                            break
+                        target, job = item
+                        limit = self.get_limit(target)
+                        if limit is not None and busy.get(target, 0) >= limit:
+                            continue
+                        pending.remove(item)
+                        busy[target] = busy.get(target, 0) + 1
+                        running[asyncio.ensure_future(worker(job))] = target
+                elif not running:
+                    break
+                done, _ = await asyncio.wait(list(running),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    busy[running.pop(task)] -= 1
+                    # Raise any errors of the worker.
+                    task.result()
+        finally:
+            # Don't leave jobs behind on errors or cancellation.
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(list(running))
+        return [job for target, job in pending]
@@ -0,0 +1,136 @@
+"""Keep the history of the Duplicity commands run in a SQLite database.
+
+Classes:
+
+BackupHistory: Record the outcome and statistics of the commands run.
+"""
+import contextlib
+import sqlite3
+from .backup_metrics import STATS_FIELDS
+from .backup_state import hash_data
+
+# The columns of the statistics, named after the exported metrics.
+STATS_COLUMNS = [(field, name) for field, (name, help_text) in STATS_FIELDS.items()]
+
+
+class BackupHistory:
+    """Record the outcome and statistics of the commands run.
+
+    Each attempt to run a Duplicity command is a row of the commands
+    table. The rows are kept in memory during the run and written in a
+    single transaction by :meth:`save`, so recording them doesn't slow
+    down the run.
+
+    :param file_path: The path of the database file.
+    :type file_path: str
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        # Rows not saved yet.
+        self.pending = []
+
+    def add(self, group, source, mode, cmd, start, end, returncode, stats):
+        """Record an attempt to run a command, without saving it.
+
+        :param group: The name of the group.
+        :type group: str
+        :param source: The path of the source.
+        :type source: str
+        :param mode: The run mode, 'backup' or 'restore'.
+        :type mode: str
+        :param cmd: The command argument list.
+        :type cmd: list
+        :param start: The time the command was started, in seconds
+                      since the epoch.
+        :type start: float
+        :param end: The time the command ended.
+        :type end: float
+        :param returncode: The return code of the command.
+        :type returncode: int
+        :param stats: The statistics printed by Duplicity,
+                      see :class:`backup_metrics.DuplicityStats`.
+        :type stats: dict
+        """
+        self.pending.append((group, source, mode, hash_data(cmd), start, end,
+                             returncode) +
+                            tuple(stats.get(field, None)
+                                  for field, column in STATS_COLUMNS))
+
+    def _connect(self):
+        """Open the database, creating the table if needed."""
+        conn = sqlite3.connect(self.file_path)
+        stats_columns = ''.join(', {} NUMERIC'.format(column)
+                                for field, column in STATS_COLUMNS)
+        conn.execute('CREATE TABLE IF NOT EXISTS commands ('
+                     'id INTEGER PRIMARY KEY, group_name TEXT NOT NULL, '
+                     'source TEXT, mode TEXT NOT NULL, argv_hash TEXT NOT NULL, '
+                     'start_time REAL NOT NULL, end_time REAL NOT NULL, '
+                     'returncode INTEGER{})'.format(stats_columns))
+        conn.execute('CREATE INDEX IF NOT EXISTS commands_source '
+                     'ON commands (group_name, source, mode)')
+        return conn
+
+    def save(self):
+        """Write the rows recorded in one transaction."""
+        if not self.pending:
+            return
+        columns = ['group_name', 'source', 'mode', 'argv_hash', 'start_time',
+                   'end_time', 'returncode'] + [column for field, column
+                                                in STATS_COLUMNS]
+        with contextlib.closing(self._connect()) as conn:
+            with conn:
+                conn.executemany('INSERT INTO commands ({}) VALUES ({})'
+                                 .format(', '.join(columns),
+                                         ', '.join('?' * len(columns))),
+                                 self.pending)
+        self.pending = []
+
+    def get_durations(self, mode):
+        """Get the duration of the last successful run of each command.
+
+        :param mode: The run mode, 'backup' or 'restore'.
+        :type mode: str
+        :return: The durations in seconds by (group, source).
+        :rtype: dict
+        """
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute('SELECT group_name, source, end_time - start_time '
+                                'FROM commands WHERE mode = ? AND returncode = 0 '
+                                'ORDER BY id', (mode,))
+            # The later rows replace the earlier ones.
+            return {(group, source): duration for group, source, duration in rows}
+
+    def get_throughput(self, mode):
+        """Get the average source size processed per second.
+
+        :param mode: The run mode, 'backup' or 'restore'.
+        :type mode: str
+        :return: The throughput in bytes per second, or None if there
+                 are no statistics recorded.
+        :rtype: float
+        """
+        with contextlib.closing(self._connect()) as conn:
+            size, duration = conn.execute(
+                'SELECT SUM(source_file_size_bytes), SUM(end_time - start_time) '
+                'FROM commands WHERE mode = ? AND returncode = 0 '
+                'AND source_file_size_bytes IS NOT NULL', (mode,)).fetchone()
+        if not size or not duration:
+            return None
+        return size / duration
+
+    def get_rows(self, mode=None):
+        """Get the rows recorded, oldest first.
+
+        :param mode: Only the rows of this run mode, if given.
+        :type mode: str
+        :return: The rows as dicts, keyed by the column names.
+        :rtype: list
+        """
+        with contextlib.closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            if mode is None:
+                rows = conn.execute('SELECT * FROM commands ORDER BY id')
+            else:
+                rows = conn.execute('SELECT * FROM commands WHERE mode = ? '
+                                    'ORDER BY id', (mode,))
+            return [dict(row) for row in rows]
@@ -1,4 +1,3 @@
-import keyring
 import os
 import stat
 import pwd
@@ -19,15 +18,40 @@ class BackupKeyring:
                 keyring is listening on. This parameter is MANDATORY
                 when a username is provided upon instantiation.
     :type bus_address: str
+
+    The secrets read are cached for the lifetime of the process, keyed
+    by the UID, the bus address, the service and the account, so each
+    secret is read from the keyring only once.
+
+    The keyring module is imported when the first secret is read, so
+    that runs without keyring secrets don't pay for loading it.
     """
     # The UID of the user running the script,
     runuser_id = os.geteuid()
     # The socket address of the DBUS the Gnome Keyring
     # is listening on for the user running the script.
     runuser_bus = os.environ.get('DBUS_SESSION_BUS_ADDRESS', None)
-    if not isinstance(keyring.get_keyring(),
-                      keyring.backends.SecretService.Keyring):
-        keyring.set_keyring(keyring.backends.SecretService.Keyring())
+    # Secrets already read: (uid, bus, service, account) -> secret
+    secret_cache = {}
+    # The keyring module, imported on first use.
+    keyring_module = None
+
+
+    @classmethod
+    def _load_keyring(cls):
+        """Import the keyring module and select the Secret Service backend.
+
+        :return: The keyring module.
+        :rtype: module
+        """
+        if cls.keyring_module is None:
+            import keyring
+            import keyring.backends.SecretService
+            if not isinstance(keyring.get_keyring(),
+                              keyring.backends.SecretService.Keyring):
+                keyring.set_keyring(keyring.backends.SecretService.Keyring())
+            cls.keyring_module = keyring
+        return cls.keyring_module
 
 
     def __init__(self, username=None, bus_address=None):
@@ -75,17 +99,40 @@ class BackupKeyring:
                          the account name [1].
         :type ks_entry: list
         """
-        # Set correct UID and DBUS socket
-        os.seteuid(self.uid)
-        os.environ['DBUS_SESSION_BUS_ADDRESS'] = self.bus
-
-        pw = keyring.get_password(*ks_entry)
-        """Reset to the original UID and BUS address.
-        
-        This might not be absolutely necessary, but doing it
-        anyways, to make sure the changed environment doesn't
-        affect other operations.
+        return self.get_secrets([ks_entry])[0]
+
+
+    def get_secrets(self, ks_entries):
+        """Read several secrets from the keyring at once.
+
+        The secrets not cached yet are all read with a single switch
+        to the keyring's UID and DBUS socket.
+
+        :param ks_entries: A list of keyring entries, each a list of the
+                           keyring service and the account name.
+        :type ks_entries: list
+        :return: The secrets in the order of ks_entries.
+        :rtype: list
         """
-        os.seteuid(BackupKeyring.runuser_id)
-        os.environ['DBUS_SESSION_BUS_ADDRESS'] = BackupKeyring.runuser_bus
-        return pw
+        keys = [(self.uid, self.bus, service, account)
+                for service, account in ks_entries]
+        missing = [key for key in keys if key not in BackupKeyring.secret_cache]
+        if missing:
+            keyring = BackupKeyring._load_keyring()
+            # Set correct UID and DBUS socket
+            os.seteuid(self.uid)
+            os.environ['DBUS_SESSION_BUS_ADDRESS'] = self.bus
+            try:
+                for key in missing:
+                    if key not in BackupKeyring.secret_cache:
+                        BackupKeyring.secret_cache[key] = keyring.get_password(*key[2:])
+            finally:
+                """Reset to the original UID and BUS address.
+
+                This might not be absolutely necessary, but doing it
+                anyways, to make sure the changed environment doesn't
+                affect other operations.
+                """
+                os.seteuid(BackupKeyring.runuser_id)
+                os.environ['DBUS_SESSION_BUS_ADDRESS'] = BackupKeyring.runuser_bus
+        return [BackupKeyring.secret_cache[key] for key in keys]
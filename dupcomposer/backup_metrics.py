@@ -0,0 +1,172 @@
+"""Collect the statistics of the Duplicity runs and export them.
+
+Classes:
+
+DuplicityStats: Parse the statistics block of the Duplicity output.
+
+Functions:
+
+get_metrics_data: Get the results of a run as JSON serializable data.
+write_metrics_json: Write the results of a run to a JSON file.
+write_metrics_textfile: Write the results of a run to a Prometheus textfile.
+"""
+import time
+from .backup_state import write_file_atomic, write_json_atomic
+
+# The statistics collected, with the name and help text of the metric
+# exported to Prometheus.
+STATS_FIELDS = {
+    'ElapsedTime': ('elapsed_seconds',
+                    'Duration of the Duplicity backup.'),
+    'SourceFiles': ('source_files',
+                    'Number of files in the source.'),
+    'SourceFileSize': ('source_file_size_bytes',
+                       'Total size of the files in the source.'),
+    'NewFiles': ('new_files',
+                 'Number of files new since the last backup.'),
+    'ChangedFiles': ('changed_files',
+                     'Number of files changed since the last backup.'),
+    'DeltaEntries': ('delta_entries',
+                     'Number of entries in the backup delta.'),
+    'RawDeltaSize': ('raw_delta_size_bytes',
+                     'Size of the backup delta before compression.'),
+    'TotalDestinationSizeChange': ('destination_size_change_bytes',
+                                   'Change of the size of the backup target.'),
+    'Errors': ('errors',
+               'Number of errors reported by Duplicity.'),
+}
+METRIC_PREFIX = 'dupcomposer_'
+
+
+class DuplicityStats:
+    """Parse the statistics block of the Duplicity output.
+
+    The lines of the output are fed one by one as they are read, the
+    values of the statistics block printed at the end of a backup are
+    collected in self.values. ElapsedTime is a float, the other values
+    are integers.
+    """
+    block_start = '--------------[ Backup Statistics ]--------------'
+    block_end = '-----'
+
+    def __init__(self):
+        self.values = {}
+        self._in_block = False
+
+    def feed(self, line):
+        """Process a line of the Duplicity output.
+
+        :param line: The output line.
+        :type line: str
+        """
+        line = line.strip()
+        if not self._in_block:
+            if line == DuplicityStats.block_start:
+                self._in_block = True
+                self.values = {}
+            return
+        if line.startswith(DuplicityStats.block_end):
+            self._in_block = False
+            return
+        # eg. "SourceFileSize 40960 (40.0 KB)"
+        fields = line.split(None, 2)
+        if len(fields) < 2 or fields[0] not in STATS_FIELDS:
+            return
+        try:
+            value = float(fields[1])
+        except ValueError:
+            return
+        self.values[fields[0]] = value if fields[0] == 'ElapsedTime' else int(value)
+
+
+def get_metrics_data(results, mode):
+    """Get the results of a run as JSON serializable data.
+
+    :param results: The results of the groups.
+    :type results: list of :class:`backup_runner.GroupResult`
+    :param mode: The run mode, 'backup' or 'restore'.
+    :type mode: str
+    :rtype: dict
+    """
+    groups = []
+    for result in results:
+        sources = [{'source': source.source,
+                    'status': source.status,
+                    'returncode': source.returncode,
+                    'elapsed': round(source.elapsed, 3),
+                    'stats': source.stats}
+                   for source in result.sources]
+        groups.append({'group': result.name,
+                       'status': result.status,
+                       'returncode': result.returncode,
+                       'elapsed': round(result.elapsed, 3),
+                       'sources': sources})
+    return {'time': int(time.time()), 'mode': mode, 'groups': groups}
+
+
+def write_metrics_json(file_path, results, mode):
+    """Write the results of a run to a JSON file.
+
+    :param file_path: The path of the file.
+    :type file_path: str
+    :param results: The results of the groups.
+    :type results: list of :class:`backup_runner.GroupResult`
+    :param mode: The run mode, 'backup' or 'restore'.
+    :type mode: str
+    """
+    write_json_atomic(file_path, get_metrics_data(results, mode))
+
+
+def _format_labels(labels):
+    """Format the labels of a Prometheus sample."""
+    escaped = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                .replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels]
+    return '{' + ','.join(escaped) + '}'
+
+
+def write_metrics_textfile(file_path, results, mode):
+    """Write the results of a run to a Prometheus textfile.
+
+    The file is in the text format read by the textfile collector of
+    the node exporter. It is replaced in an atomic way, so the collector
+    never reads it half written.
+
+    :param file_path: The path of the file, it should have a .prom
+                      extension for the collector to pick it up.
+    :type file_path: str
+    :param results: The results of the groups.
+    :type results: list of :class:`backup_runner.GroupResult`
+    :param mode: The run mode, 'backup' or 'restore'.
+    :type mode: str
+    """
+    metrics = [('last_run_timestamp_seconds', 'Time of the last run.',
+                [((('mode', mode),), int(time.time()))]),
+               ('group_exit_code', 'Exit code of the group, -1 if skipped.',
+                [((('group', result.name),),
+                  -1 if result.returncode is None else result.returncode)
+                 for result in results]),
+               ('group_duration_seconds', 'Wall time of the group.',
+                [((('group', result.name),), round(result.elapsed, 3))
+                 for result in results]),
+               ('source_exit_code', 'Exit code of the Duplicity command.',
+                [((('group', result.name), ('source', source.source)),
+                  source.returncode)
+                 for result in results for source in result.sources
+                 if source.returncode is not None])]
+    for field, (name, help_text) in STATS_FIELDS.items():
+        metrics.append((name, help_text,
+                        [((('group', result.name), ('source', source.source)),
+                          source.stats[field])
+                         for result in results for source in result.sources
+                         if field in source.stats]))
+    lines = []
+    for name, help_text, samples in metrics:
+        if not samples:
+            continue
+        lines.append('# HELP {}{} {}'.format(METRIC_PREFIX, name, help_text))
+        lines.append('# TYPE {}{} gauge'.format(METRIC_PREFIX, name))
+        for labels, value in samples:
+            lines.append('{}{}{} {}'.format(METRIC_PREFIX, name,
+                                            _format_labels(labels), value))
+    write_file_atomic(file_path, ('\n'.join(lines) + '\n').encode('utf-8'))
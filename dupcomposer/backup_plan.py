@@ -0,0 +1,82 @@
+"""Export the Duplicity commands as an execution plan and read it back.
+
+A plan is a JSON Lines file, with one record for each Duplicity
+command. The records are generated by
+:meth:`backup_runner.BackupRunner.iter_plan`.
+
+Functions:
+
+write_plan: Write plan records to a stream as JSON Lines.
+read_plan: Read the records of a plan file.
+get_shard: Select the records of one shard of a plan.
+"""
+import json
+
+
+def write_plan(records, out):
+    """Write plan records to a stream as JSON Lines.
+
+    :param records: The plan records.
+    :type records: iterable
+    :param out: The stream to write to.
+    :type out: file object
+    """
+    for record in records:
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_plan(file_path):
+    """Read the records of a plan file.
+
+    :param file_path: The path of the plan file.
+    :type file_path: str
+    :raises ValueError: if a line is not a valid plan record.
+    :return: The plan records in the order of the file.
+    :rtype: list
+    """
+    required_keys = {'group', 'source', 'action', 'argv'}
+    records = []
+    with open(file_path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not isinstance(record, dict) or not required_keys <= set(record):
+                raise ValueError('Invalid plan record on line {} of '
+                                 '{}.'.format(line_number, file_path))
+            records.append(record)
+    return records
+
+
+def get_shard(records, shard, shard_count):
+    """Select the records of one shard of a plan.
+
+    Starting with the most costly one, each record is assigned to
+    the shard with the lowest total estimated cost so far, records
+    without a cost estimate are spread evenly. The assignment only
+    depends on the plan, so the shards selected on different machines
+    don't overlap and cover the whole plan.
+
+    :param records: The plan records.
+    :type records: list
+    :param shard: The number of the shard, from 1 to shard_count.
+    :type shard: int
+    :param shard_count: The number of shards.
+    :type shard_count: int
+    :return: The records of the shard in the order of the plan.
+    :rtype: list
+    """
+    costs = [record.get('cost', None) or 0 for record in records]
+    # The total cost and the number of records of each shard, the
+    # number of records decides between shards of the same cost.
+    totals = [(0, 0)] * shard_count
+    selected = []
+    for i in sorted(range(len(records)), key=lambda i: -costs[i]):
+        target = totals.index(min(totals))
+        totals[target] = (totals[target][0] + costs[i], totals[target][1] + 1)
+        if target == shard - 1:
+            selected.append(i)
+    return [records[i] for i in sorted(selected)]
@@ -4,30 +4,143 @@
 Classes:
 
 BackupRunner: Fetch the duplicity commands and process them.
+GroupResult: The outcome of running the commands of a backup group.
+SourceResult: The outcome of running the command of a source.
 
 Functions:
 
 read_config: Read the configuration file and load the YAML data.
 """
 import yaml
+import asyncio
+import hashlib
+import io
+import json
+import datetime
+import heapq
+import sqlite3
 import time
-import subprocess
 import os
+import shutil
 import sys
 from . import backup_config
+from .backup_engine import (BackupEngine, BackupScheduler, get_lpt_order,
+                            get_makespan)
+from .backup_metrics import (DuplicityStats, write_metrics_json,
+                             write_metrics_textfile)
+from .backup_trace import NULL_TRACER
+from .backup_state import (get_tree_digest, get_tree_size, get_cache_path,
+                           is_private_file, write_file_atomic)
 
-def read_config(file_path):
+# Use the much faster LibYAML based loader, if PyYAML was built with it.
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+def read_config(file_path, use_cache=False):
     """Read the configuration file and load the YAML data.
 
+    With use_cache, the loaded data is stored as JSON in the user's
+    cache directory along with the hash of the file content, and loaded
+    from there as long as the content is unchanged. Cache files not
+    owned by the user, or writable by others, are ignored. Data which
+    doesn't survive the JSON round trip, eg. dates, is not cached.
+
     :param file_path: The path of the YAML config file.
     :type file_path: str
+    :param use_cache: Use the cache of the loaded data?
+    :type use_cache: bool
     :return: The complete configuration data loaded into a dictionary.
     :rtype: dict
     """
-    with open(file_path) as config_file:
-        config = yaml.load(config_file, Loader=yaml.FullLoader)
+    with open(file_path, 'rb') as config_file:
+        content = config_file.read()
+    if not use_cache:
+        return yaml.load(content, Loader=YAML_LOADER)
+    content_hash = hashlib.sha256(content).hexdigest()
+    # One cache file for each config file.
+    path_hash = hashlib.sha256(os.path.abspath(file_path).encode('utf-8')).hexdigest()
+    try:
+        cache_path = get_cache_path('config-{}.json'.format(path_hash))
+    except OSError:
+        return yaml.load(content, Loader=YAML_LOADER)
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            if is_private_file(cache_file):
+                cached = json.loads(cache_file.read().decode('utf-8'))
+                if cached['hash'] == content_hash:
+                    return cached['data']
+    except (OSError, ValueError, TypeError, KeyError):
+        # Missing, foreign or broken cache, parse the file.
+        pass
+    config = yaml.load(content, Loader=YAML_LOADER)
+    try:
+        serialized = json.dumps({'hash': content_hash, 'data': config})
+        # eg. integer keys would come back as strings.
+        if json.loads(serialized)['data'] != config:
+            return config
+        write_file_atomic(cache_path, serialized.encode('utf-8'), 0o600)
+    except (OSError, ValueError, TypeError):
+        pass
     return config
 
+class GroupResult:
+    """The outcome of running the commands of a backup group.
+
+    :param name: The name of the group.
+    :type name: str
+    """
+    def __init__(self, name):
+        self.name = name
+        self.returncode = None
+        self.elapsed = 0.0
+        # Buffered output of the group when running in parallel.
+        self.output = ''
+        # (command, return code) of the commands that failed.
+        self.failures = []
+        # The results of the sources, in the order they were run.
+        self.sources = []
+        # Not run, as it would have missed the deadline.
+        self.deferred = False
+
+    @property
+    def status(self):
+        """Human readable status of the group run."""
+        if self.deferred:
+            return 'DEFERRED'
+        elif self.returncode is None:
+            return 'SKIPPED'
+        elif self.returncode == 0:
+            return 'OK'
+        else:
+            return 'FAILED'
+
+class SourceResult:
+    """The outcome of running the command of a source.
+
+    :param group: The name of the group.
+    :type group: str
+    :param source: The path of the source.
+    :type source: str
+    """
+    def __init__(self, group, source):
+        self.group = group
+        self.source = source
+        self.returncode = None
+        self.elapsed = 0.0
+        # The command was skipped, as completed or unchanged.
+        self.skipped = False
+        # The statistics printed by Duplicity, see DuplicityStats.
+        self.stats = {}
+
+    @property
+    def status(self):
+        """Human readable status of the source run."""
+        if self.skipped:
+            return 'SKIPPED'
+        elif self.returncode == 0:
+            return 'OK'
+        else:
+            return 'FAILED'
+
 class BackupRunner:
     """Collect the Duplicity commands and execute the backups.
 
@@ -37,12 +150,51 @@ class BackupRunner:
     :type mode: str
     :param is_full_backup: Force full backup?
     :type is_full_backup: bool
+    :param jobs: The maximum number of groups to run concurrently,
+                 defaults to max_parallel_groups from the configuration.
+    :type jobs: int
+    :param keep_going: Keep running the remaining commands after a failure?
+    :type keep_going: bool
+    :param journal: The journal recording the completed commands.
+    :type journal: :class:`backup_state.BackupJournal`
+    :param index: The index of the sources backed up, used by the
+                  groups that skip unchanged sources.
+    :type index: :class:`backup_state.BackupSourceIndex`
+    :param force: Back up unchanged sources anyway?
+    :type force: bool
+    :param tracer: The tracer recording the timing of the run,
+                   no timing is recorded by default.
+    :type tracer: :class:`backup_trace.BackupTracer`
+    :param history: The history of the commands run, the commands
+                    of the run are added to it.
+    :type history: :class:`backup_history.BackupHistory`
+    :param deferred: The groups deferred to the next run, the groups
+                     deferred earlier are run first.
+    :type deferred: :class:`backup_state.BackupDeferredGroups`
     """
     command = ['duplicity']
+    # Return code reported for commands killed after the timeout,
+    # the same as the one of timeout(1).
+    timeout_returncode = 124
+    # Return code reported for commands which couldn't be started,
+    # the same as the one of the shell for commands not found.
+    start_error_returncode = 127
+    # Bytes backed up per second assumed, before any statistics are
+    # recorded in the history.
+    default_throughput = 50 * 2 ** 20
 
-    def __init__(self, config, mode, is_full_backup=False):
+    def __init__(self, config, mode, is_full_backup=False, jobs=None,
+                 keep_going=False, journal=None, index=None, force=False,
+                 tracer=None, history=None, deferred=None):
         self.base_cmd = 'duplicity'
         self.is_full_backup = is_full_backup
+        self.keep_going = keep_going
+        self.journal = journal
+        self.index = index
+        self.force = force
+        self.tracer = tracer or NULL_TRACER
+        self.history = history
+        self.deferred = deferred
         if isinstance(config, backup_config.BackupConfig):
             self.config = config
         else:
@@ -52,6 +204,25 @@ class BackupRunner:
             self.mode = mode
         else:
             raise ValueError('{} is not a valid run mode.'.format(mode))
+        if jobs is None:
+            jobs = self.config.max_parallel_groups
+        if isinstance(jobs, bool) or not isinstance(jobs, int) or jobs < 1:
+            raise ValueError('The number of jobs must be a positive integer.')
+        self.jobs = jobs
+        self.engine = BackupEngine(self.config.provider_limits, self.tracer)
+        # The complete environment of the processes by group.
+        self._process_envs = {}
+        # The paths of the executables run by name.
+        self._executables = {}
+        # The estimated durations of the commands by group.
+        self._estimates = {}
+        # The estimated durations of the groups.
+        self._group_costs = {}
+        # The deadline of the run on the monotonic clock.
+        self._deadline_at = None
+        self.scheduler = BackupScheduler(jobs,
+                                         self.config.target_limits,
+                                         self.config.max_parallel_per_target)
 
     def get_cmds_raw(self, group_names=None):
         """Get the Duplicity command lists for each group.
@@ -66,51 +237,703 @@ class BackupRunner:
         :rtype: dict
         """
         cmds = {}
+        cmd_prefix = self.get_cmd_prefix()
+        # The groups are built on access, so only touch the selected ones.
         for group in self.config.groups:
             if not group_names or group in group_names:
-                opts =  self.config.groups[group].get_opts_raw(self.mode)
-                for i in range(len(opts)):
-                    # We prepend the options if full is forced.
-                    if self.is_full_backup and self.mode == 'backup':
-                        opts[i][:0] = ['full']
-                    # BackupGroup only returns the options,
-                    # so prepend with the actual command.
-                    opts[i][:0] = BackupRunner.command
-                cmds[group] = opts
+                cmds[group] = self.config.groups[group].get_opts_raw(self.mode,
+                                                                     cmd_prefix)
         return cmds
 
+    def iter_cmds(self, group_names=None):
+        """Generate the Duplicity commands one by one.
+
+        The commands are generated lazily, group by group in alphabetical
+        order, and in the order of the sources within a group.
+
+        :param group_names: The group names to give the commands for,
+                            all the groups if not given.
+        :type group_names: list
+        :return: A generator of (group name, command list) tuples.
+        :rtype: generator
+        """
+        cmd_prefix = self.get_cmd_prefix()
+        for group in sorted(group_names or self.config.groups):
+            for cmd in self.config.groups[group].iter_opts_raw(self.mode,
+                                                               cmd_prefix):
+                yield group, cmd
+
+    def iter_plan(self, group_names=None):
+        """Generate the execution plan records of the commands.
+
+        Each record describes a Duplicity command with the keys:
+
+        - group: the name of the group
+        - source: the source path of the command
+        - action: the run mode, 'backup' or 'restore'
+        - argv: the command argument list
+        - env: the names of the environment variables needed, with
+          references to the keyring entries of the secrets, the values
+          are never included
+        - host: the backup target, see
+          :meth:`backup_config.BackupProvider.get_target`
+        - cost: the estimated cost, the size of the source in bytes
+          for backups, None if unknown
+
+        :param group_names: The group names to give the records for,
+                            all the groups if not given.
+        :type group_names: list
+        :return: A generator of the plan records in the order of
+                 :meth:`iter_cmds`.
+        :rtype: generator
+        """
+        cmd_prefix = self.get_cmd_prefix()
+        for group in sorted(group_names or self.config.groups):
+            backup_group = self.config.groups[group]
+            env_refs = backup_group.get_env_refs()
+            host = backup_group.provider.get_target()
+            for source, cmd in zip(backup_group.sources,
+                                   backup_group.iter_opts_raw(self.mode, cmd_prefix)):
+                cost = None
+                if self.mode == 'backup':
+                    cost = get_tree_size(source.source_path,
+                                         source.filters.is_excluded)
+                yield {'group': group,
+                       'source': source.source_path,
+                       'action': self.mode,
+                       'argv': cmd,
+                       'env': env_refs,
+                       'host': host,
+                       'cost': cost}
+
+    def get_cmd_prefix(self):
+        """Get the command and action the options are appended to.
+
+        :return: The Duplicity command, followed by 'full', if
+                 a full backup is forced.
+        :rtype: list
+        """
+        if self.is_full_backup and self.mode == 'backup':
+            return BackupRunner.command + ['full']
+        return list(BackupRunner.command)
+
     def run_cmds(self, group_names=None):
         """Execute the Duplicity commands.
 
+        Groups are run one after another, or up to self.jobs at
+        the same time, the ones estimated to take the longest first.
+        Groups which would miss the deadline of the configuration are
+        deferred to the next run, see :meth:`_get_group_order`.
+        When running in parallel, the output of each group is buffered
+        and printed in one piece once the group is done.
+        A summary of the group results is printed at the end. If any of
+        the commands failed, the process exits with their return code,
+        or 1 if the failed commands returned different codes.
+
         :param group_names: The group names to execute.
         :type group_names: list
+        :return: The results of the groups.
+        :rtype: list of :class:`GroupResult`
         """
-        commands = self.get_cmds_raw(group_names)
-        for group in sorted(commands):
-            print('Running backups for group: {}'.format(group))
-            print('==\n==')
+        with self.tracer.span('get_cmds_raw'):
+            commands = self.get_cmds_raw(group_names)
+        sources = {group: self.config.groups[group].sources for group in commands}
+        return self._run_all(commands, sources)
+
+    def run_plan(self, records):
+        """Execute the commands of an execution plan.
+
+        The commands are run as in :meth:`run_cmds`, with the
+        environment of their group in the configuration.
+
+        :param records: The plan records, see :meth:`iter_plan`.
+        :type records: list
+        :raises ValueError: if a record doesn't match the run mode
+                            or the configuration, including its command.
+        :return: The results of the groups.
+        :rtype: list of :class:`GroupResult`
+        """
+        # A plan may force full backups or not, whatever the options.
+        prefixes = [list(BackupRunner.command)]
+        if self.mode == 'backup':
+            prefixes.append(BackupRunner.command + ['full'])
+        # The commands the configuration allows by group and source.
+        allowed = {}
+        commands = {}
+        sources = {}
+        for record in records:
+            group = record['group']
+            if record['action'] != self.mode:
+                raise ValueError('The plan has {} and {} commands mixed, '
+                                 'run them separately.'.format(self.mode,
+                                                               record['action']))
+            if group not in self.config.groups:
+                raise ValueError('No group {} in the configuration!'.format(group))
+            group_sources = {source.source_path: source
+                             for source in self.config.groups[group].sources}
+            if record['source'] not in group_sources:
+                raise ValueError('No source {} in group {} of the '
+                                 'configuration!'.format(record['source'], group))
+            # The secrets of the group are passed to the command, so
+            # only the commands of the configuration are run.
+            if group not in allowed:
+                backup_group = self.config.groups[group]
+                allowed[group] = {}
+                for prefix in prefixes:
+                    for source, cmd in zip(backup_group.sources,
+                                           backup_group.iter_opts_raw(self.mode,
+                                                                      prefix)):
+                        allowed[group].setdefault(source.source_path, []).append(cmd)
+            argv = record['argv']
+            if argv not in allowed[group][record['source']]:
+                raise ValueError("The plan command of source {} in group {} "
+                                 "doesn't match the configuration."
+                                 .format(record['source'], group))
+            commands.setdefault(group, []).append(list(argv))
+            sources.setdefault(group, []).append(group_sources[record['source']])
+        return self._run_all(commands, sources)
+
+    def _run_all(self, commands, sources):
+        """Run the commands of the groups and report the results.
+
+        :param commands: The command argument lists by group.
+        :type commands: dict
+        :param sources: The sources of the commands by group.
+        :type sources: dict
+        :return: The results of the groups.
+        :rtype: list of :class:`GroupResult`
+        """
+        # Read the keyring secrets of the groups to run in bulk.
+        with self.tracer.span('resolve_secrets'):
+            self.config.resolve_secrets(list(commands))
+        if self.journal:
+            self.journal.begin()
+        time_left = self.config.get_time_left(datetime.datetime.now())
+        if time_left is not None:
+            self._deadline_at = time.monotonic() + time_left
+        if self._needs_estimates(commands, time_left):
+            with self.tracer.span('estimate_durations'):
+                self._estimates = self._get_estimates(commands, sources)
+        groups, deferred, predicted = self._get_group_order(commands, time_left)
+        start = time.monotonic()
+        try:
+            with self.tracer.span('run_groups'):
+                results = asyncio.run(self._run_groups(commands, sources, groups))
+        finally:
+            # Keep the history of the commands run, even if interrupted.
+            with self.tracer.span('save_history'):
+                self._save_history()
+        for group in deferred:
+            result = GroupResult(group)
+            result.deferred = True
+            results.append(result)
+        self._print_summary(results)
+        if predicted is not None:
+            print('\nPredicted makespan: {:.1f}s, actual: {:.1f}s'
+                  .format(predicted, time.monotonic() - start))
+        if self.deferred:
+            self.deferred.update([result.name for result in results
+                                  if result.returncode is not None],
+                                 [result.name for result in results
+                                  if result.deferred])
+        with self.tracer.span('write_metrics'):
+            self._write_metrics(results)
+        returncodes = {returncode for result in results
+                       for cmd, returncode in result.failures}
+        # The journal is only needed to resume a failed run.
+        if self.journal and not returncodes:
+            self.journal.remove()
+        if returncodes:
+            sys.exit(returncodes.pop() if len(returncodes) == 1 else 1)
+        return results
+
+    def _needs_estimates(self, commands, time_left):
+        """Check if the run depends on the duration estimates.
+
+        The estimates are only needed to order the groups or sources
+        run in parallel, and to keep to the deadline. Otherwise they
+        aren't worth reading the history and walking the new sources.
+
+        :param commands: The command argument lists by group.
+        :type commands: dict
+        :param time_left: The seconds left until the deadline, if any.
+        :type time_left: float
+        :rtype: bool
+        """
+        return (self.jobs > 1 or time_left is not None or
+                any(self.config.groups[group].parallel_sources > 1
+                    for group in commands))
+
+    def _get_estimates(self, commands, sources):
+        """Estimate the duration of the commands.
+
+        A command is estimated to take as long as its last successful
+        run recorded in the history. The backups of new sources are
+        estimated from the size of the source and the throughput of the
+        backups recorded, the other commands from the average estimate.
+
+        :param commands: The command argument lists by group.
+        :type commands: dict
+        :param sources: The sources of the commands by group.
+        :type sources: dict
+        :return: The estimated durations in seconds by group, in the
+                 order of the commands, empty if there is nothing to
+                 estimate from.
+        :rtype: dict
+        """
+        durations = {}
+        throughput = None
+        if self.history:
+            try:
+                durations = self.history.get_durations(self.mode)
+                throughput = self.history.get_throughput(self.mode)
+            except sqlite3.Error:
+                pass
+        estimates = {}
+        for group in commands:
+            group_estimates = estimates[group] = []
+            for source in sources[group][:len(commands[group])]:
+                duration = durations.get((group, source.source_path), None)
+                if duration is None and self.mode == 'backup':
+                    size = get_tree_size(source.source_path,
+                                         source.filters.is_excluded)
+                    if size is not None:
+                        duration = size / (throughput or
+                                           BackupRunner.default_throughput)
+                group_estimates.append(duration)
+        known = [duration for group_estimates in estimates.values()
+                 for duration in group_estimates if duration is not None]
+        if not known:
+            return {}
+        average = sum(known) / len(known)
+        return {group: [average if duration is None else duration
+                        for duration in group_estimates]
+                for group, group_estimates in estimates.items()}
+
+    def _get_group_order(self, commands, time_left=None):
+        """Get the order to run the groups in and predict the makespan.
+
+        The critical groups are run first, then the groups deferred in
+        the last run, then the normal and the low priority groups. Within
+        these, the groups estimated to take the longest are started
+        first when several groups can run at the same time, otherwise
+        the groups are run in the order of their names.
+
+        The low priority groups predicted to finish after the deadline
+        are deferred to the next run, unless they were deferred in the
+        last run already, see :meth:`_can_defer`. The makespan predicted
+        doesn't account for the target limits, nor for the commands
+        skipped.
+
+        :param commands: The command argument lists by group.
+        :type commands: dict
+        :param time_left: The seconds left until the deadline, if any.
+        :type time_left: float
+        :return: The group names in the order to run them, the names of
+                 the groups deferred, and the predicted time to run the
+                 groups in seconds, or None if there are no estimates.
+        :rtype: tuple
+        """
+        for group in commands:
+            estimates = self._estimates.get(group, [])
+            parallel = self.config.groups[group].parallel_sources
+            if parallel > 1:
+                estimates = [estimates[i] for i in get_lpt_order(estimates)]
+            self._group_costs[group] = get_makespan(estimates, parallel)
+
+        def key(group):
+            cost = self._group_costs[group] if self.jobs > 1 else 0
+            return self._get_rank(group), -cost
+
+        groups = sorted(sorted(commands), key=key)
+        deferred = []
+        # The time each worker is predicted to be free.
+        finish_times = [0.0] * self.jobs
+        for group in groups:
+            finish_time = finish_times[0] + self._group_costs[group]
+            if (time_left is not None and self._estimates and
+                    self.config.groups[group].priority == 'low' and
+                    self._can_defer(group) and finish_time > time_left):
+                deferred.append(group)
+                continue
+            heapq.heapreplace(finish_times, finish_time)
+        groups = [group for group in groups if group not in deferred]
+        predicted = max(finish_times) if self._estimates else None
+        return groups, deferred, predicted
+
+    def _get_rank(self, group):
+        """Get the rank of a group in the run order, the lowest first.
+
+        :param group: The name of the group.
+        :type group: str
+        :rtype: int
+        """
+        priority = self.config.groups[group].priority
+        if priority == 'critical':
+            return 0
+        if self.deferred and group in self.deferred.groups:
+            return 1
+        return 1 + backup_config.BackupGroup.priorities.index(priority)
+
+    def _can_defer(self, group):
+        """Check if a group can be deferred to the next run.
+
+        Critical groups are never deferred, the others not in two runs
+        in a row, so that every group is run eventually.
+
+        :param group: The name of the group.
+        :type group: str
+        :rtype: bool
+        """
+        return (self.config.groups[group].priority != 'critical' and
+                not (self.deferred and group in self.deferred.groups))
+
+    def _is_late(self, group):
+        """Check if a group to defer would finish after the deadline.
+
+        :param group: The name of the group.
+        :type group: str
+        :rtype: bool
+        """
+        return (self._deadline_at is not None and self._can_defer(group) and
+                time.monotonic() + self._group_costs.get(group, 0.0) >
+                self._deadline_at)
+
+    def _save_history(self):
+        """Save the commands of the run to the history.
+
+        A history which can't be written is reported, but doesn't
+        fail the run.
+        """
+        if self.history is None:
+            return
+        try:
+            self.history.save()
+        except sqlite3.Error as e:
+            print('Unable to save the history to {}: {}'
+                  .format(self.history.file_path, e), file=sys.stderr)
+
+    def _write_metrics(self, results):
+        """Write the results to the metrics files of the configuration.
+
+        A metrics file which can't be written is reported, but doesn't
+        fail the run.
+
+        :param results: The results of the groups.
+        :type results: list of :class:`GroupResult`
+        """
+        writers = (('json', write_metrics_json),
+                    ('textfile', write_metrics_textfile))
+        for key, write in writers:
+            file_path = self.config.metrics.get(key, None)
+            if file_path is None:
+                continue
+            try:
+                write(file_path, results, self.mode)
+            except OSError as e:
+                print('Unable to write the metrics to {}: {}'.format(file_path, e),
+                      file=sys.stderr)
+
+    async def _run_groups(self, commands, sources, groups):
+        """Run up to self.jobs groups at the same time.
+
+        Groups are queued by their backup target, so that the target
+        limits are respected. Unless self.keep_going is set, no new group
+        is started after one of the groups failed, but the groups already
+        running are allowed to finish.
+
+        :param commands: The command argument lists by group.
+        :type commands: dict
+        :param sources: The sources of the commands by group.
+        :type sources: dict
+        :param groups: The group names in execution order.
+        :type groups: list
+        :return: The results of the groups.
+        :rtype: list
+        """
+        results = [GroupResult(group) for group in groups]
+        queue = [(self.config.groups[result.name].provider.get_target(), result)
+                 for result in results]
+
+        async def run(result):
+            # Don't start groups which would miss the deadline.
+            if self._is_late(result.name):
+                result.deferred = True
+                return
+            # Only a single group can write to the console directly.
+            out = sys.stdout if self.jobs == 1 else io.StringIO()
+            await self._run_group(commands, sources, result, out)
+            if out is not sys.stdout:
+                result.output = out.getvalue()
+                sys.stdout.write(result.output)
+                sys.stdout.flush()
+
+        def failed():
+            return not self.keep_going and any(result.returncode
+                                               for result in results)
+
+        await self.scheduler.run(queue, run, failed)
+        return results
+
+    async def _run_group(self, commands, sources, result, out):
+        """Run the commands of a group and record the result.
+
+        :param commands: The command argument lists by group.
+        :type commands: dict
+        :param sources: The sources of the commands by group.
+        :type sources: dict
+        :param result: The result object of the group to fill in.
+        :type result: :class:`GroupResult`
+        :param out: The stream to write the output to.
+        :type out: file object
+        """
+        start = time.monotonic()
+        print('Running backups for group: {}'.format(result.name), file=out)
+        print('==\n==', file=out)
+        # Each group is traced on a track of its own.
+        with self.tracer.span(result.name, {'commands': len(commands[result.name])},
+                              lane=result.name):
             # Process the commands for the given group.
-            self._run_group_cmds(commands, group)
+            returncodes = await self._run_group_cmds(commands, result.name, out,
+                                                     sources[result.name], result)
+        result.failures = [(cmd, returncode)
+                           for cmd, returncode in zip(commands[result.name], returncodes)
+                           if returncode]
+        result.returncode = result.failures[0][1] if result.failures else 0
+        result.elapsed = time.monotonic() - start
+
+    def _print_summary(self, results):
+        """Print the exit code and wall time of each group.
+
+        The groups are followed by the list of failed commands and the
+        list of the groups deferred to the next run, if any.
+
+        :param results: The results of the groups.
+        :type results: list
+        """
+        print('== Summary ==')
+        print('{:<30} {:<8} {:>9} {:>10}'.format('GROUP', 'STATUS',
+                                                 'EXIT CODE', 'WALL TIME'))
+        for result in results:
+            returncode = '-' if result.returncode is None else result.returncode
+            print('{:<30} {:<8} {:>9} {:>9.1f}s'.format(result.name,
+                                                       result.status,
+                                                       returncode,
+                                                       result.elapsed))
+        failures = [(result.name, cmd, returncode) for result in results
+                    for cmd, returncode in result.failures]
+        if failures:
+            print('\nFailed commands:')
+            for group, cmd, returncode in failures:
+                print('{} [{}]: {}'.format(group, returncode, ' '.join(cmd)))
+        deferred = [result.name for result in results if result.deferred]
+        if deferred:
+            print('\nDeferred to the next run, as these would have missed the '
+                  'deadline: {}'.format(', '.join(deferred)))
 
-    def _run_group_cmds(self, commands, group):
+    async def _run_group_cmds(self, commands, group, out=None, sources=None,
+                              result=None):
         """Execute the Duplicity commands for a group.
 
         For each command it prints the command to be run, then
-        executes it.
+        executes it. Unless self.keep_going is set, it stops at the
+        first command that fails.
+
+        If the group allows running several sources in parallel, the
+        output of each command is buffered and written to out in the
+        order of the sources, once all commands finished.
 
         :param commands: A list of command argument lists for the given group..
         :type commands: list
         :param group: The name of the group.
         :type group: str
+        :param out: The stream to write the output to, defaults to stdout.
+        :type out: file object
+        :param sources: The sources of the commands, defaults to the
+                        sources of the group.
+        :type sources: list
+        :param result: The result of the group, the results of the
+                       sources run are added to it.
+        :type result: :class:`GroupResult`
+        :return: The return codes of the commands, None for the
+                 commands that were not run.
+        :rtype: list
         """
-        for cmd in commands[group]:
-            print('Executing Duplicity command: {}'.format(' '.join(cmd)))
-            print('==\nDuplicity output follows:\n==\n')
-            # Call the function actually creating the process.
-            self._run_cmd(cmd, self.config.groups[group].get_env())
+        out = out or sys.stdout
+        backup_group = self.config.groups[group]
+        cmds = commands[group]
+        sources = sources or backup_group.sources
+        returncodes = [None] * len(cmds)
+        source_results = [SourceResult(group, source.source_path)
+                          for source in sources[:len(cmds)]]
+        if backup_group.parallel_sources == 1:
+            for i, cmd in enumerate(cmds):
+                returncodes[i] = await self._run_source_cmd(cmd, backup_group, out,
+                                                            sources[i],
+                                                            source_results[i])
+                if returncodes[i] != 0 and not self.keep_going:
+                    break
+        else:
+            outputs = [io.StringIO() for cmd in cmds]
+
+            async def run(i):
+                returncodes[i] = await self._run_source_cmd(cmds[i], backup_group,
+                                                            outputs[i],
+                                                            sources[i],
+                                                            source_results[i])
+
+            # The sources estimated to take the longest are started first.
+            order = range(len(cmds))
+            if group in self._estimates:
+                order = get_lpt_order(self._estimates[group])
+            scheduler = BackupScheduler(backup_group.parallel_sources)
+            await scheduler.run([(None, i) for i in order], run,
+                                lambda: not self.keep_going and any(returncodes))
+            for output in outputs:
+                out.write(output.getvalue())
+        if result is not None:
+            result.sources = [source_result for source_result in source_results
+                              if source_result.returncode is not None]
+        return returncodes
 
+    async def _run_source_cmd(self, cmd, backup_group, out, source=None,
+                              source_result=None):
+        """Print the command for a source of the group and execute it.
 
-    def _run_cmd(self, command, env):
+        A failed command is run again according to the retry
+        policy of the group. Commands completed in the resumed run
+        are skipped, as well as the backups of unchanged sources if
+        the group is configured so.
+
+        :param cmd: The command argument list.
+        :type cmd: list
+        :param backup_group: The group the command belongs to.
+        :type backup_group: :class:`backup_config.BackupGroup`
+        :param out: The stream to write the output to.
+        :type out: file object
+        :param source: The source the command belongs to.
+        :type source: :class:`backup_config.BackupSource`
+        :param source_result: The result of the source to fill in.
+        :type source_result: :class:`SourceResult`
+        :return: The return code of the last attempt.
+        :rtype: int
+        """
+        if source_result is None:
+            source_result = SourceResult(backup_group.name, None)
+        if self.journal and self.journal.is_completed(backup_group.name,
+                                                     backup_group.group_data, cmd):
+            print('Skipping Duplicity command completed in the resumed run: '
+                  '{}\n'.format(' '.join(cmd)), file=out)
+            source_result.skipped = True
+            source_result.returncode = 0
+            return 0
+        span_name = source.source_path if source else cmd[-1]
+        # Sources running concurrently are traced on tracks of their own.
+        lane = None
+        if backup_group.parallel_sources > 1:
+            lane = '{}: {}'.format(backup_group.name, span_name)
+        digest = None
+        if (self.index and source and backup_group.skip_unchanged and
+                self.mode == 'backup'):
+            # Walking the tree is blocking, keep it off the event loop.
+            with self.tracer.span('get_tree_digest', {'source': span_name}, lane):
+                digest = await asyncio.get_running_loop().run_in_executor(
+                    None, get_tree_digest, source.source_path,
+                    source.filters.is_excluded)
+            if (not self.force and not self.is_full_backup and
+                    self.index.is_unchanged(backup_group.name, source.source_path,
+                                            cmd, digest)):
+                print('Skipping Duplicity command, source {} is unchanged since '
+                      'its last backup: {}\n'.format(source.source_path, ' '.join(cmd)),
+                      file=out)
+                source_result.skipped = True
+                source_result.returncode = 0
+                return 0
+        timeout = backup_group.command_timeout or self.config.command_timeout
+        policy = backup_group.retry_policy
+        env = self._get_process_env(backup_group)
+        attempt = 1
+        start = time.monotonic()
+        while True:
+            print('Executing Duplicity command: {}'.format(' '.join(cmd)), file=out)
+            print('==\nDuplicity output follows:\n==\n', file=out)
+            stats = DuplicityStats()
+            span_args = {'group': backup_group.name, 'attempt': attempt}
+            with self.tracer.span(span_name, span_args, lane):
+                attempt_start = time.time()
+                # Call the function actually creating the process.
+                returncode = await self._run_cmd(cmd, env, out,
+                                                 backup_group.provider, timeout,
+                                                 stats)
+                if self.history:
+                    self.history.add(backup_group.name, source_result.source,
+                                     self.mode, cmd, attempt_start, time.time(),
+                                     returncode, stats.values)
+                span_args['returncode'] = returncode
+                source_result.returncode = returncode
+                source_result.stats = stats.values
+                source_result.elapsed = time.monotonic() - start
+                if returncode == 0 and self.journal:
+                    self.journal.mark_completed(backup_group.name,
+                                                backup_group.group_data, cmd)
+                if returncode == 0 and digest is not None:
+                    self.index.update(backup_group.name, source.source_path,
+                                      cmd, digest)
+            if not policy.should_retry(attempt, returncode):
+                return returncode
+            delay = policy.get_delay(attempt)
+            attempt += 1
+            print('Retrying in {:.1f} seconds (attempt {} of {}).\n'
+                  .format(delay, attempt, policy.max_attempts), file=out)
+            await asyncio.sleep(delay)
+
+    def _get_process_env(self, backup_group):
+        """Get the complete environment of the processes of a group.
+
+        It is built once for each group and shared by the commands of
+        the group. With an env_allowlist configured, only the variables
+        listed are passed on from the environment of dupcomp, otherwise
+        all of them.
+
+        :param backup_group: The group to get the environment for.
+        :type backup_group: :class:`backup_config.BackupGroup`
+        :return: The environment variables.
+        :rtype: dict
+        """
+        env = self._process_envs.get(backup_group.name, None)
+        if env is None:
+            allowlist = backup_group.env_allowlist
+            if allowlist is None:
+                allowlist = self.config.env_allowlist
+            if allowlist is None:
+                env = dict(os.environ)
+            else:
+                env = {name: os.environ[name] for name in allowlist
+                       if name in os.environ}
+            env.update(backup_group.get_env())
+            self._process_envs[backup_group.name] = env
+        return env
+
+    def _get_executable(self, name):
+        """Get the path of an executable on the PATH of dupcomp.
+
+        The processes are started with the absolute path of the
+        executable, so that it is found even if the env_allowlist
+        doesn't pass the PATH on to them.
+
+        :param name: The name of the executable.
+        :type name: str
+        :return: The path of the executable, or the name if it is not
+                 found on the PATH.
+        :rtype: str
+        """
+        path = self._executables.get(name, None)
+        if path is None:
+            path = self._executables[name] = shutil.which(name) or name
+        return path
+
+    async def _run_cmd(self, command, env, out=None, provider=None, timeout=None,
+                       stats=None):
         """Execute the duplicty command.
 
         This does the actual work to run the duplicity process.
@@ -119,27 +942,38 @@ class BackupRunner:
 
         :param command: The command argument list.
         :type command: list
+        :param env: The complete environment of the command.
+        :type env: dict
+        :param out: The stream to write the output to, defaults to stdout.
+        :type out: file object
+        :param provider: The provider of the group the command belongs to.
+        :type provider: :class:`backup_config.BackupProvider`
+        :param timeout: Seconds after which the command is killed.
+        :type timeout: int, float
+        :param stats: The parser of the Duplicity statistics, fed with
+                      the output as it is read.
+        :type stats: :class:`backup_metrics.DuplicityStats`
+        :return: The return code of the Duplicity process, or
+                 start_error_returncode if it couldn't be started.
+        :rtype: int
         """
-        env_complete = dict(os.environ)
-        env_complete.update(env)
-        proc = subprocess.Popen(command,
-                                env=env_complete,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT,
-                                universal_newlines=True)
-        while True:
-            try:
-                print(proc.stdout.readline(), end='')
-            except Exception:
-                proc.kill()
-                break
-            if proc.poll() is not None:
-                print(proc.stdout.read())
-                print('== End of Duplicity output ==')
-                if proc.returncode == 0:
-                    print('Duplicity returned NORMALLY.\n')
-                else:
-                    print('Duplicity returned with ERROR CODE {}'.format(proc.returncode))
-                    sys.exit(proc.returncode)
-                break
-            time.sleep(1)
+        out = out or sys.stdout
+        command = [self._get_executable(command[0])] + command[1:]
+        try:
+            returncode = await self.engine.run_cmd(command, env, out,
+                                                   provider, timeout,
+                                                   stats.feed if stats else None)
+        except asyncio.TimeoutError:
+            print('== End of Duplicity output ==', file=out)
+            print('Duplicity TIMED OUT after {} seconds.'.format(timeout), file=out)
+            return BackupRunner.timeout_returncode
+        except OSError as e:
+            print('Duplicity could NOT be started: {}'.format(e), file=out)
+            return BackupRunner.start_error_returncode
+        print('== End of Duplicity output ==', file=out)
+        if returncode == 0:
+            print('Duplicity returned NORMALLY.\n', file=out)
+        else:
+            print('Duplicity returned with ERROR CODE {}'.format(returncode),
+                  file=out)
+        return returncode
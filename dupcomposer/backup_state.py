@@ -0,0 +1,498 @@
+"""Persist the state of the runs between invocations.
+
+Classes:
+
+BackupJournal: Record the commands completed in a run, to resume it.
+BackupSourceIndex: Record the digests of the sources backed up.
+BackupConfigDigests: Record the configuration digests of the groups run.
+BackupDeferredGroups: Record the groups deferred to the next run.
+
+Functions:
+
+get_state_path: Get the path of a state file kept next to the config.
+get_cache_path: Get the path of a file in the user's cache directory.
+is_private_file: Check if an open file can only have been written by the user.
+write_file_atomic: Write bytes to a file in an atomic way.
+write_json_atomic: Write data to a JSON file in an atomic way.
+hash_data: Get a stable hash of JSON serializable data.
+get_tree_digest: Get a digest of the metadata of a directory tree.
+get_tree_size: Get the total size of the files in a directory tree.
+"""
+import copy
+import hashlib
+import json
+import os
+import stat
+
+
+def get_state_path(config_file, suffix):
+    """Get the path of a state file kept next to the config.
+
+    :param config_file: The path of the configuration file.
+    :type config_file: str
+    :param suffix: The suffix identifying the type of the state file.
+    :type suffix: str
+    :rtype: str
+    """
+    return '.'.join([config_file, suffix])
+
+
+def get_cache_path(file_name):
+    """Get the path of a file in the user's cache directory.
+
+    The cache directory is $XDG_CACHE_HOME/dupcomposer, or
+    ~/.cache/dupcomposer if XDG_CACHE_HOME is not set. It is created
+    if it doesn't exist.
+
+    :param file_name: The name of the cache file.
+    :type file_name: str
+    :rtype: str
+    """
+    cache_home = (os.environ.get('XDG_CACHE_HOME', None) or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    cache_dir = os.path.join(cache_home, 'dupcomposer')
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, file_name)
+
+
+def is_private_file(file_obj):
+    """Check if an open file can only have been written by the user.
+
+    Cached data is only trusted from such files, as another user could
+    otherwise make dupcomp skip checks or load a crafted configuration.
+
+    :param file_obj: The open file.
+    :type file_obj: file object
+    :return: True if the file is owned by the effective user and not
+             writable by the group or others.
+    :rtype: bool
+    """
+    st = os.fstat(file_obj.fileno())
+    return st.st_uid == os.geteuid() and not st.st_mode & 0o022
+
+
+def write_file_atomic(file_path, content, mode=None):
+    """Write bytes to a file in an atomic way.
+
+    The content is written to a temporary file first, which then
+    replaces the original file, so that it is never left half written.
+
+    :param file_path: The path of the file.
+    :type file_path: str
+    :param content: The content of the file.
+    :type content: bytes
+    :param mode: The permissions of the file, eg. 0o600, by default
+                 the ones of a new file.
+    :type mode: int
+    """
+    temp_path = '.'.join([file_path, 'tmp'])
+    with open(temp_path, 'wb') as f:
+        if mode is not None:
+            os.fchmod(f.fileno(), mode)
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, file_path)
+
+
+def write_json_atomic(file_path, data, mode=None):
+    """Write data to a JSON file in an atomic way.
+
+    :param file_path: The path of the file.
+    :type file_path: str
+    :param data: JSON serializable data.
+    :param mode: The permissions of the file, see :func:`write_file_atomic`.
+    :type mode: int
+    """
+    write_file_atomic(file_path,
+                      json.dumps(data, sort_keys=True).encode('utf-8'), mode)
+
+
+def hash_data(data):
+    """Get a stable hash of JSON serializable data.
+
+    :param data: The data to hash, eg. the config of a group or
+                 a command argument list.
+    :return: The hex digest of the data.
+    :rtype: str
+    """
+    serialized = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def get_tree_digest(path, is_excluded=None):
+    """Get a digest of the metadata of a directory tree.
+
+    The digest covers the relative path, type, modification time, size
+    and inode of every entry in the tree, so it changes whenever a file
+    is added, removed, modified or replaced. File contents are not read.
+    Symbolic links are not followed.
+
+    :param path: The root of the tree, a directory or a single file.
+    :type path: str
+    :param is_excluded: A function telling if an absolute path is
+                        excluded from the tree.
+    :type is_excluded: callable
+    :return: The hex digest, or None if the path doesn't exist or
+             can't be read.
+    :rtype: str
+    """
+    root = os.path.abspath(path)
+    try:
+        st = os.lstat(root)
+    except OSError:
+        return None
+    digest = hashlib.sha256()
+    digest.update('{}:{}:{}:{}\n'.format(st.st_mode, st.st_mtime_ns,
+                                         st.st_size, st.st_ino).encode())
+    dirs = [root] if stat.S_ISDIR(st.st_mode) else []
+    while dirs:
+        current = dirs.pop()
+        try:
+            # Sort the entries, as the order of scandir() is arbitrary.
+            entries = sorted(os.scandir(current), key=lambda e: e.name)
+        except OSError:
+            # We can't tell if an unreadable directory has changed.
+            return None
+        for entry in entries:
+            if is_excluded and is_excluded(entry.path):
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # Removed since the directory was listed.
+                continue
+            except OSError:
+                return None
+            digest.update(os.fsencode(os.path.relpath(entry.path, root)))
+            digest.update('\0{}:{}:{}:{}\n'.format(st.st_mode, st.st_mtime_ns,
+                                                   st.st_size, st.st_ino).encode())
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(entry.path)
+    return digest.hexdigest()
+
+
+def get_tree_size(path, is_excluded=None):
+    """Get the total size of the files in a directory tree.
+
+    Unreadable directories are skipped, and the files removed while the
+    tree is walked count as empty. Symbolic links are not followed.
+
+    :param path: The root of the tree, a directory or a single file.
+    :type path: str
+    :param is_excluded: A function telling if an absolute path is
+                        excluded from the tree.
+    :type is_excluded: callable
+    :return: The size in bytes, or None if the path doesn't exist or
+             its metadata can't be read.
+    :rtype: int
+    """
+    root = os.path.abspath(path)
+    try:
+        st = os.lstat(root)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size
+    size = 0
+    dirs = [root]
+    while dirs:
+        current = dirs.pop()
+        try:
+            entries = list(os.scandir(current))
+        except OSError:
+            continue
+        for entry in entries:
+            if is_excluded and is_excluded(entry.path):
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                return None
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(entry.path)
+            else:
+                size += st.st_size
+    return size
+
+
+class BackupJournal:
+    """Record the commands completed in a run, to resume it.
+
+    The journal keeps the hashes of the completed commands by group,
+    along with the hash of the group configuration they were generated
+    from. The journal is removed when a run completes without errors,
+    so an existing journal means, that the last run was interrupted
+    or failed.
+
+    The first line of the journal file holds the commands we are
+    resuming from, each command completed in the run is appended as a
+    line of its own, so recording a command doesn't rewrite the file.
+
+    :param file_path: The path of the journal file.
+    :type file_path: str
+    :param mode: The run mode, 'backup' or 'restore'.
+    :type mode: str
+    :param resume: Load the journal of the last run to skip the commands
+                   completed in that run?
+    :type resume: bool
+    """
+    def __init__(self, file_path, mode, resume=False):
+        self.file_path = file_path
+        self.mode = mode
+        # The config hash and the set of command hashes by group.
+        self.completed = {}
+        # Commands completed in the last run, skipped when resuming.
+        self.resumable = {}
+        # The config hashes by group, the config doesn't change in a run.
+        self._config_hashes = {}
+        if resume:
+            self._load()
+
+    def _load(self):
+        """Load the completed commands of the last run."""
+        try:
+            with open(self.file_path) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return
+        try:
+            data = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return
+        if data.get('mode') != self.mode:
+            return
+        for group, entry in data.get('completed', {}).items():
+            self.resumable[group] = {'config_hash': entry['config_hash'],
+                                     'commands': set(entry['commands'])}
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be cut short by an interruption.
+                break
+            self._add(self.resumable, record['group'], record['config_hash'],
+                      record['command'])
+        # Keep the state of the last run in case we get interrupted again.
+        self.completed = copy.deepcopy(self.resumable)
+
+    def begin(self):
+        """Start the journal of a new run.
+
+        It replaces the journal of the last run, keeping only the
+        commands we are resuming from.
+        """
+        completed = {group: {'config_hash': entry['config_hash'],
+                             'commands': sorted(entry['commands'])}
+                     for group, entry in self.completed.items()}
+        write_file_atomic(self.file_path,
+                          (json.dumps({'mode': self.mode, 'completed': completed},
+                                      sort_keys=True) + '\n').encode('utf-8'))
+
+    def _get_config_hash(self, group, group_data):
+        """Get the hash of a group configuration, computed once a run."""
+        config_hash = self._config_hashes.get(group, None)
+        if config_hash is None:
+            config_hash = self._config_hashes[group] = hash_data(group_data)
+        return config_hash
+
+    @staticmethod
+    def _add(completed, group, config_hash, cmd_hash):
+        """Add a command to the completed commands by group.
+
+        :return: True if the command wasn't recorded yet.
+        :rtype: bool
+        """
+        entry = completed.get(group, None)
+        if entry is None or entry['config_hash'] != config_hash:
+            entry = completed[group] = {'config_hash': config_hash,
+                                        'commands': set()}
+        if cmd_hash in entry['commands']:
+            return False
+        entry['commands'].add(cmd_hash)
+        return True
+
+    def is_completed(self, group, group_data, cmd):
+        """Check if the command was completed in the resumed run.
+
+        :param group: The name of the group.
+        :type group: str
+        :param group_data: The raw configuration of the group.
+        :type group_data: dict
+        :param cmd: The command argument list.
+        :type cmd: list
+        :rtype: bool
+        """
+        entry = self.resumable.get(group, None)
+        return (entry is not None and
+                entry['config_hash'] == self._get_config_hash(group, group_data) and
+                hash_data(cmd) in entry['commands'])
+
+    def mark_completed(self, group, group_data, cmd):
+        """Record a successfully completed command in the journal.
+
+        :param group: The name of the group.
+        :type group: str
+        :param group_data: The raw configuration of the group.
+        :type group_data: dict
+        :param cmd: The command argument list.
+        :type cmd: list
+        """
+        config_hash = self._get_config_hash(group, group_data)
+        cmd_hash = hash_data(cmd)
+        if self._add(self.completed, group, config_hash, cmd_hash):
+            with open(self.file_path, 'a') as f:
+                f.write(json.dumps({'group': group, 'config_hash': config_hash,
+                                    'command': cmd_hash}) + '\n')
+
+    def remove(self):
+        """Remove the journal after a run completed without errors."""
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+
+
+class BackupSourceIndex:
+    """Record the digests of the sources backed up.
+
+    The digest of each source's directory tree is stored after a
+    successful backup, along with the hash of the command used, so
+    that the backup of unchanged sources can be skipped.
+
+    :param file_path: The path of the index file.
+    :type file_path: str
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        try:
+            with open(self.file_path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def is_unchanged(self, group, source_path, cmd, digest):
+        """Check if the source is unchanged since its last backup.
+
+        :param group: The name of the group.
+        :type group: str
+        :param source_path: The path of the source.
+        :type source_path: str
+        :param cmd: The command argument list of the backup.
+        :type cmd: list
+        :param digest: The current digest of the source tree.
+        :type digest: str
+        :rtype: bool
+        """
+        entry = self.entries.get(group, {}).get(source_path, None)
+        return (digest is not None and entry is not None and
+                entry['digest'] == digest and
+                entry['command'] == hash_data(cmd))
+
+    def update(self, group, source_path, cmd, digest):
+        """Record the digest of a source after a successful backup.
+
+        :param group: The name of the group.
+        :type group: str
+        :param source_path: The path of the source.
+        :type source_path: str
+        :param cmd: The command argument list of the backup.
+        :type cmd: list
+        :param digest: The digest of the source tree backed up.
+        :type digest: str
+        """
+        self.entries.setdefault(group, {})[source_path] = \
+            {'digest': digest, 'command': hash_data(cmd)}
+        write_json_atomic(self.file_path, self.entries)
+
+
+class BackupConfigDigests:
+    """Record the configuration digests of the groups run.
+
+    The hash of each group's configuration is stored after a successful
+    run of the group, so that the configuration change safeguard can
+    detect the groups changed since their last run.
+
+    :param file_path: The path of the digest file.
+    :type file_path: str
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        try:
+            with open(self.file_path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def add_groups(self, groups_data):
+        """Record the digests of the groups without saving them.
+
+        :param groups_data: The raw configuration of the groups by name.
+        :type groups_data: dict
+        """
+        for group_name, group_data in groups_data.items():
+            self.entries[group_name] = hash_data(group_data)
+
+    def get_changed(self, groups_data):
+        """Get the groups changed since their last recorded run.
+
+        Groups without a recorded digest are not considered changed.
+
+        :param groups_data: The raw configuration of the groups by name.
+        :type groups_data: dict
+        :return: The names of the changed groups in alphabetical order.
+        :rtype: list
+        """
+        return [group_name for group_name in sorted(groups_data)
+                if group_name in self.entries and
+                self.entries[group_name] != hash_data(groups_data[group_name])]
+
+    def update(self, groups_data):
+        """Record the digests of the groups run and save them.
+
+        :param groups_data: The raw configuration of the groups by name.
+        :type groups_data: dict
+        """
+        self.add_groups(groups_data)
+        write_json_atomic(self.file_path, self.entries)
+
+
+class BackupDeferredGroups:
+    """Record the groups deferred to the next run.
+
+    Groups not started because they would have missed the deadline
+    are recorded, so that they are run first the next time.
+
+    :param file_path: The path of the state file.
+    :type file_path: str
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        try:
+            with open(self.file_path) as f:
+                self.groups = json.load(f)
+        except FileNotFoundError:
+            self.groups = []
+
+    def update(self, run_groups, deferred_groups):
+        """Record the groups deferred in a run and save them.
+
+        The groups deferred earlier stay deferred, until they are run.
+        The file is removed when no groups are deferred.
+
+        :param run_groups: The names of the groups run.
+        :type run_groups: list
+        :param deferred_groups: The names of the groups deferred.
+        :type deferred_groups: list
+        """
+        self.groups = sorted((set(self.groups) - set(run_groups)) |
+                             set(deferred_groups))
+        if self.groups:
+            write_json_atomic(self.file_path, self.groups)
+        else:
+            try:
+                os.remove(self.file_path)
+            except FileNotFoundError:
+                pass
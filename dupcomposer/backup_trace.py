@@ -0,0 +1,106 @@
+"""Record where the time of a run is spent as a Chrome trace.
+
+Classes:
+
+BackupTracer: Record timing spans and write them as trace events.
+NullTracer: A tracer recording nothing, used when tracing is off.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import time
+from .backup_state import write_file_atomic
+
+
+class BackupTracer:
+    """Record timing spans and write them as trace events.
+
+    The spans are written in the Chrome trace event format, which can
+    be opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing.
+    Spans started in a lane are shown on a track of their own, nested
+    spans are shown in the lane of the enclosing span, so groups and
+    sources running concurrently don't overlap on the same track.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self._start = time.perf_counter_ns()
+        # Track ids by lane name, the main lane is 0.
+        self._lanes = {None: 0}
+        self._lane = contextvars.ContextVar('lane', default=0)
+        self._add_lane_name(0, 'dupcomp')
+
+    def _add_lane_name(self, tid, name):
+        """Add the metadata event naming the track of a lane."""
+        self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                            'tid': tid, 'args': {'name': name}})
+
+    def _get_lane(self, lane):
+        """Get the track id of a lane, allocating one for a new lane."""
+        tid = self._lanes.get(lane, None)
+        if tid is None:
+            tid = self._lanes[lane] = len(self._lanes)
+            self._add_lane_name(tid, lane)
+        return tid
+
+    @contextlib.contextmanager
+    def span(self, name, args=None, lane=None):
+        """Record the time spent in the with block as a span.
+
+        :param name: The name of the span.
+        :type name: str
+        :param args: Details shown with the span.
+        :type args: dict
+        :param lane: Start the span on the track of this lane, instead
+                     of the track of the enclosing span.
+        :type lane: str
+        """
+        token = None
+        if lane is None:
+            tid = self._lane.get()
+        else:
+            tid = self._get_lane(lane)
+            token = self._lane.set(tid)
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            if token is not None:
+                self._lane.reset(token)
+            event = {'name': name, 'cat': 'dupcomp', 'ph': 'X',
+                     'ts': (start - self._start) / 1000,
+                     'dur': (end - start) / 1000,
+                     'pid': self.pid, 'tid': tid}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+
+    def save(self, file_path):
+        """Write the spans recorded to a trace file.
+
+        :param file_path: The path of the trace file.
+        :type file_path: str
+        """
+        data = {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+        write_file_atomic(file_path, json.dumps(data).encode('utf-8'))
+
+
+class NullTracer:
+    """A tracer recording nothing, used when tracing is off.
+
+    The span is a shared no-op context manager, so the phases traced
+    cost no more than a method call when tracing is off.
+    """
+    enabled = False
+    _null_span = contextlib.nullcontext()
+
+    def span(self, name, args=None, lane=None):
+        """Return a context manager doing nothing."""
+        return NullTracer._null_span
+
+
+NULL_TRACER = NullTracer()
@@ -20,6 +20,7 @@ setup(
                   'Programming Language :: Python :: 3.7',
                   'Topic :: System :: Archiving :: Backup'],
     packages=['dupcomposer'],
+    python_requires='>=3.7',
     include_package_data=False,
     install_requires=['keyring>=19.2.0', 'SecretStorage>=3.1.1',
                       'PyYAML>=5.1'],
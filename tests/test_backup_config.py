@@ -1,4 +1,6 @@
 import unittest
+import datetime
+import os
 from unittest.mock import patch, MagicMock
 from dupcomposer.backup_runner import read_config
 from dupcomposer import backup_keyring
@@ -6,7 +8,8 @@ from dupcomposer.backup_config import (BackupConfig, BackupGroup,
                                        BackupEncryption, BackupProvider,
                                        BackupProviderLocal, BackupProviderS3,
                                        BackupProviderSSH, BackupSource,
-                                       BackupFilePrefixes, BackupPathFilter)
+                                       BackupFilePrefixes, BackupPathFilter,
+                                       BackupRetryPolicy)
 
 class TestBackupConfig(unittest.TestCase):
 
@@ -32,6 +35,151 @@ class TestBackupConfig(unittest.TestCase):
         for group in self.backup_config.groups.values():
             self.assertIsInstance(group, BackupGroup)
 
+    def test_max_parallel_groups(self):
+        self.assertEqual(self.backup_config.max_parallel_groups, 1)
+        config_data = dict(self.config_data, max_parallel_groups=4)
+        self.assertEqual(BackupConfig(config_data).max_parallel_groups, 4)
+
+    def test_invalid_max_parallel_groups(self):
+        for value in (0, -2, 'many', 1.5):
+            config_data = dict(self.config_data, max_parallel_groups=value)
+            self.assertRaisesRegex(ValueError,
+                                   'max_parallel_groups must be a positive integer',
+                                   BackupConfig,
+                                   config_data)
+
+    def test_provider_limits(self):
+        self.assertEqual(self.backup_config.provider_limits, {})
+        config_data = dict(self.config_data, provider_limits={'s3': 2, 'ssh': 1})
+        self.assertEqual(BackupConfig(config_data).provider_limits,
+                         {'s3': 2, 'ssh': 1})
+
+    def test_invalid_provider_limits(self):
+        config_data = dict(self.config_data, provider_limits={'ftp': 2})
+        self.assertRaisesRegex(ValueError,
+                               'Unknown provider type in provider_limits: ftp',
+                               BackupConfig,
+                               config_data)
+        config_data = dict(self.config_data, provider_limits={'s3': 0})
+        self.assertRaisesRegex(ValueError,
+                               'Provider limit for s3 must be a positive integer',
+                               BackupConfig,
+                               config_data)
+
+    def test_target_limits(self):
+        self.assertEqual(self.backup_config.target_limits, {})
+        self.assertIsNone(self.backup_config.max_parallel_per_target)
+        config_data = dict(self.config_data, max_parallel_per_target=2,
+                           target_limits={'host.example.com': 1})
+        config = BackupConfig(config_data)
+        self.assertEqual(config.target_limits, {'host.example.com': 1})
+        self.assertEqual(config.max_parallel_per_target, 2)
+
+    def test_invalid_target_limits(self):
+        config_data = dict(self.config_data, target_limits={'host.example.com': 'one'})
+        self.assertRaisesRegex(ValueError,
+                               'Target limit for host.example.com must be a positive integer',
+                               BackupConfig,
+                               config_data)
+        config_data = dict(self.config_data, max_parallel_per_target=0)
+        self.assertRaisesRegex(ValueError,
+                               'max_parallel_per_target must be a positive integer',
+                               BackupConfig,
+                               config_data)
+
+    def test_command_timeout(self):
+        self.assertIsNone(self.backup_config.command_timeout)
+        config_data = dict(self.config_data, command_timeout=3600)
+        self.assertEqual(BackupConfig(config_data).command_timeout, 3600)
+        config_data = dict(self.config_data, command_timeout=-1)
+        self.assertRaisesRegex(ValueError,
+                               'command_timeout must be a positive number',
+                               BackupConfig,
+                               config_data)
+
+    def test_env_allowlist(self):
+        self.assertIsNone(self.backup_config.env_allowlist)
+        config_data = dict(self.config_data, env_allowlist=['PATH', 'HOME'])
+        self.assertEqual(BackupConfig(config_data).env_allowlist, ['PATH', 'HOME'])
+        for allowlist in ('PATH', ['PATH', 1]):
+            config_data = dict(self.config_data, env_allowlist=allowlist)
+            self.assertRaisesRegex(ValueError,
+                                   'env_allowlist must be a list',
+                                   BackupConfig,
+                                   config_data)
+
+    def test_deadline(self):
+        self.assertIsNone(self.backup_config.get_time_left(datetime.datetime.now()))
+        config_data = dict(self.config_data, deadline='06:00')
+        config = BackupConfig(config_data)
+        self.assertEqual(config.deadline, (6, 0))
+        self.assertEqual(config.get_time_left(datetime.datetime(2020, 1, 1, 5, 30)),
+                         1800)
+        # The deadline of the next day.
+        self.assertEqual(config.get_time_left(datetime.datetime(2020, 1, 1, 22, 0)),
+                         8 * 3600)
+        config_data['window'] = 600
+        self.assertEqual(BackupConfig(config_data).get_time_left(
+            datetime.datetime(2020, 1, 1, 22, 0)), 600)
+        for deadline in (360, '6', '24:00', '06:60'):
+            config_data = dict(self.config_data, deadline=deadline)
+            self.assertRaisesRegex(ValueError, 'deadline must be a time of day',
+                                   BackupConfig, config_data)
+        for window in (0, 'long', True):
+            config_data = dict(self.config_data, window=window)
+            self.assertRaisesRegex(ValueError, 'window must be a positive number',
+                                   BackupConfig, config_data)
+
+    def test_metrics(self):
+        self.assertEqual(self.backup_config.metrics, {})
+        config_data = dict(self.config_data,
+                           metrics={'json': '/tmp/metrics.json',
+                                    'textfile': '~/dupcomposer.prom'})
+        self.assertEqual(BackupConfig(config_data).metrics,
+                         {'json': '/tmp/metrics.json',
+                          'textfile': os.path.expanduser('~/dupcomposer.prom')})
+        for metrics, message in (('/tmp/metrics.json', 'metrics must be a mapping'),
+                                 ({'csv': '/tmp/metrics.csv'}, 'Unknown metrics file'),
+                                 ({'json': ['/tmp']}, 'must be a string')):
+            config_data = dict(self.config_data, metrics=metrics)
+            self.assertRaisesRegex(ValueError, message, BackupConfig, config_data)
+
+    @patch('dupcomposer.backup_keyring.BackupKeyring')
+    def test_resolve_secrets(self, mock_keyring):
+        group = {'encryption': {'enabled': True, 'gpg_key': 'xxx',
+                                'gpg_passphrase': ['gpg', 'backup']},
+                 'backup_provider': {'url': 's3://s3.example.com/bucket',
+                                     'aws_access_key_id': 'xxx',
+                                     'aws_secret_access_key': ['aws', 'backup']},
+                 'volume_size': 50,
+                 'sources': {'/etc': {'backup_path': 'etc'}}}
+        config_data = {'backup_groups': {'one': group, 'two': dict(group),
+                                         'plain': self.config_data['backup_groups']
+                                                                  ['my_s3_backups']}}
+        config = BackupConfig(config_data)
+        # Nothing is read from the keyring until it's needed.
+        mock_keyring.assert_not_called()
+        config.resolve_secrets()
+        # The secrets shared by the groups are requested once, in bulk.
+        mock_keyring.return_value.get_secrets.assert_called_once_with(
+            [['aws', 'backup'], ['gpg', 'backup']])
+        mock_keyring.return_value.get_secrets.reset_mock()
+        config.resolve_secrets(['plain'])
+        mock_keyring.return_value.get_secrets.assert_not_called()
+
+    def test_groups_built_on_demand(self):
+        config_data = {'backup_groups': {'valid': self.config_data['backup_groups']
+                                                                  ['my_local_backups'],
+                                         'invalid': {'encryption': {'enabled': 'maybe'}}}}
+        config = BackupConfig(config_data)
+        self.assertEqual(list(config.groups), ['valid', 'invalid'])
+        self.assertIn('invalid', config.groups)
+        self.assertNotIn('missing', config.groups)
+        self.assertIsInstance(config.groups['valid'], BackupGroup)
+        self.assertIs(config.groups['valid'], config.groups['valid'])
+        # Groups are only checked when they are built.
+        self.assertRaises(KeyError, config.groups.__getitem__, 'invalid')
+
 class TestBackupGroup(unittest.TestCase):
 
     @classmethod
@@ -83,6 +231,45 @@ class TestBackupGroup(unittest.TestCase):
                          .group_data['backup_provider']['url'],
                          'scp://myscpuser@host.example.com/')
 
+    def test_parallel_sources(self):
+        self.assertEqual(self.backup_groups['my_local_backups'].parallel_sources, 1)
+        group_data = dict(self.config_data['backup_groups']['my_local_backups'],
+                          parallel_sources=4)
+        self.assertEqual(BackupGroup(group_data, 'parallel').parallel_sources, 4)
+        group_data['parallel_sources'] = 0
+        self.assertRaisesRegex(ValueError,
+                               'parallel_sources must be a positive integer',
+                               BackupGroup,
+                               group_data, 'parallel')
+
+    def test_env_allowlist(self):
+        self.assertIsNone(self.backup_groups['my_local_backups'].env_allowlist)
+        group_data = dict(self.config_data['backup_groups']['my_local_backups'],
+                          env_allowlist=['PATH'])
+        self.assertEqual(BackupGroup(group_data, 'minimal').env_allowlist, ['PATH'])
+
+    def test_priority(self):
+        self.assertEqual(self.backup_groups['my_local_backups'].priority, 'normal')
+        group_data = dict(self.config_data['backup_groups']['my_local_backups'],
+                          priority='critical')
+        self.assertEqual(BackupGroup(group_data, 'critical').priority, 'critical')
+        group_data['priority'] = 'urgent'
+        self.assertRaisesRegex(ValueError,
+                               'priority must be one of critical, normal, low',
+                               BackupGroup,
+                               group_data, 'urgent')
+
+    def test_skip_unchanged(self):
+        self.assertIs(self.backup_groups['my_local_backups'].skip_unchanged, False)
+        group_data = dict(self.config_data['backup_groups']['my_local_backups'],
+                          skip_unchanged=True)
+        self.assertIs(BackupGroup(group_data, 'skip').skip_unchanged, True)
+        group_data['skip_unchanged'] = 'sometimes'
+        self.assertRaisesRegex(ValueError,
+                               'skip_unchanged must be yes or no',
+                               BackupGroup,
+                               group_data, 'skip')
+
     def test_invalid_group_data(self):
         self.assertRaisesRegex(KeyError,
                                'Invalid group configuration data, key "encryption" is missing.',
@@ -170,6 +357,21 @@ class TestBackupGroup(unittest.TestCase):
                            'home/fun',
                            'scp://myscpuser@host.example.com/home/fun']])
 
+    def test_get_opts_raw_prefix(self):
+        opts = self.backup_groups['my_local_backups'].get_opts_raw('backup',
+                                                                  ['duplicity', 'full'])
+        self.assertEqual(opts,
+                         [['duplicity', 'full', '--no-encryption', '--volsize', '200',
+                           '/var/www/html', 'file:///root/backups/var/www/html'],
+                          ['duplicity', 'full', '--no-encryption', '--volsize', '200',
+                           'home/tommy', 'file://backups/home/tommy']])
+        # Each command is a separate list.
+        self.assertIsNot(opts[0], opts[1])
+
+    def test_get_group_opts(self):
+        self.assertEqual(self.backup_groups['my_local_backups'].get_group_opts('backup'),
+                         ['--no-encryption', '--volsize', '200'])
+
     def test_get_opts_raw_restore(self):
         self.assertEqual(self.backup_groups['my_s3_backups'].get_opts_raw('restore'),
                          [['--encrypt-key', 'xxxxxx', '--sign-key', 'xxxxxx',
@@ -247,6 +449,15 @@ class TestBackupGroup(unittest.TestCase):
         self.assertEqual(self.backup_groups['my_scp_backups'].get_env(),
                          {'FTP_PASSWORD': 'xxxxxx'}) 
 
+    def test_get_env_refs(self):
+        self.assertEqual(self.backup_groups['my_local_backups'].get_env_refs(), {})
+        self.assertEqual(self.backup_groups['my_s3_backups'].get_env_refs(),
+                         {'AWS_ACCESS_KEY_ID': None, 'AWS_SECRET_ACCESS_KEY': None,
+                          'PASSPHRASE': None})
+        self.assertEqual(self.backup_groups['backup_with_keyring'].get_env_refs(),
+                         {'FTP_PASSWORD': {'keyring': {'service': 'service',
+                                                       'account': 'account'}}})
+
 class TestBackupEncryption(unittest.TestCase):
 
     @classmethod
@@ -272,10 +483,17 @@ class TestBackupEncryption(unittest.TestCase):
         backup_group.keyring.get_secret.return_value = 'mypassphrase'
         self.backup_enc_on_keyring = BackupEncryption(self.config_with_keyring,
                                                       backup_group)
-        self.assertEqual(list(backup_group.keyring.get_secret.call_args[0][0]),
-                         ['service', 'account'])
+        # The passphrase is read on first use.
+        backup_group.keyring.get_secret.assert_not_called()
         self.assertEqual(self.backup_enc_on_keyring.gpg_passphrase,
                          'mypassphrase')
+        self.assertEqual(self.backup_enc_on_keyring.get_env(),
+                         {'PASSPHRASE': 'mypassphrase'})
+        backup_group.keyring.get_secret.assert_called_once_with(['service', 'account'])
+        self.assertEqual(self.backup_enc_on_keyring.get_env_refs(),
+                         {'PASSPHRASE': {'keyring': {'service': 'service',
+                                                     'account': 'account'}}})
+        self.assertEqual(self.backup_encryption_off.get_env_refs(), {})
 
 
     def test_keyring_read_invalid(self):
@@ -396,6 +614,9 @@ class TestBackupProviderLocal(unittest.TestCase):
     def test_get_env(self):
         self.assertEqual(self.backup_local.get_env(), {})
 
+    def test_get_target(self):
+        self.assertIsNone(self.backup_local.get_target())
+
 class TestBackupProviderS3(unittest.TestCase):
 
     @classmethod
@@ -423,6 +644,11 @@ class TestBackupProviderS3(unittest.TestCase):
         self.assertEqual(self.backup_s3.get_env(), {'AWS_ACCESS_KEY_ID': 'xxxxxx',
                                                     'AWS_SECRET_ACCESS_KEY': 'xxxxxx'})
 
+    def test_get_target(self):
+        self.assertEqual(self.backup_s3.get_target(), 'my-backup-bucket')
+        self.assertEqual(self.backup_s3_boto3.get_target(),
+                         'my-backup-bucket.s3.sa-east-1.amazonaws.com')
+
 
     def test_get_env_from_keyring(self):
         backup_group = MagicMock()
@@ -431,6 +657,11 @@ class TestBackupProviderS3(unittest.TestCase):
                                           'aws_access_key_id': 'xxxxxx',
                                            'aws_secret_access_key': ['aws', 'account']},
                                           backup_group)
+        backup_group.keyring.get_secret.assert_not_called()
+        self.assertEqual(provider.get_env_refs(),
+                         {'AWS_ACCESS_KEY_ID': None,
+                          'AWS_SECRET_ACCESS_KEY': {'keyring': {'service': 'aws',
+                                                                'account': 'account'}}})
         self.assertEqual(provider.get_env(), {'AWS_ACCESS_KEY_ID': 'xxxxxx',
                                               'AWS_SECRET_ACCESS_KEY': 'mysecretkey'})
         backup_group.keyring.get_secret.assert_called_once_with(['aws', 'account'])
@@ -498,6 +729,14 @@ class TestBackupProviderSSH(unittest.TestCase):
         self.assertEqual(self.backup_scp_nopass.get_env(), {})
         self.assertEqual(self.backup_sftp.get_env(), {'FTP_PASSWORD': 'xxxxxx'})
 
+    def test_get_env_refs(self):
+        self.assertEqual(self.backup_scp.get_env_refs(), {'FTP_PASSWORD': None})
+        self.assertEqual(self.backup_scp_nopass.get_env_refs(), {})
+
+    def test_get_target(self):
+        self.assertEqual(self.backup_scp.get_target(), 'host.example.com')
+        self.assertEqual(self.backup_sftp.get_target(), 'host.dupexample.com')
+
 
     def test_get_env_from_keyring(self):
         backup_group = MagicMock()
@@ -505,6 +744,7 @@ class TestBackupProviderSSH(unittest.TestCase):
         provider = BackupProvider.factory({'url': 'scp://myscpuser@host.exp.com/test',
                                            'password': ['scpserver', 'myscpuser']},
                                           backup_group)
+        backup_group.keyring.get_secret.assert_not_called()
         self.assertEqual(provider.get_env(), {'FTP_PASSWORD': 'mykeyringpassword'})
         backup_group.keyring.get_secret.assert_called_once_with(['scpserver', 'myscpuser'])
 
@@ -766,3 +1006,65 @@ class TestBackupPathFilter(unittest.TestCase):
         filter = BackupPathFilter(None)
         self.assertEqual(filter.get_cmd(),
                          [])
+
+
+class TestBackupRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy_default = BackupRetryPolicy()
+        self.policy = BackupRetryPolicy({'max_attempts': 4,
+                                         'backoff_base': 5,
+                                         'backoff_max': 12,
+                                         'jitter': False,
+                                         'retryable_exit_codes': [23, 50]})
+
+    def test_no_retry_by_default(self):
+        self.assertEqual(self.policy_default.max_attempts, 1)
+        self.assertFalse(self.policy_default.should_retry(1, 50))
+
+    def test_should_retry(self):
+        self.assertTrue(self.policy.should_retry(1, 50))
+        self.assertTrue(self.policy.should_retry(3, 23))
+        self.assertFalse(self.policy.should_retry(4, 50))
+        self.assertFalse(self.policy.should_retry(1, 0))
+        self.assertFalse(self.policy.should_retry(1, 30))
+        self.assertTrue(BackupRetryPolicy({'max_attempts': 2}).should_retry(1, 30))
+
+    def test_get_delay(self):
+        self.assertEqual([self.policy.get_delay(i) for i in (1, 2, 3)],
+                         [5, 10, 12])
+
+    def test_get_delay_jitter(self):
+        policy = BackupRetryPolicy({'max_attempts': 3, 'backoff_base': 4})
+        for i in range(20):
+            self.assertTrue(0 <= policy.get_delay(2) <= 8)
+
+    def test_invalid_config(self):
+        for config in ({'max_attempts': 0},
+                       {'backoff_base': -1},
+                       {'backoff_max': 'long'},
+                       {'jitter': 'maybe'},
+                       {'retryable_exit_codes': 50},
+                       {'retryable_exit_codes': ['50']},
+                       {'attempts': 3}):
+            self.assertRaises(ValueError, BackupRetryPolicy, config)
+
+    def test_is_excluded(self):
+        path_filter = BackupPathFilter([{'type': 'include', 'path': '/data/keep/important'},
+                                        {'type': 'exclude', 'path': '/data/keep'},
+                                        {'type': 'exclude', 'path': '/data/cache/'}])
+        self.assertFalse(path_filter.is_excluded('/data'))
+        self.assertFalse(path_filter.is_excluded('/data/keep'))
+        self.assertFalse(path_filter.is_excluded('/data/keep/important/file'))
+        self.assertTrue(path_filter.is_excluded('/data/keep/other'))
+        self.assertTrue(path_filter.is_excluded('/data/cache'))
+        self.assertTrue(path_filter.is_excluded('/data/cache/file'))
+        self.assertFalse(path_filter.is_excluded('/data/cached'))
+
+    def test_is_excluded_no_filters(self):
+        self.assertFalse(BackupPathFilter().is_excluded('/data'))
+
+    def test_is_excluded_glob(self):
+        path_filter = BackupPathFilter([{'type': 'include', 'path': '/data/**.txt'},
+                                        {'type': 'exclude', 'path': '/data'}])
+        self.assertFalse(path_filter.is_excluded('/data/file.bin'))
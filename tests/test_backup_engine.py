@@ -0,0 +1,154 @@
+import unittest
+import asyncio
+import io
+import os
+import sys
+import time
+from unittest.mock import MagicMock
+from dupcomposer.backup_engine import (BackupEngine, BackupScheduler, get_lpt_order,
+                                       get_makespan)
+
+
+class TestBackupEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = BackupEngine()
+        self.env = dict(os.environ)
+
+    def _python_cmd(self, script):
+        return [sys.executable, '-c', script]
+
+    def test_stdout_and_stderr(self):
+        out = io.StringIO()
+        script = ('import sys\n'
+                  'print("to stdout", flush=True)\n'
+                  'print("to stderr", file=sys.stderr, flush=True)\n'
+                  'sys.exit(5)')
+        returncode = asyncio.run(self.engine.run_cmd(self._python_cmd(script),
+                                                     self.env, out))
+        self.assertEqual(returncode, 5)
+        self.assertEqual(sorted(out.getvalue().splitlines()),
+                         ['to stderr', 'to stdout'])
+
+    def test_env(self):
+        out = io.StringIO()
+        script = 'import os; print(os.environ["DUPCOMP_TEST_VAR"])'
+        asyncio.run(self.engine.run_cmd(self._python_cmd(script),
+                                        dict(self.env, DUPCOMP_TEST_VAR='foo'), out))
+        self.assertEqual(out.getvalue(), 'foo\n')
+
+    def test_timeout(self):
+        out = io.StringIO()
+        start = time.monotonic()
+        self.assertRaises(asyncio.TimeoutError,
+                          asyncio.run,
+                          self.engine.run_cmd(self._python_cmd('import time; time.sleep(30)'),
+                                              self.env, out, timeout=0.2))
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_cancel(self):
+        async def cancel_run():
+            task = asyncio.ensure_future(
+                self.engine.run_cmd(self._python_cmd('import time; time.sleep(30)'),
+                                    self.env, io.StringIO()))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return task
+
+        start = time.monotonic()
+        task = asyncio.run(cancel_run())
+        self.assertTrue(task.cancelled())
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_provider_limits(self):
+        engine = BackupEngine({'ssh': 1})
+        ssh_provider = MagicMock(provider_type='ssh')
+        s3_provider = MagicMock(provider_type='s3')
+        script = 'import time; time.sleep(0.5)'
+
+        async def run_all(provider):
+            await asyncio.gather(*(engine.run_cmd(self._python_cmd(script),
+                                                  self.env, io.StringIO(), provider)
+                                   for i in range(3)))
+
+        start = time.monotonic()
+        asyncio.run(run_all(ssh_provider))
+        # The ssh processes had to run one after another.
+        self.assertGreaterEqual(time.monotonic() - start, 1.5)
+        start = time.monotonic()
+        asyncio.run(run_all(s3_provider))
+        self.assertLess(time.monotonic() - start, 1.5)
+
+
+class TestBackupScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.running = {}
+        self.peak = {}
+
+    async def _worker(self, job):
+        target, name = job
+        self.log.append(name)
+        self.running[target] = self.running.get(target, 0) + 1
+        self.peak[target] = max(self.peak.get(target, 0), self.running[target])
+        await asyncio.sleep(0.05)
+        self.running[target] -= 1
+
+    def _queue(self, jobs):
+        return [(target, (target, name)) for target, name in jobs]
+
+    def test_get_limit(self):
+        scheduler = BackupScheduler(4, {'host1': 1}, 2)
+        self.assertEqual(scheduler.get_limit('host1'), 1)
+        self.assertEqual(scheduler.get_limit('host2'), 2)
+        self.assertIsNone(scheduler.get_limit(None))
+        self.assertIsNone(BackupScheduler(4).get_limit('host1'))
+
+    def test_target_limits(self):
+        scheduler = BackupScheduler(4, {'host1': 1, 'bucket': 2})
+        queue = self._queue([('host1', 'a'), ('host1', 'b'), ('host1', 'c'),
+                             ('bucket', 'd'), ('bucket', 'e'), ('bucket', 'f'),
+                             (None, 'g')])
+        not_started = asyncio.run(scheduler.run(queue, self._worker))
+        self.assertEqual(not_started, [])
+        self.assertEqual(sorted(self.log), list('abcdefg'))
+        self.assertEqual(self.peak, {'host1': 1, 'bucket': 2, None: 1})
+
+    def test_busy_target_does_not_block_queue(self):
+        scheduler = BackupScheduler(2, {'host1': 1})
+        queue = self._queue([('host1', 'a'), ('host1', 'b'), ('host2', 'c')])
+        asyncio.run(scheduler.run(queue, self._worker))
+        # c is started before b, as host1 is busy with a.
+        self.assertEqual(self.log, ['a', 'c', 'b'])
+
+    def test_max_jobs(self):
+        scheduler = BackupScheduler(1)
+        queue = self._queue([('host1', 'a'), ('host2', 'b'), ('host3', 'c')])
+        asyncio.run(scheduler.run(queue, self._worker))
+        self.assertEqual(self.log, ['a', 'b', 'c'])
+        self.assertEqual(max(self.peak.values()), 1)
+
+    def test_stop(self):
+        scheduler = BackupScheduler(1)
+        queue = self._queue([('host1', 'a'), ('host2', 'b'), ('host3', 'c')])
+        not_started = asyncio.run(scheduler.run(queue, self._worker,
+                                                lambda: len(self.log) >= 2))
+        self.assertEqual(self.log, ['a', 'b'])
+        self.assertEqual(not_started, [('host3', 'c')])
+
+
+class TestMakespan(unittest.TestCase):
+
+    def test_get_lpt_order(self):
+        self.assertEqual(get_lpt_order([1, 5, 1, 3]), [1, 3, 0, 2])
+        self.assertEqual(get_lpt_order([]), [])
+
+    def test_get_makespan(self):
+        self.assertEqual(get_makespan([5, 4, 3, 3, 3], 2), 10)
+        # The last long job leaves the other worker idle.
+        self.assertEqual(get_makespan([3, 3, 3, 4, 5], 2), 11)
+        self.assertEqual(get_makespan([2, 3], 1), 5)
+        self.assertEqual(get_makespan([2, 3], 5), 3)
+        self.assertEqual(get_makespan([], 2), 0)
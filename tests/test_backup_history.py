@@ -0,0 +1,73 @@
+import unittest
+import os
+import sqlite3
+import uuid
+from unittest.mock import patch
+from dupcomposer.backup_history import BackupHistory
+from dupcomposer.backup_state import hash_data
+
+class TestBackupHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.file_path = '/tmp/' + str(uuid.uuid4()) + '.history'
+        self.history = BackupHistory(self.file_path)
+        self.cmd = ['duplicity', '/etc', 'file:///backups/etc']
+
+    def tearDown(self):
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+
+    def test_add_save(self):
+        self.history.add('local', '/etc', 'backup', self.cmd, 100.0, 112.5, 0,
+                         {'ElapsedTime': 12.5, 'SourceFiles': 10,
+                          'RawDeltaSize': 2048})
+        self.history.add('local', '/etc', 'backup', self.cmd, 200.0, 201.0, 50, {})
+        # Nothing is written before saving.
+        self.assertFalse(os.path.exists(self.file_path))
+        self.history.save()
+        self.assertEqual(self.history.pending, [])
+        rows = BackupHistory(self.file_path).get_rows()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['argv_hash'], hash_data(self.cmd))
+        self.assertEqual((rows[0]['elapsed_seconds'], rows[0]['source_files'],
+                          rows[0]['raw_delta_size_bytes'], rows[0]['errors']),
+                         (12.5, 10, 2048, None))
+        self.assertEqual(rows[1]['returncode'], 50)
+
+    def test_get_rows_mode(self):
+        self.history.add('local', '/etc', 'backup', self.cmd, 100.0, 101.0, 0, {})
+        self.history.add('local', '/etc', 'restore', self.cmd, 200.0, 201.0, 0, {})
+        self.history.save()
+        self.assertEqual([row['mode'] for row in self.history.get_rows('restore')],
+                         ['restore'])
+
+    def test_save_one_transaction(self):
+        for i in range(3):
+            self.history.add('local', '/etc', 'backup', self.cmd, i, i + 1, 0, {})
+        with patch('sqlite3.connect', wraps=sqlite3.connect) as connect:
+            self.history.save()
+            self.history.save()
+        # A single connection, nothing to do for the second save.
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(len(self.history.get_rows()), 3)
+
+    def test_get_durations(self):
+        self.history.add('local', '/etc', 'backup', self.cmd, 100.0, 110.0, 0, {})
+        self.history.add('local', '/etc', 'backup', self.cmd, 200.0, 205.0, 0, {})
+        self.history.add('local', '/etc', 'backup', self.cmd, 300.0, 301.0, 1, {})
+        self.history.add('local', '/home', 'restore', self.cmd, 300.0, 340.0, 0, {})
+        self.history.save()
+        # The last successful run counts.
+        self.assertEqual(self.history.get_durations('backup'), {('local', '/etc'): 5.0})
+
+    def test_get_throughput(self):
+        self.assertIsNone(self.history.get_throughput('backup'))
+        self.history.add('local', '/etc', 'backup', self.cmd, 100.0, 110.0, 0,
+                         {'SourceFileSize': 1000})
+        self.history.add('local', '/home', 'backup', self.cmd, 100.0, 130.0, 0,
+                         {'SourceFileSize': 3000})
+        self.history.add('local', '/srv', 'backup', self.cmd, 100.0, 200.0, 0, {})
+        self.history.save()
+        self.assertEqual(self.history.get_throughput('backup'), 100.0)
@@ -4,8 +4,12 @@ import os
 import pwd
 import uuid
 import socket
+import subprocess
+import sys
 from collections import namedtuple
 import keyring
+import keyring.backends.SecretService
+import keyring.backends.chainer
 from keyring import backends
 from unittest.mock import patch, Mock, MagicMock, call, DEFAULT
 from dupcomposer import backup_keyring
@@ -60,6 +64,7 @@ class TestBackupKeyring(unittest.TestCase):
         mock_geteuid.return_value = self.dummy_runuser_id
         mock_env.get.return_value = self.dummy_runuser_bus
         importlib.reload(backup_keyring)
+        backup_keyring.BackupKeyring._load_keyring()
 
 
     @patch('os.geteuid')
@@ -71,10 +76,24 @@ class TestBackupKeyring(unittest.TestCase):
         mock_geteuid.return_value = self.dummy_runuser_id
         mock_env.get.return_value = self.dummy_runuser_bus
         importlib.reload(backup_keyring)
-        self.assertTrue(isinstance(set_keyring.call_args[0][0],
-                        backends.SecretService.Keyring))
         self.assertEqual(backup_keyring.BackupKeyring.runuser_id, self.dummy_runuser_id)
         self.assertEqual(backup_keyring.BackupKeyring.runuser_bus,self.dummy_runuser_bus)
+        # The keyring backend is set up on first use.
+        set_keyring.assert_not_called()
+        self.assertIs(backup_keyring.BackupKeyring._load_keyring(), keyring)
+        self.assertTrue(isinstance(set_keyring.call_args[0][0],
+                        backends.SecretService.Keyring))
+        backup_keyring.BackupKeyring._load_keyring()
+        set_keyring.assert_called_once()
+
+
+    def test_keyring_not_imported(self):
+        script = ('import sys\n'
+                  'from dupcomposer import backup_config, backup_runner\n'
+                  'print("keyring" in sys.modules)')
+        result = subprocess.run([sys.executable, '-c', script],
+                                stdout=subprocess.PIPE)
+        self.assertEqual(result.stdout.strip(), b'False')
         
 
     def test_instantiation_noconfig(self):
@@ -156,3 +175,50 @@ class TestBackupKeyring(unittest.TestCase):
                          [call('DBUS_SESSION_BUS_ADDRESS', '='.join(['unix:path',
                                                                      self.socket_path])),
                           call('DBUS_SESSION_BUS_ADDRESS', self.dummy_runuser_bus)])
+
+
+    @patch('keyring.get_password')
+    @patch('pwd.getpwnam')
+    @patch.multiple('os', seteuid=DEFAULT, environ=DEFAULT)
+    def test_get_secret_cached(self, getpwnam, get_password,
+                               seteuid, environ):
+        get_password.return_value = 'storedpassword'
+        getpwnam.return_value = Mock(pw_uid=self.config_uid)
+        kr = backup_keyring.BackupKeyring(self.config_username, self.socket_path)
+        kr.get_secret(['service', 'account'])
+        # Another instance for the same user and bus shares the cache.
+        kr = backup_keyring.BackupKeyring(self.config_username, self.socket_path)
+        self.assertEqual(kr.get_secret(['service', 'account']),
+                         'storedpassword')
+        get_password.assert_called_once_with('service', 'account')
+        self.assertEqual(seteuid.call_count, 2)
+
+
+    @patch('keyring.get_password')
+    @patch('pwd.getpwnam')
+    @patch.multiple('os', seteuid=DEFAULT, environ=DEFAULT)
+    def test_get_secrets(self, getpwnam, get_password,
+                         seteuid, environ):
+        get_password.side_effect = lambda service, account: service + account
+        getpwnam.return_value = Mock(pw_uid=self.config_uid)
+        kr = backup_keyring.BackupKeyring(self.config_username, self.socket_path)
+        self.assertEqual(kr.get_secrets([['s1', 'a1'], ['s2', 'a2'], ['s1', 'a1']]),
+                         ['s1a1', 's2a2', 's1a1'])
+        self.assertEqual(get_password.call_args_list,
+                         [call('s1', 'a1'), call('s2', 'a2')])
+        # A single privilege switch for all the secrets.
+        self.assertEqual(seteuid.call_args_list,
+                         [call(self.config_uid), call(self.dummy_runuser_id)])
+
+
+    @patch('keyring.get_password')
+    @patch('pwd.getpwnam')
+    @patch.multiple('os', seteuid=DEFAULT, environ=DEFAULT)
+    def test_get_secrets_error_resets_uid(self, getpwnam, get_password,
+                                          seteuid, environ):
+        get_password.side_effect = RuntimeError('keyring locked')
+        getpwnam.return_value = Mock(pw_uid=self.config_uid)
+        kr = backup_keyring.BackupKeyring(self.config_username, self.socket_path)
+        self.assertRaises(RuntimeError, kr.get_secrets, [['s1', 'a1']])
+        self.assertEqual(seteuid.call_args_list,
+                         [call(self.config_uid), call(self.dummy_runuser_id)])
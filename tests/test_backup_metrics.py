@@ -0,0 +1,105 @@
+import unittest
+import json
+import os
+import uuid
+from dupcomposer.backup_metrics import (DuplicityStats, get_metrics_data,
+                                        write_metrics_json, write_metrics_textfile)
+from dupcomposer.backup_runner import GroupResult, SourceResult
+
+STATS_OUTPUT = """Local and Remote metadata are synchronized, no sync needed.
+--------------[ Backup Statistics ]--------------
+StartTime 1600000000.00 (Sun Sep 13 12:26:40 2020)
+ElapsedTime 12.50 (12.50 seconds)
+SourceFiles 10
+SourceFileSize 40960 (40.0 KB)
+NewFiles 3
+ChangedFiles 2
+DeltaEntries 5
+RawDeltaSize 36864 (36.0 KB)
+TotalDestinationSizeChange 2048 (2.00 KB)
+Errors 0
+-------------------------------------------------
+"""
+
+class TestDuplicityStats(unittest.TestCase):
+
+    def test_feed(self):
+        stats = DuplicityStats()
+        for line in STATS_OUTPUT.splitlines(True):
+            stats.feed(line)
+        self.assertEqual(stats.values,
+                         {'ElapsedTime': 12.5, 'SourceFiles': 10,
+                          'SourceFileSize': 40960, 'NewFiles': 3,
+                          'ChangedFiles': 2, 'DeltaEntries': 5,
+                          'RawDeltaSize': 36864,
+                          'TotalDestinationSizeChange': 2048, 'Errors': 0})
+
+    def test_no_block(self):
+        stats = DuplicityStats()
+        # Statistics outside of the block are not collected.
+        for line in ['SourceFiles 10\n', 'Errors 1\n']:
+            stats.feed(line)
+        self.assertEqual(stats.values, {})
+
+    def test_invalid_value(self):
+        stats = DuplicityStats()
+        for line in STATS_OUTPUT.replace('Errors 0', 'Errors none').splitlines():
+            stats.feed(line)
+        self.assertNotIn('Errors', stats.values)
+        self.assertEqual(stats.values['SourceFiles'], 10)
+
+
+class TestMetricsFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.file_path = '/tmp/' + str(uuid.uuid4())
+        group = GroupResult('my "local" backups')
+        group.returncode = 0
+        group.elapsed = 13.25
+        source = SourceResult(group.name, '/etc')
+        source.returncode = 0
+        source.elapsed = 13.0
+        source.stats = {'ElapsedTime': 12.5, 'SourceFiles': 10}
+        skipped = SourceResult(group.name, '/home')
+        skipped.returncode = 0
+        skipped.skipped = True
+        group.sources = [source, skipped]
+        self.results = [group, GroupResult('remote')]
+
+    def tearDown(self):
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+
+    def test_get_metrics_data(self):
+        data = get_metrics_data(self.results, 'backup')
+        self.assertEqual(data['mode'], 'backup')
+        self.assertEqual(data['groups'][0]['sources'],
+                         [{'source': '/etc', 'status': 'OK', 'returncode': 0,
+                           'elapsed': 13.0,
+                           'stats': {'ElapsedTime': 12.5, 'SourceFiles': 10}},
+                          {'source': '/home', 'status': 'SKIPPED', 'returncode': 0,
+                           'elapsed': 0.0, 'stats': {}}])
+        self.assertEqual(data['groups'][1],
+                         {'group': 'remote', 'status': 'SKIPPED',
+                          'returncode': None, 'elapsed': 0.0, 'sources': []})
+
+    def test_write_metrics_json(self):
+        write_metrics_json(self.file_path, self.results, 'backup')
+        with open(self.file_path) as f:
+            data = json.load(f)
+        self.assertEqual([group['group'] for group in data['groups']],
+                         ['my "local" backups', 'remote'])
+
+    def test_write_metrics_textfile(self):
+        write_metrics_textfile(self.file_path, self.results, 'backup')
+        with open(self.file_path) as f:
+            lines = f.read().splitlines()
+        labels = '{group="my \\"local\\" backups",source="/etc"}'
+        self.assertIn('# TYPE dupcomposer_source_files gauge', lines)
+        self.assertIn('dupcomposer_source_files' + labels + ' 10', lines)
+        self.assertIn('dupcomposer_elapsed_seconds' + labels + ' 12.5', lines)
+        self.assertIn('dupcomposer_group_exit_code{group="remote"} -1', lines)
+        # No samples, no metric.
+        self.assertNotIn('# TYPE dupcomposer_errors gauge', lines)
@@ -0,0 +1,57 @@
+import unittest
+import io
+import os
+import uuid
+from dupcomposer.backup_plan import write_plan, read_plan, get_shard
+
+class TestBackupPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.file_path = '/tmp/' + str(uuid.uuid4()) + '.jsonl'
+        self.records = [{'group': 'local', 'source': '/etc', 'action': 'backup',
+                         'argv': ['duplicity', '/etc', 'file:///backups/etc'],
+                         'env': {}, 'host': None, 'cost': 100},
+                        {'group': 'remote', 'source': '/home', 'action': 'backup',
+                         'argv': ['duplicity', '/home', 'sftp://host/home'],
+                         'env': {'FTP_PASSWORD': None}, 'host': 'host',
+                         'cost': None}]
+
+    def tearDown(self):
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+
+    def test_write_read(self):
+        out = io.StringIO()
+        write_plan(iter(self.records), out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+        with open(self.file_path, 'w') as f:
+            f.write(out.getvalue() + '\n')
+        self.assertEqual(read_plan(self.file_path), self.records)
+
+    def test_read_invalid(self):
+        for line in ('not json', '[1, 2]', '{"group": "local"}'):
+            with open(self.file_path, 'w') as f:
+                f.write(line + '\n')
+            self.assertRaisesRegex(ValueError,
+                                   'Invalid plan record on line 1',
+                                   read_plan, self.file_path)
+
+    def test_get_shard(self):
+        records = [{'id': i, 'cost': cost}
+                   for i, cost in enumerate([10, 70, 20, 30, 40, None])]
+        shards = [get_shard(records, i, 3) for i in (1, 2, 3)]
+        # The shards don't overlap and cover the plan, in the plan order.
+        self.assertEqual(sorted(r['id'] for shard in shards for r in shard),
+                         list(range(6)))
+        for shard in shards:
+            self.assertEqual(shard, sorted(shard, key=lambda r: r['id']))
+        self.assertEqual([sum(r['cost'] or 0 for r in shard) for shard in shards],
+                         [70, 50, 50])
+
+    def test_get_shard_without_cost(self):
+        records = [{'id': i} for i in range(7)]
+        self.assertEqual([len(get_shard(records, i, 3)) for i in (1, 2, 3)],
+                         [3, 2, 2])
+        self.assertEqual(get_shard(records, 1, 1), records)
@@ -0,0 +1,287 @@
+import unittest
+import os
+import json
+import uuid
+import shutil
+import tempfile
+from unittest.mock import patch
+from dupcomposer.backup_state import (BackupJournal, BackupSourceIndex,
+                                      BackupConfigDigests, BackupDeferredGroups,
+                                      get_state_path, write_json_atomic,
+                                      hash_data, get_tree_digest,
+                                      get_tree_size)
+
+
+class TestStateHelpers(unittest.TestCase):
+
+    def setUp(self):
+        self.file_path = '/tmp/' + str(uuid.uuid4()) + '.json'
+
+    def tearDown(self):
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+
+    def test_get_state_path(self):
+        self.assertEqual(get_state_path('conf/dupcomposer-config.yml', 'journal'),
+                         'conf/dupcomposer-config.yml.journal')
+
+    def test_write_json_atomic(self):
+        write_json_atomic(self.file_path, {'b': [1, 2], 'a': None})
+        write_json_atomic(self.file_path, {'c': 'd'})
+        with open(self.file_path) as f:
+            self.assertEqual(json.load(f), {'c': 'd'})
+        self.assertFalse(os.path.exists(self.file_path + '.tmp'))
+
+    def test_hash_data(self):
+        self.assertEqual(hash_data({'a': 1, 'b': [2, 3]}),
+                         hash_data({'b': [2, 3], 'a': 1}))
+        self.assertNotEqual(hash_data({'a': 1}), hash_data({'a': 2}))
+        self.assertNotEqual(hash_data(['a', 'b c']), hash_data(['a b', 'c']))
+
+
+class TestBackupJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.file_path = '/tmp/' + str(uuid.uuid4()) + '.journal'
+        self.group_data = {'volume_size': 200, 'sources': {'/etc': {}}}
+        self.cmd_etc = ['duplicity', '/etc', 'file:///backups/etc']
+        self.cmd_home = ['duplicity', '/home', 'file:///backups/home']
+
+    def tearDown(self):
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+
+    def _interrupted_run(self):
+        journal = BackupJournal(self.file_path, 'backup')
+        journal.begin()
+        journal.mark_completed('local', self.group_data, self.cmd_etc)
+
+    def test_resume(self):
+        self._interrupted_run()
+        journal = BackupJournal(self.file_path, 'backup', resume=True)
+        self.assertTrue(journal.is_completed('local', self.group_data, self.cmd_etc))
+        self.assertFalse(journal.is_completed('local', self.group_data, self.cmd_home))
+        self.assertFalse(journal.is_completed('other', self.group_data, self.cmd_etc))
+
+    def test_no_resume(self):
+        self._interrupted_run()
+        journal = BackupJournal(self.file_path, 'backup')
+        self.assertFalse(journal.is_completed('local', self.group_data, self.cmd_etc))
+        journal.begin()
+        journal = BackupJournal(self.file_path, 'backup', resume=True)
+        self.assertFalse(journal.is_completed('local', self.group_data, self.cmd_etc))
+
+    def test_resume_changed_config(self):
+        self._interrupted_run()
+        journal = BackupJournal(self.file_path, 'backup', resume=True)
+        changed_data = dict(self.group_data, volume_size=100)
+        self.assertFalse(journal.is_completed('local', changed_data, self.cmd_etc))
+
+    def test_resume_other_mode(self):
+        self._interrupted_run()
+        journal = BackupJournal(self.file_path, 'restore', resume=True)
+        self.assertFalse(journal.is_completed('local', self.group_data, self.cmd_etc))
+
+    def test_resume_interrupted_again(self):
+        self._interrupted_run()
+        journal = BackupJournal(self.file_path, 'backup', resume=True)
+        journal.begin()
+        journal.mark_completed('local', self.group_data, self.cmd_home)
+        journal = BackupJournal(self.file_path, 'backup', resume=True)
+        self.assertTrue(journal.is_completed('local', self.group_data, self.cmd_etc))
+        self.assertTrue(journal.is_completed('local', self.group_data, self.cmd_home))
+
+    def test_resume_cut_short(self):
+        self._interrupted_run()
+        journal = BackupJournal(self.file_path, 'backup')
+        journal.mark_completed('local', self.group_data, self.cmd_home)
+        with open(self.file_path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.file_path) - 10)
+        journal = BackupJournal(self.file_path, 'backup', resume=True)
+        self.assertTrue(journal.is_completed('local', self.group_data, self.cmd_etc))
+        self.assertFalse(journal.is_completed('local', self.group_data, self.cmd_home))
+
+    def test_mark_completed_appends(self):
+        journal = BackupJournal(self.file_path, 'backup')
+        journal.begin()
+        with patch('dupcomposer.backup_state.hash_data',
+                   side_effect=hash_data) as hash_data_mock, \
+             patch('os.replace') as replace:
+            for i in range(3):
+                journal.mark_completed('local', self.group_data,
+                                       self.cmd_etc + [str(i)])
+            journal.mark_completed('local', self.group_data, self.cmd_etc + ['0'])
+        # The file isn't rewritten, the config is hashed once.
+        replace.assert_not_called()
+        self.assertEqual(hash_data_mock.call_count, 5)
+        with open(self.file_path) as f:
+            self.assertEqual(len(f.read().splitlines()), 4)
+
+    def test_resume_missing_journal(self):
+        journal = BackupJournal(self.file_path, 'backup', resume=True)
+        self.assertFalse(journal.is_completed('local', self.group_data, self.cmd_etc))
+
+    def test_remove(self):
+        self._interrupted_run()
+        journal = BackupJournal(self.file_path, 'backup')
+        journal.remove()
+        self.assertFalse(os.path.exists(self.file_path))
+        # Removing a missing journal is not an error.
+        journal.remove()
+
+
+class TestTreeDigest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'sub', 'cache'))
+        self._write('a.txt', 'a')
+        self._write('sub/b.txt', 'b')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, path, content):
+        with open(os.path.join(self.root, path), 'w') as f:
+            f.write(content)
+
+    def test_unchanged(self):
+        self.assertEqual(get_tree_digest(self.root), get_tree_digest(self.root))
+
+    def test_changes(self):
+        digests = [get_tree_digest(self.root)]
+        self._write('sub/c.txt', 'c')
+        digests.append(get_tree_digest(self.root))
+        self._write('a.txt', 'longer content')
+        digests.append(get_tree_digest(self.root))
+        os.remove(os.path.join(self.root, 'sub/b.txt'))
+        digests.append(get_tree_digest(self.root))
+        self.assertEqual(len(set(digests)), 4)
+
+    def test_excluded(self):
+        cache_dir = os.path.join(self.root, 'sub', 'cache')
+        is_excluded = lambda path: path == cache_dir
+        digest = get_tree_digest(self.root, is_excluded)
+        self._write('sub/cache/c.txt', 'c')
+        self.assertEqual(get_tree_digest(self.root, is_excluded), digest)
+
+    def test_missing_path(self):
+        self.assertIsNone(get_tree_digest(os.path.join(self.root, 'missing')))
+        self.assertIsNone(get_tree_size(os.path.join(self.root, 'missing')))
+
+    def test_vanished_entry(self):
+        entries = list(os.scandir(self.root))
+        os.remove(os.path.join(self.root, 'a.txt'))
+        digest = get_tree_digest(self.root)
+        # Files removed while the tree is walked are left out.
+        with patch('os.scandir', side_effect=[entries, os.scandir(
+                os.path.join(self.root, 'sub')), os.scandir(
+                os.path.join(self.root, 'sub', 'cache'))]):
+            self.assertEqual(get_tree_digest(self.root), digest)
+
+    def test_unreadable_path(self):
+        with patch('os.lstat', side_effect=PermissionError):
+            self.assertIsNone(get_tree_digest(self.root))
+            self.assertIsNone(get_tree_size(self.root))
+
+    def test_tree_size_vanished_entry(self):
+        entries = list(os.scandir(self.root))
+        os.remove(os.path.join(self.root, 'a.txt'))
+        with patch('os.scandir', side_effect=[entries, os.scandir(
+                os.path.join(self.root, 'sub')), os.scandir(
+                os.path.join(self.root, 'sub', 'cache'))]):
+            self.assertEqual(get_tree_size(self.root), 1)
+
+    def test_tree_size(self):
+        self.assertEqual(get_tree_size(self.root), 2)
+        self.assertEqual(get_tree_size(os.path.join(self.root, 'a.txt')), 1)
+        self._write('sub/cache/c.txt', 'cache')
+        self.assertEqual(get_tree_size(self.root), 7)
+        cache_dir = os.path.join(self.root, 'sub', 'cache')
+        self.assertEqual(get_tree_size(self.root, lambda path: path == cache_dir), 2)
+
+
+class TestBackupSourceIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.file_path = '/tmp/' + str(uuid.uuid4()) + '.index'
+        self.cmd = ['duplicity', '/etc', 'file:///backups/etc']
+
+    def tearDown(self):
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+
+    def test_is_unchanged(self):
+        index = BackupSourceIndex(self.file_path)
+        self.assertFalse(index.is_unchanged('local', '/etc', self.cmd, 'digest1'))
+        index.update('local', '/etc', self.cmd, 'digest1')
+        index = BackupSourceIndex(self.file_path)
+        self.assertTrue(index.is_unchanged('local', '/etc', self.cmd, 'digest1'))
+        self.assertFalse(index.is_unchanged('local', '/etc', self.cmd, 'digest2'))
+        self.assertFalse(index.is_unchanged('local', '/etc', self.cmd, None))
+        self.assertFalse(index.is_unchanged('other', '/etc', self.cmd, 'digest1'))
+        self.assertFalse(index.is_unchanged('local', '/etc',
+                                            ['duplicity', 'full'] + self.cmd[1:],
+                                            'digest1'))
+
+
+class TestBackupConfigDigests(unittest.TestCase):
+
+    def setUp(self):
+        self.file_path = '/tmp/' + str(uuid.uuid4()) + '.digests'
+        self.groups = {'local': {'volume_size': 200},
+                       'remote': {'volume_size': 50}}
+
+    def tearDown(self):
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+
+    def test_get_changed(self):
+        digests = BackupConfigDigests(self.file_path)
+        self.assertEqual(digests.get_changed(self.groups), [])
+        digests.update({'local': self.groups['local']})
+        self.assertTrue(os.path.isfile(self.file_path))
+        digests = BackupConfigDigests(self.file_path)
+        self.assertEqual(sorted(digests.entries), ['local'])
+        self.assertEqual(digests.get_changed(self.groups), [])
+        changed = {'local': {'volume_size': 100}, 'remote': {'volume_size': 100}}
+        # Only the groups run before are checked.
+        self.assertEqual(digests.get_changed(changed), ['local'])
+
+    def test_add_groups(self):
+        digests = BackupConfigDigests(self.file_path)
+        digests.add_groups(self.groups)
+        self.assertFalse(os.path.isfile(self.file_path))
+        self.assertEqual(digests.get_changed({'remote': {'volume_size': 100}}),
+                         ['remote'])
+
+
+class TestBackupDeferredGroups(unittest.TestCase):
+
+    def setUp(self):
+        self.file_path = '/tmp/' + str(uuid.uuid4()) + '.deferred'
+
+    def tearDown(self):
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+
+    def test_update(self):
+        self.assertEqual(BackupDeferredGroups(self.file_path).groups, [])
+        BackupDeferredGroups(self.file_path).update(['local'], ['remote', 'archive'])
+        deferred = BackupDeferredGroups(self.file_path)
+        self.assertEqual(deferred.groups, ['archive', 'remote'])
+        # The groups deferred earlier stay deferred until they are run.
+        deferred.update(['remote'], [])
+        self.assertEqual(BackupDeferredGroups(self.file_path).groups, ['archive'])
+        deferred.update(['archive'], [])
+        self.assertFalse(os.path.exists(self.file_path))
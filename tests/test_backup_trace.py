@@ -0,0 +1,66 @@
+import unittest
+import asyncio
+import json
+import os
+import uuid
+from dupcomposer.backup_trace import BackupTracer, NullTracer, NULL_TRACER
+
+class TestBackupTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = BackupTracer()
+
+    def get_spans(self):
+        return [event for event in self.tracer.events if event['ph'] == 'X']
+
+    def test_span(self):
+        with self.tracer.span('outer'):
+            with self.tracer.span('inner', {'source': '/etc'}):
+                pass
+        inner, outer = self.get_spans()
+        self.assertEqual((inner['name'], outer['name']), ('inner', 'outer'))
+        self.assertEqual(inner['args'], {'source': '/etc'})
+        self.assertNotIn('args', outer)
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertGreaterEqual(outer['dur'], inner['dur'])
+        self.assertEqual(inner['tid'], 0)
+
+    def test_span_on_error(self):
+        with self.assertRaises(SystemExit):
+            with self.tracer.span('failing'):
+                raise SystemExit(1)
+        self.assertEqual([span['name'] for span in self.get_spans()], ['failing'])
+
+    def test_lanes(self):
+        async def run(name):
+            with self.tracer.span(name, lane=name):
+                await asyncio.sleep(0.01)
+                with self.tracer.span('command'):
+                    pass
+
+        async def run_all():
+            await asyncio.gather(run('alpha'), run('bravo'))
+
+        asyncio.run(run_all())
+        tracks = {event['args']['name']: event['tid']
+                  for event in self.tracer.events if event['ph'] == 'M'}
+        self.assertEqual(tracks, {'dupcomp': 0, 'alpha': 1, 'bravo': 2})
+        # The nested spans are on the track of their lane.
+        self.assertEqual(sorted(span['tid'] for span in self.get_spans()
+                                if span['name'] == 'command'), [1, 2])
+
+    def test_save(self):
+        file_path = '/tmp/' + str(uuid.uuid4()) + '.json'
+        with self.tracer.span('run'):
+            pass
+        self.tracer.save(file_path)
+        with open(file_path) as f:
+            data = json.load(f)
+        os.remove(file_path)
+        self.assertEqual(data['traceEvents'], self.tracer.events)
+
+    def test_null_tracer(self):
+        self.assertIsInstance(NULL_TRACER, NullTracer)
+        self.assertIs(NULL_TRACER.span('run'), NULL_TRACER.span('other', {}, 'lane'))
+        with NULL_TRACER.span('run'):
+            pass
@@ -3,10 +3,14 @@ from unittest.mock import patch
 import subprocess
 import os
 import shutil
-import filecmp
 import glob
 import json
+import re
 import uuid
+import tempfile
+from dupcomposer.backup_runner import read_config
+from dupcomposer.backup_state import BackupJournal, hash_data
+from dupcomposer.backup_history import BackupHistory
 
 class TestCLI(unittest.TestCase):
 
@@ -163,6 +167,18 @@ class TestCLI(unittest.TestCase):
                                     }
                          }
         }
+        # Same commands as the complete example, with groups run in parallel.
+        cls.test_data['backup_example_parallel'] = \
+            {'config_file': 'dupcomposer-config.yml',
+             'command': [cls.py3_exec, cls.console_script, '--jobs', '3', 'backup'],
+             'result': cls.test_data['backup_example_complete']['result']}
+        # The complete example resumed after the local backups completed.
+        complete_result = cls.test_data['backup_example_complete']['result']
+        cls.test_data['backup_example_resume'] = \
+            {'config_file': 'dupcomposer-config.yml',
+             'command': [cls.py3_exec, cls.console_script, '--resume', 'backup'],
+             'result': {'args': complete_result['args'][2:],
+                        'envs': complete_result['envs'][2:]}}
         #cls.dummy_outfile = '../temp/dummy-out.json'
         cls.dummy_outfile = '/tmp/' + str(uuid.uuid4()) + '.json'
         cls.environ = os.environ.copy()
@@ -170,12 +186,16 @@ class TestCLI(unittest.TestCase):
         cls.environ['duplicity_mock_outfile'] = cls.dummy_outfile
         # Update path, so the mock Duplicity implementation is called.
         cls.environ['PATH'] = ':'.join(['../mock', os.environ['PATH']])
+        # Keep the version check cache out of the user's home.
+        cls.cache_home = tempfile.mkdtemp()
+        cls.environ['XDG_CACHE_HOME'] = cls.cache_home
 
 
     @classmethod
     def tearDownClass(cls):
         # Reset workdir after we are done with the CLI tests.
         os.chdir(cls.workdir_original)
+        shutil.rmtree(cls.cache_home)
 
     def setUp(self):
         pass
@@ -186,7 +206,9 @@ class TestCLI(unittest.TestCase):
         except FileNotFoundError:
             pass
         # clean up any existing cache files generated
-        for filename in glob.glob('*.cached'):
+        for filename in (glob.glob('*.cached') + glob.glob('*.journal') +
+                         glob.glob('*.digests') + glob.glob('*.history') +
+                         glob.glob('*.deferred')):
             os.remove(filename)
 
 
@@ -207,6 +229,95 @@ class TestCLI(unittest.TestCase):
         self.assertEqual(self._get_duplicity_results('backup_sftp'),
                          self.test_data['backup_sftp']['result'])
 
+    def test_parallel_groups(self):
+        self.maxDiff = None
+        expected = self.test_data['backup_example_parallel']['result']
+        result = self._get_duplicity_results('backup_example_parallel')
+        # Groups finish in an arbitrary order when run in parallel.
+        self.assertEqual(sorted(zip(map(str, result['args']), map(str, result['envs']))),
+                         sorted(zip(map(str, expected['args']), map(str, expected['envs']))))
+
+    def test_parallel_summary(self):
+        output = self._get_cmd_out(['-j', '2', 'backup',
+                                    'my_local_backups', 'my_scp_backups'])
+        self.assertRegex(output, r'== Summary ==\nGROUP +STATUS +EXIT CODE +WALL TIME\n'
+                                 r'my_local_backups +OK +0 +[0-9.]+s\n'
+                                 r'my_scp_backups +OK +0 +[0-9.]+s\n$')
+
+    def test_parallel_sources(self):
+        output = self._get_cmd_out(['-c', 'dupcomposer-config-parallel-sources.yml',
+                                    'backup'])
+        # The output of the sources is reported in a deterministic order.
+        self.assertEqual(re.findall(r'^Executing Duplicity command: .* (/srv/\w+) ',
+                                    output, re.MULTILINE),
+                         ['/srv/alpha', '/srv/bravo', '/srv/charlie', '/srv/delta'])
+        self.assertEqual(output.count('Duplicity returned NORMALLY.'), 4)
+        with open(self.dummy_outfile) as f:
+            result = json.loads(f.read())
+        self.assertEqual(sorted(args[-2] for args in result['args']),
+                         ['/srv/alpha', '/srv/bravo', '/srv/charlie', '/srv/delta'])
+
+    def test_plan(self):
+        output = self._get_cmd_out(['-d', '--format', 'jsonl', 'backup'])
+        records = [json.loads(line) for line in output.splitlines()]
+        # The records are in the order of the group names.
+        self.assertEqual([record['argv'] for record in records],
+                         [['duplicity'] + args for args in
+                          self.test_data['backup_example_complete']['result']['args']])
+        self.assertEqual(records[0]['group'], 'my_local_backups')
+        self.assertEqual(records[-1]['env'], {'FTP_PASSWORD': None})
+        self.assertNotIn('xxxxxx', json.dumps([record['env'] for record in records]))
+        plan_file = '/tmp/' + str(uuid.uuid4()) + '.jsonl'
+        with open(plan_file, 'w') as f:
+            f.write(output)
+        outputs = [self._get_cmd_out(['--shard', '{}/2'.format(i), 'execute-plan', plan_file])
+                   for i in (1, 2)]
+        with open(self.dummy_outfile) as f:
+            result = json.loads(f.read())
+        os.remove(plan_file)
+        self.assertEqual([output.count('Executing Duplicity command') for output in outputs],
+                         [4, 4])
+        self.assertEqual(sorted(result['args']),
+                         sorted(record['argv'][1:] for record in records))
+        self.assertEqual(sorted(map(sorted, map(dict.items, result['envs']))),
+                         sorted(map(sorted, map(dict.items,
+                             self.test_data['backup_example_complete']['result']['envs']))))
+
+    def test_trace(self):
+        trace_file = '/tmp/' + str(uuid.uuid4()) + '.json'
+        self._get_cmd_out(['--trace', trace_file, '-j', '2', 'backup'])
+        with open(trace_file) as f:
+            events = json.load(f)['traceEvents']
+        os.remove(trace_file)
+        spans = [event for event in events if event['ph'] == 'X']
+        names = [span['name'] for span in spans]
+        for name in ('read_config', 'check_config_change', 'get_cmds_raw',
+                     'resolve_secrets', 'my_local_backups', 'spawn', 'duplicity'):
+            self.assertIn(name, names)
+        self.assertEqual(names.count('duplicity'), 8)
+        # Each group is traced on a track of its own.
+        tracks = {event['args']['name']: event['tid'] for event in events
+                  if event['ph'] == 'M'}
+        group_span = spans[names.index('my_local_backups')]
+        self.assertEqual(group_span['tid'], tracks['my_local_backups'])
+        self.assertEqual([span['name'] for span in spans
+                          if span['tid'] == group_span['tid'] and
+                          span['name'].startswith('/')], ['/var/www/html'])
+
+    def test_plan_invalid_options(self):
+        self.assertRegex(self._get_cmd_out(['--format', 'jsonl', 'backup']),
+                         r'^--format: the output format only applies to dry runs')
+        self.assertRegex(self._get_cmd_out(['--shard', '1/2', 'backup']),
+                         r'^--shard: sharding is only supported with execute-plan')
+        self.assertRegex(self._get_cmd_out(['--shard', '3/2', 'execute-plan', 'plan']),
+                         r'^--shard: the shard must be given as i/n')
+        self.assertRegex(self._get_cmd_out(['execute-plan']),
+                         r'^execute-plan: the path of the plan file is missing')
+
+    def test_invalid_jobs(self):
+        self.assertRegex(self._get_cmd_out(['--jobs', '0', 'backup']),
+                         r'^--jobs: the number of jobs must be a positive integer')
+
     def test_full_frequency_backup(self):
         self.assertEqual(self._get_duplicity_results('full_frequency_backup'),
                          self.test_data['full_frequency_backup']['result'])
@@ -331,6 +442,43 @@ class TestCLI(unittest.TestCase):
                              r'^Unsupported Duplicity version 0\.4\.1')
 
 
+    def test_duplicity_version_cached(self):
+        mock_dir = tempfile.mkdtemp()
+        mock = os.path.join(mock_dir, 'duplicity')
+        probes = os.path.join(mock_dir, 'probes')
+        with open(mock, 'w') as f:
+            f.write('#!/bin/bash\n'
+                    'echo probe >> {}\n'
+                    'echo "duplicity 0.8.11"\n'.format(probes))
+        os.chmod(mock, 0o755)
+
+        def probe_count(*args):
+            self._get_cmd_out(['-d'] + list(args) + ['backup'])
+            if not os.path.exists(probes):
+                return 0
+            with open(probes) as f:
+                return len(f.readlines())
+
+        with patch.dict(self.environ, {'PATH': ':'.join([mock_dir,
+                                                         os.environ['PATH']])}):
+            # Dry runs don't need Duplicity.
+            self.assertEqual(probe_count(), 0)
+            self.assertEqual(probe_count('--check-version'), 1)
+            # The result is cached until the executable changes.
+            self.assertEqual(probe_count('--check-version'), 1)
+            stat = os.stat(mock)
+            os.utime(mock, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertEqual(probe_count('--check-version'), 2)
+            self.assertEqual(probe_count('--check-version'), 2)
+            cache_file = os.path.join(self.cache_home, 'dupcomposer',
+                                      'duplicity-version.json')
+            self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+            # A cache others can write to is not trusted.
+            os.chmod(cache_file, 0o666)
+            self.assertEqual(probe_count('--check-version'), 3)
+            self.assertEqual(probe_count('--check-version'), 3)
+        shutil.rmtree(mock_dir)
+
     def test_duplicity_nonzero_return(self):
         with patch.dict(self.environ, {'PATH': '../mock/versioncheck-failed'}):
             self.assertRegex(self._get_cmd_out(['backup']),
@@ -340,6 +488,99 @@ class TestCLI(unittest.TestCase):
             self.assertEqual(self._get_cmd_returncode(['backup']),
                              42)
 
+    def test_keep_going(self):
+        with patch.dict(self.environ, {'PATH': '../mock/nonzero-returncode'}):
+            output = self._get_cmd_out(['backup'])
+            self.assertEqual(output.count('Executing Duplicity command'), 1)
+            self.assertRegex(output, r'my_local_backups +FAILED +42 ')
+            self.assertRegex(output, r'my_s3_backups +SKIPPED +- ')
+
+            proc = self._run_cmd(['--keep-going', 'backup'])
+            output = proc.communicate()[0]
+            self.assertEqual(proc.returncode, 42)
+            self.assertEqual(output.count('Executing Duplicity command'), 8)
+            self.assertRegex(output, r'my_scp_backups +FAILED +42 ')
+            failed = output[output.index('Failed commands:'):].splitlines()[1:]
+            self.assertEqual(len(failed), 8)
+            self.assertEqual(failed[0],
+                             'my_local_backups [42]: duplicity --no-encryption '
+                             '--volsize 200 /var/www/html file:///root/backups/var/www/html')
+
+    def test_retry(self):
+        with patch.dict(self.environ, {'PATH': ':'.join(['../mock/flaky',
+                                                         os.environ['PATH']])}):
+            proc = self._run_cmd(['-c', 'dupcomposer-config-retry.yml', 'backup'])
+            output = proc.communicate()[0]
+        os.remove(self.dummy_outfile + '.attempts')
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(output.count('Executing Duplicity command'), 2)
+        self.assertIn('Duplicity returned with ERROR CODE 50\n'
+                      'Retrying in 0.0 seconds (attempt 2 of 3).', output)
+        self.assertRegex(output, r'flaky_group +OK +0 ')
+
+    def test_history(self):
+        self._get_cmd_out(['backup', 'my_local_backups'])
+        self._get_cmd_out(['-d', 'backup', 'my_local_backups'])
+        rows = BackupHistory('dupcomposer-config.yml.history').get_rows()
+        # Dry runs are not recorded.
+        self.assertEqual([(row['group_name'], row['source'], row['mode'],
+                           row['returncode']) for row in rows],
+                         [('my_local_backups', '/var/www/html', 'backup', 0),
+                          ('my_local_backups', 'home/tommy', 'backup', 0)])
+        self.assertLessEqual(rows[0]['start_time'], rows[0]['end_time'])
+
+    def test_journal_removed_after_success(self):
+        self._get_duplicity_results('backup_example_complete')
+        self.assertFalse(os.path.exists('dupcomposer-config.yml.journal'))
+
+    def test_resume(self):
+        # Mock a run interrupted after completing the local backups.
+        group_data = read_config('dupcomposer-config.yml')['backup_groups']['my_local_backups']
+        journal = BackupJournal('dupcomposer-config.yml.journal', 'backup')
+        journal.begin()
+        for args in self.test_data['backup_example_complete']['result']['args'][:2]:
+            journal.mark_completed('my_local_backups', group_data, ['duplicity'] + args)
+        self.assertEqual(self._get_duplicity_results('backup_example_resume'),
+                         self.test_data['backup_example_resume']['result'])
+        self.assertFalse(os.path.exists('dupcomposer-config.yml.journal'))
+
+    def test_skip_unchanged(self):
+        source_dir = tempfile.mkdtemp()
+        config_dir = tempfile.mkdtemp()
+        config_file = os.path.join(config_dir, 'config.yml')
+        with open(config_file, 'w') as f:
+            f.write('backup_groups:\n'
+                    '  cold_archive:\n'
+                    '    encryption:\n'
+                    '      enabled: no\n'
+                    '    backup_provider:\n'
+                    '      url: file://\n'
+                    '    volume_size: 200\n'
+                    '    skip_unchanged: yes\n'
+                    '    sources:\n'
+                    '      {}:\n'
+                    '        backup_path: /backups/archive\n'
+                    '        restore_path: /restored/archive\n'.format(source_dir))
+
+        def run_count(*args):
+            self._get_cmd_out(['-s', '-c', config_file] + list(args) + ['backup'])
+            if not os.path.exists(self.dummy_outfile):
+                return 0
+            with open(self.dummy_outfile) as f:
+                count = len(json.loads(f.read())['args'])
+            os.remove(self.dummy_outfile)
+            return count
+
+        self.assertEqual(run_count(), 1)
+        self.assertEqual(run_count(), 0)
+        self.assertEqual(run_count('--force'), 1)
+        with open(os.path.join(source_dir, 'new-file'), 'w') as f:
+            f.write('changed')
+        self.assertEqual(run_count(), 1)
+        self.assertEqual(run_count(), 0)
+        shutil.rmtree(source_dir)
+        shutil.rmtree(config_dir)
+
     def test_changed_config(self):
         self.assertRegex(self._get_cmd_out(['-c', 'cache-test-fixture/dupcomposer-config-changed.yml', 'backup']),
                          r'^The configuration of existing group\(s\) '
@@ -370,14 +611,34 @@ class TestCLI(unittest.TestCase):
                                             'backup']),
                          expected)
 
-    def test_cache_file_create(self):
+    def test_digest_file_create(self):
         dummyfile = '/tmp/' + str(uuid.uuid4()) + '.yml'
-        cachefile = '.'.join([dummyfile, '.cached'])
+        digestfile = '.'.join([dummyfile, 'digests'])
         shutil.copyfile('cache-test-fixture/dupcomposer-config-changed.yml', dummyfile)
         self._get_cmd_out(['-c', dummyfile, 'backup'])
-        self.assertTrue(filecmp.cmp(dummyfile, cachefile))
+        groups = read_config(dummyfile)['backup_groups']
+        with open(digestfile) as f:
+            self.assertEqual(json.load(f),
+                             {name: hash_data(groups[name]) for name in groups})
         os.remove(dummyfile)
-        os.remove(cachefile)
+        os.remove(digestfile)
+
+    def test_digests_record_groups_run(self):
+        config_dir = tempfile.mkdtemp()
+        config_file = os.path.join(config_dir, 'config.yml')
+        shutil.copyfile('cache-test-fixture/dupcomposer-config-changed.yml', config_file)
+        self._get_cmd_out(['-c', config_file, 'backup', 'unchanged_group'])
+        with open(config_file) as f:
+            config = f.read()
+        with open(config_file, 'w') as f:
+            f.write(config.replace('volume_size: 200', 'volume_size: 100'))
+        # Groups not run before are not checked.
+        self.assertNotIn('have changed',
+                         self._get_cmd_out(['-c', config_file, 'backup', 'backup_local']))
+        self.assertRegex(self._get_cmd_out(['-c', config_file, 'backup']),
+                         r'^The configuration of existing group\(s\) '
+                         'unchanged_group have changed')
+        shutil.rmtree(config_dir)
 
     def test_filters_backup(self):
         self.assertEqual(self._get_duplicity_results('backup_filters'),
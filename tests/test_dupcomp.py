@@ -1,7 +1,24 @@
 import unittest
-from dupcomposer.backup_runner import read_config, BackupRunner
+from unittest.mock import patch, MagicMock
+import asyncio
+import datetime
+import io
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+from dupcomposer.backup_runner import read_config, BackupRunner, GroupResult
 from dupcomposer.backup_config import BackupConfig
 
+def coroutine_mock(mock):
+    """Wrap a mock in a coroutine function, AsyncMock needs Python 3.8."""
+    async def coroutine_function(*args, **kwargs):
+        return mock(*args, **kwargs)
+    return coroutine_function
+
 class TestBackupRunner(unittest.TestCase):
 
     @classmethod
@@ -58,6 +75,17 @@ class TestBackupRunner(unittest.TestCase):
                           BackupRunner,
                           BackupConfig(self.config_data), 'foo')
 
+    def test_jobs(self):
+        self.assertEqual(self.runner_backup_mode.jobs, 1)
+        runner = BackupRunner(BackupConfig(self.config_data), 'backup', jobs=3)
+        self.assertEqual(runner.jobs, 3)
+
+    def test_invalid_jobs(self):
+        for jobs in (0, -1, '2', True):
+            self.assertRaises(ValueError,
+                              BackupRunner,
+                              BackupConfig(self.config_data), 'backup', jobs=jobs)
+
     def test_invalid_config_object(self):
         self.assertRaises(ValueError,
                           BackupRunner,
@@ -75,3 +103,398 @@ class TestBackupRunner(unittest.TestCase):
             data_expected[name] = self.cmds_expected_bkup[name]
         self.assertEqual(self.runner_backup_mode.get_cmds_raw(group_names),
                          data_expected)
+
+    def test_iter_cmds(self):
+        cmds = self.runner_backup_mode.iter_cmds()
+        self.assertIsInstance(cmds, types.GeneratorType)
+        self.assertEqual(list(cmds),
+                         [(group, cmd) for group in sorted(self.cmds_expected_bkup)
+                          for cmd in self.cmds_expected_bkup[group]])
+        self.assertEqual([group for group, cmd in self.runner_backup_mode.iter_cmds(
+                              ['my_s3_backups', 'my_local_backups'])],
+                         ['my_local_backups'] * 2 + ['my_s3_backups'] * 2)
+
+    def test_iter_plan(self):
+        records = list(self.runner_backup_mode.iter_plan(['my_local_backups',
+                                                          'my_scp_backups']))
+        self.assertEqual([record['argv'] for record in records],
+                         self.cmds_expected_bkup['my_local_backups'] +
+                         self.cmds_expected_bkup['my_scp_backups'])
+        self.assertEqual(records[2],
+                         {'group': 'my_scp_backups', 'source': '/home/katy',
+                          'action': 'backup',
+                          'argv': self.cmds_expected_bkup['my_scp_backups'][0],
+                          'env': {'FTP_PASSWORD': None},
+                          'host': 'host.example.com', 'cost': None})
+        restore_record = next(self.runner_restore_mode.iter_plan(['my_local_backups']))
+        self.assertEqual(restore_record['action'], 'restore')
+        self.assertIsNone(restore_record['cost'])
+
+    def test_iter_plan_unreadable_source(self):
+        # A source which can't be read has no cost, it doesn't fail the plan.
+        with patch('os.lstat', side_effect=PermissionError):
+            records = list(self.runner_backup_mode.iter_plan(['my_local_backups']))
+        self.assertEqual([record['cost'] for record in records], [None, None])
+
+    def test_run_plan_invalid(self):
+        record = next(self.runner_backup_mode.iter_plan(['my_local_backups']))
+        for key, value, message in (('action', 'restore', 'mixed'),
+                                    ('group', 'missing', 'No group missing'),
+                                    ('source', '/missing', 'No source /missing'),
+                                    ('argv', ['rm', '-rf', '/'], "doesn't match"),
+                                    ('argv', record['argv'] + ['--exclude', '**'],
+                                     "doesn't match")):
+            with patch.object(self.runner_backup_mode, '_run_all') as run_all:
+                self.assertRaisesRegex(ValueError, message,
+                                       self.runner_backup_mode.run_plan,
+                                       [record, dict(record, **{key: value})])
+                run_all.assert_not_called()
+
+    def test_run_plan(self):
+        records = list(self.runner_backup_mode.iter_plan(['my_local_backups']))
+        with patch.object(self.runner_backup_mode, '_run_all') as run_all:
+            self.runner_backup_mode.run_plan(records[1:])
+        commands, sources = run_all.call_args[0]
+        self.assertEqual(commands,
+                         {'my_local_backups': self.cmds_expected_bkup['my_local_backups'][1:]})
+        self.assertEqual([source.source_path for source in sources['my_local_backups']],
+                         ['home/tommy'])
+        # The plans forcing full backups are run as well.
+        record = dict(records[0], argv=['duplicity', 'full'] + records[0]['argv'][1:])
+        with patch.object(self.runner_backup_mode, '_run_all') as run_all:
+            self.runner_backup_mode.run_plan([record])
+        self.assertEqual(run_all.call_args[0][0], {'my_local_backups': [record['argv']]})
+
+    def test_get_process_env(self):
+        group = self.runner_backup_mode.config.groups['my_scp_backups']
+        with patch.dict(os.environ, {'DUPCOMP_TEST_VAR': 'x'}):
+            env = self.runner_backup_mode._get_process_env(group)
+        self.assertEqual(env['DUPCOMP_TEST_VAR'], 'x')
+        self.assertEqual(env['FTP_PASSWORD'], 'xxxxxx')
+        # The environment is built once for the group.
+        with patch.object(group, 'get_env') as get_env:
+            self.assertIs(self.runner_backup_mode._get_process_env(group), env)
+            get_env.assert_not_called()
+
+    def test_get_process_env_allowlist(self):
+        config_data = dict(self.config_data, env_allowlist=['PATH', 'MISSING_VAR'])
+        runner = BackupRunner(BackupConfig(config_data), 'backup')
+        self.assertEqual(runner._get_process_env(runner.config.groups['my_scp_backups']),
+                         {'PATH': os.environ['PATH'], 'FTP_PASSWORD': 'xxxxxx'})
+        # The allowlist of the group takes precedence.
+        group = runner.config.groups['my_local_backups']
+        group.env_allowlist = []
+        self.assertEqual(runner._get_process_env(group), {})
+
+    def test_get_cmds_raw_builds_selected_groups(self):
+        self.runner_backup_mode.get_cmds_raw(['my_local_backups'])
+        self.assertEqual(list(self.runner_backup_mode.config.groups._groups),
+                         ['my_local_backups'])
+
+    def test_run_cmd_streams_output(self):
+        out = io.StringIO()
+        script = 'import sys\nfor i in range(2000): print(i)\nsys.exit(3)'
+        start = time.monotonic()
+        returncode = asyncio.run(
+            self.runner_backup_mode._run_cmd([sys.executable, '-c', script], {}, out))
+        # No polling delay, the result is reported right after exit.
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(returncode, 3)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[:2000], [str(i) for i in range(2000)])
+        self.assertEqual(lines[2000:], ['== End of Duplicity output ==',
+                                        'Duplicity returned with ERROR CODE 3'])
+
+    def test_run_cmd_without_path(self):
+        config_data = dict(self.config_data, env_allowlist=['HOME'])
+        runner = BackupRunner(BackupConfig(config_data), 'backup')
+        env = runner._get_process_env(runner.config.groups['my_local_backups'])
+        self.assertNotIn('PATH', env)
+        out = io.StringIO()
+        path = os.pathsep.join([os.path.dirname(sys.executable),
+                                os.environ.get('PATH', '')])
+        # The executable is found on the PATH of dupcomp.
+        with patch.dict(os.environ, {'PATH': path}):
+            returncode = asyncio.run(runner._run_cmd(
+                [os.path.basename(sys.executable), '-c', 'print(1)'], env, out))
+        self.assertEqual(returncode, 0)
+        self.assertEqual(out.getvalue().splitlines()[0], '1')
+
+    def test_run_cmd_not_found(self):
+        out = io.StringIO()
+        returncode = asyncio.run(
+            self.runner_backup_mode._run_cmd(['/nonexistent/duplicity'], {}, out))
+        self.assertEqual(returncode, BackupRunner.start_error_returncode)
+        self.assertIn('Duplicity could NOT be started', out.getvalue())
+
+    def test_run_group_cmds_source_results(self):
+        script = ('print("--------------[ Backup Statistics ]--------------")\n'
+                  'print("SourceFiles 10")\nprint("RawDeltaSize 2048 (2.00 KB)")\n'
+                  'print("-------------------------------------------------")')
+        commands = {'my_local_backups': [[sys.executable, '-c', script],
+                                         [sys.executable, '-c',
+                                          'import sys; sys.exit(2)']]}
+        result = GroupResult('my_local_backups')
+        self.runner_backup_mode.keep_going = True
+        returncodes = asyncio.run(
+            self.runner_backup_mode._run_group_cmds(commands, 'my_local_backups',
+                                                    io.StringIO(), None, result))
+        self.assertEqual(returncodes, [0, 2])
+        self.assertEqual([(source.source, source.status, source.stats)
+                          for source in result.sources],
+                         [('/var/www/html', 'OK',
+                           {'SourceFiles': 10, 'RawDeltaSize': 2048}),
+                          ('home/tommy', 'FAILED', {})])
+
+    def test_write_metrics(self):
+        metrics_dir = tempfile.mkdtemp()
+        config_data = dict(self.config_data,
+                           metrics={'json': os.path.join(metrics_dir, 'metrics.json'),
+                                    'textfile': os.path.join(metrics_dir, 'no', 'x.prom')})
+        runner = BackupRunner(BackupConfig(config_data), 'backup')
+        with patch('sys.stderr', new_callable=io.StringIO) as err:
+            runner._write_metrics([GroupResult('my_local_backups')])
+        self.assertTrue(os.path.exists(os.path.join(metrics_dir, 'metrics.json')))
+        # A metrics file which can't be written doesn't fail the run.
+        self.assertIn('Unable to write the metrics', err.getvalue())
+        shutil.rmtree(metrics_dir)
+
+    def test_get_estimates(self):
+        source_dir = tempfile.mkdtemp()
+        with open(os.path.join(source_dir, 'data'), 'wb') as f:
+            f.write(b'x' * 1000)
+        history = types.SimpleNamespace(
+            get_durations=lambda mode: {('alpha', '/etc'): 30.0},
+            get_throughput=lambda mode: 100.0)
+        runner = BackupRunner(BackupConfig(self.config_data), 'backup',
+                              history=history)
+        def source(path):
+            return types.SimpleNamespace(source_path=path,
+                                         filters=types.SimpleNamespace(is_excluded=None))
+        commands = {'alpha': [['duplicity'], ['duplicity']], 'bravo': [['duplicity']]}
+        sources = {'alpha': [source('/etc'), source(source_dir)],
+                   'bravo': [source('/nonexistent')]}
+        estimates = runner._get_estimates(commands, sources)
+        shutil.rmtree(source_dir)
+        # From the history, the size of the source and the average.
+        self.assertEqual(estimates, {'alpha': [30.0, 10.0], 'bravo': [20.0]})
+        # Nothing to estimate from.
+        runner.history = None
+        self.assertEqual(runner._get_estimates({'bravo': [['duplicity']]},
+                                               {'bravo': [source('/nonexistent')]}),
+                         {})
+
+    def test_needs_estimates(self):
+        runner = BackupRunner(BackupConfig(self.config_data), 'backup', jobs=1)
+        commands = {'my_local_backups': [], 'my_s3_backups': []}
+        self.assertFalse(runner._needs_estimates(commands, None))
+        self.assertTrue(runner._needs_estimates(commands, 60.0))
+        runner.config.groups['my_s3_backups'].parallel_sources = 2
+        self.assertTrue(runner._needs_estimates(commands, None))
+        self.assertFalse(runner._needs_estimates({'my_local_backups': []}, None))
+        runner.jobs = 2
+        self.assertTrue(runner._needs_estimates({'my_local_backups': []}, None))
+
+    def test_run_without_estimates(self):
+        runner = BackupRunner(BackupConfig(self.config_data), 'backup', jobs=1)
+        with patch.object(runner, '_get_estimates') as get_estimates, \
+             patch.object(runner, '_run_group', coroutine_mock(MagicMock())), \
+             patch('sys.stdout', new_callable=io.StringIO) as out:
+            runner.run_cmds(['my_local_backups'])
+        get_estimates.assert_not_called()
+        self.assertNotIn('Predicted makespan', out.getvalue())
+
+    def test_get_group_order(self):
+        commands = {group: [] for group in self.cmds_expected_bkup}
+        estimates = {'my_local_backups': [1.0, 2.0], 'my_s3_backups': [5.0, 5.0],
+                     'my_s3_boto3_backups': [4.0, 0.0], 'my_scp_backups': [8.0, 1.0]}
+        runner = BackupRunner(BackupConfig(self.config_data), 'backup', jobs=2)
+        self.assertEqual(runner._get_group_order(commands), (sorted(commands), [], None))
+        runner._estimates = estimates
+        # The longest groups first.
+        self.assertEqual(runner._get_group_order(commands),
+                         (['my_s3_backups', 'my_scp_backups', 'my_s3_boto3_backups',
+                           'my_local_backups'], [], 13.0))
+        # The groups run one after another in the order of their names.
+        runner.jobs = 1
+        self.assertEqual(runner._get_group_order(commands), (sorted(commands), [], 26.0))
+
+    def test_get_group_order_priority(self):
+        commands = {group: [] for group in self.cmds_expected_bkup}
+        runner = BackupRunner(BackupConfig(self.config_data), 'backup', jobs=2,
+                              deferred=types.SimpleNamespace(groups=['my_scp_backups']))
+        runner.config.groups['my_s3_backups'].priority = 'low'
+        runner.config.groups['my_local_backups'].priority = 'critical'
+        runner._estimates = {'my_local_backups': [1.0], 'my_s3_backups': [5.0],
+                             'my_s3_boto3_backups': [4.0], 'my_scp_backups': [3.0]}
+        # Critical groups first, then the ones deferred in the last run.
+        self.assertEqual(runner._get_group_order(commands),
+                         (['my_local_backups', 'my_scp_backups',
+                           'my_s3_boto3_backups', 'my_s3_backups'], [], 8.0))
+        # The low priority group would finish after the deadline.
+        self.assertEqual(runner._get_group_order(commands, 7.5),
+                         (['my_local_backups', 'my_scp_backups',
+                           'my_s3_boto3_backups'], ['my_s3_backups'], 5.0))
+        # Unless it was deferred in the last run already.
+        runner.deferred.groups.append('my_s3_backups')
+        self.assertEqual(runner._get_group_order(commands, 7.5)[1], [])
+        # Groups are only deferred on estimates.
+        runner._estimates = {}
+        self.assertEqual(runner._get_group_order(commands, 0.0)[1], [])
+
+    def test_is_late(self):
+        runner = BackupRunner(BackupConfig(self.config_data), 'backup')
+        self.assertFalse(runner._is_late('my_s3_backups'))
+        runner._deadline_at = time.monotonic() + 60
+        runner._group_costs = {'my_s3_backups': 120.0, 'my_local_backups': 120.0}
+        runner.config.groups['my_s3_backups'].priority = 'low'
+        self.assertTrue(runner._is_late('my_s3_backups'))
+        self.assertTrue(runner._is_late('my_local_backups'))
+        runner.config.groups['my_local_backups'].priority = 'critical'
+        self.assertFalse(runner._is_late('my_local_backups'))
+        # Not in two runs in a row.
+        runner.deferred = types.SimpleNamespace(groups=['my_s3_backups'])
+        self.assertFalse(runner._is_late('my_s3_backups'))
+
+    def test_run_deferred(self):
+        deferred = types.SimpleNamespace(groups=[], update=MagicMock())
+        config_data = dict(self.config_data, window=1)
+        runner = BackupRunner(BackupConfig(config_data), 'backup', deferred=deferred)
+        runner.config.groups['my_local_backups'].priority = 'critical'
+        runner.config.groups['my_s3_backups'].priority = 'low'
+        estimates = {'my_local_backups': [0.0, 0.0], 'my_s3_backups': [60.0, 60.0]}
+        run_group = MagicMock()
+        with patch.object(runner, '_get_estimates', return_value=estimates), \
+             patch.object(runner, '_run_group', coroutine_mock(run_group)), \
+             patch('sys.stdout', new_callable=io.StringIO) as out:
+            results = runner.run_cmds(['my_local_backups', 'my_s3_backups'])
+        self.assertEqual([(result.name, result.status) for result in results],
+                         [('my_local_backups', 'SKIPPED'),
+                          ('my_s3_backups', 'DEFERRED')])
+        self.assertEqual(run_group.call_count, 1)
+        self.assertIn('Deferred to the next run, as these would have missed the '
+                      'deadline: my_s3_backups', out.getvalue())
+        deferred.update.assert_called_once_with([], ['my_s3_backups'])
+        # The group deferred is run the next time, even if late.
+        deferred.groups = ['my_s3_backups']
+        run_group = MagicMock()
+        with patch.object(runner, '_get_estimates', return_value=estimates), \
+             patch.object(runner, '_run_group', coroutine_mock(run_group)), \
+             patch('sys.stdout', new_callable=io.StringIO):
+            results = runner.run_cmds(['my_local_backups', 'my_s3_backups'])
+        self.assertEqual(run_group.call_count, 2)
+        self.assertFalse(any(result.deferred for result in results))
+
+    def test_run_normal_past_deadline(self):
+        deferred = types.SimpleNamespace(groups=[], update=MagicMock())
+        runner = BackupRunner(BackupConfig(self.config_data), 'backup',
+                              deferred=deferred)
+        runner.config.groups['my_local_backups'].priority = 'critical'
+        run_group = MagicMock()
+        with patch.object(runner.config, 'get_time_left', return_value=0.0), \
+             patch.object(runner, '_get_estimates', return_value={}), \
+             patch.object(runner, '_run_group', coroutine_mock(run_group)), \
+             patch('sys.stdout', new_callable=io.StringIO):
+            results = runner.run_cmds(['my_local_backups', 'my_s3_backups'])
+        # The normal group isn't started once the deadline has passed.
+        self.assertEqual([(result.name, result.status) for result in results],
+                         [('my_local_backups', 'SKIPPED'),
+                          ('my_s3_backups', 'DEFERRED')])
+        self.assertEqual(run_group.call_count, 1)
+        deferred.update.assert_called_once_with([], ['my_s3_backups'])
+
+    def test_save_history_error(self):
+        history = types.SimpleNamespace(file_path='/nonexistent/history',
+                                        save=lambda: sqlite3.connect('/nonexistent/x'))
+        runner = BackupRunner(BackupConfig(self.config_data), 'backup',
+                              history=history)
+        with patch('sys.stderr', new_callable=io.StringIO) as err:
+            runner._save_history()
+        # A history which can't be written doesn't fail the run.
+        self.assertIn('Unable to save the history', err.getvalue())
+
+    def test_run_cmd_timeout(self):
+        out = io.StringIO()
+        returncode = asyncio.run(
+            self.runner_backup_mode._run_cmd([sys.executable, '-c',
+                                              'import time; time.sleep(30)'],
+                                             {}, out, timeout=0.2))
+        self.assertEqual(returncode, BackupRunner.timeout_returncode)
+        self.assertEqual(out.getvalue().splitlines(),
+                         ['== End of Duplicity output ==',
+                          'Duplicity TIMED OUT after 0.2 seconds.'])
+
+
+class TestReadConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_home = tempfile.mkdtemp()
+        self.config_dir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.config_dir, 'config.yml')
+        shutil.copyfile('tests/fixtures/dupcomposer-config.yml', self.config_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_home)
+        shutil.rmtree(self.config_dir)
+
+    def test_read_config(self):
+        with patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache_home}):
+            self.assertEqual(read_config(self.config_file, use_cache=True),
+                             read_config('tests/fixtures/dupcomposer-config.yml'))
+
+    def test_cached(self):
+        with patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache_home}):
+            config = read_config(self.config_file, use_cache=True)
+            self.assertEqual(len(os.listdir(os.path.join(self.cache_home,
+                                                         'dupcomposer'))), 1)
+            with patch('yaml.load') as yaml_load:
+                self.assertEqual(read_config(self.config_file, use_cache=True),
+                                 config)
+                yaml_load.assert_not_called()
+            # The file is parsed again when its content changes.
+            with open(self.config_file, 'a') as f:
+                f.write('max_parallel_groups: 2\n')
+            self.assertEqual(read_config(self.config_file,
+                                         use_cache=True)['max_parallel_groups'], 2)
+
+    def test_broken_cache(self):
+        with patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache_home}):
+            read_config(self.config_file, use_cache=True)
+            cache_dir = os.path.join(self.cache_home, 'dupcomposer')
+            for name in os.listdir(cache_dir):
+                with open(os.path.join(cache_dir, name), 'wb') as f:
+                    f.write(b'garbage')
+            self.assertEqual(read_config(self.config_file, use_cache=True),
+                             read_config(self.config_file))
+            for payload in (b'[]', b'{"data": {}}', b'"x"'):
+                for name in os.listdir(cache_dir):
+                    with open(os.path.join(cache_dir, name), 'wb') as f:
+                        f.write(payload)
+                self.assertEqual(read_config(self.config_file, use_cache=True),
+                                 read_config(self.config_file))
+
+    def test_unsafe_cache(self):
+        with patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache_home}):
+            config = read_config(self.config_file, use_cache=True)
+            cache_dir = os.path.join(self.cache_home, 'dupcomposer')
+            cache_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            self.assertEqual(os.stat(cache_path).st_mode & 0o777, 0o600)
+            # A cache file others can write to is not trusted.
+            os.chmod(cache_path, 0o622)
+            with patch('yaml.load', return_value=config) as yaml_load:
+                read_config(self.config_file, use_cache=True)
+                yaml_load.assert_called_once()
+            with patch('os.geteuid', return_value=os.geteuid() + 1), \
+                 patch('yaml.load', return_value=config) as yaml_load:
+                read_config(self.config_file, use_cache=True)
+                yaml_load.assert_called_once()
+
+    def test_not_cached(self):
+        with patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache_home}):
+            # The data which doesn't survive the JSON round trip.
+            for data in ({'date': datetime.date(2020, 1, 1)}, {1: 'x'}):
+                with patch('yaml.load', return_value=data):
+                    self.assertEqual(read_config(self.config_file, use_cache=True),
+                                     data)
+                self.assertEqual(os.listdir(os.path.join(self.cache_home,
+                                                         'dupcomposer')), [])